@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+#  ebuild-commander Overhead Benchmarks
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+"""
+Measure ebuild-commander's own overhead by running it with a stand-in for the
+'docker' executable that does not create any container, and compare the
+results with the previous run recorded in a history file.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = pathlib.Path(__file__).resolve().parent
+
+PROJECT_DIR = BENCHMARKS_DIR.parent
+
+FAKE_DOCKER = BENCHMARKS_DIR / 'fake-docker'
+
+DEFAULT_HISTORY = BENCHMARKS_DIR / 'history.jsonl'
+
+# Docker commands whose latency can be simulated
+LATENCY_COMMANDS = ('run', 'exec', 'rm', 'pull')
+
+# Phases reported for every run, in the order they happen
+PHASES = ('run_container', 'config_portage', 'cleanup')
+
+# Smallest increase in the total time of a run, in seconds, that can be
+# reported as a regression; smaller changes are within the noise of process
+# scheduling
+NOISE_FLOOR = 0.005
+
+
+def main() -> int:
+    opts = parse_args()
+    env = dict(os.environ)
+    env['EBUILD_CMDER_DOCKER'] = str(FAKE_DOCKER)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [str(PROJECT_DIR / 'src'), env.get('PYTHONPATH')]))
+    for cmd, latency in opts.latency.items():
+        env[f'FAKE_DOCKER_LATENCY_{cmd.upper()}'] = str(latency)
+
+    samples = {name: [] for name in ('startup',) + PHASES}
+    per_line = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # Keep the runs from reading or adding to the user's caches, like the
+        # build history and the records of image pulls
+        env['XDG_CACHE_HOME'] = str(pathlib.Path(tmp, 'cache'))
+        for num_lines in opts.lines:
+            script = pathlib.Path(tmp, f'{num_lines}.sh')
+            script.write_text('true\n' * num_lines)
+            durations = []
+            for _ in range(opts.repeat):
+                run = run_once(opts, env, script, pathlib.Path(tmp))
+                for name in samples:
+                    samples[name].append(run[name])
+                durations.append(run['execute'] / num_lines)
+            per_line[str(num_lines)] = statistics.median(durations)
+            print(f"{num_lines} line(s): {per_line[str(num_lines)] * 1000:.3f}"
+                  f" ms per line", file=sys.stderr)
+
+    results = {name: statistics.median(values)
+               for name, values in samples.items()}
+    results['execute_per_line'] = per_line
+    record = {
+        'time': time.time(),
+        'commit': get_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'persistent_shell': opts.persistent_shell,
+        'latency': opts.latency,
+        'results': results,
+    }
+
+    previous = find_previous(opts.history, record)
+    regressions = print_results(record, previous, opts.threshold)
+    if opts.record:
+        with open(opts.history, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    return 1 if regressions else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Measure ebuild-commander's overhead with a stand-in "
+                    "for the 'docker' executable.")
+    parser.add_argument(
+        '--lines',
+        type=lambda value: [int(n) for n in value.split(',')],
+        default=[10, 100, 1000, 10000],
+        help="comma-separated numbers of lines of the scripts to run "
+             "(default: 10,100,1000,10000)")
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help="number of runs for each script, whose median is reported "
+             "(default: %(default)s)")
+    parser.add_argument(
+        '--latency',
+        type=parse_latency,
+        default={},
+        help="simulated latency of Docker commands in seconds, like "
+             "'run=0.5,exec=0.05' (default: none)")
+    parser.add_argument(
+        '--persistent-shell',
+        action='store_true',
+        help="run ebuild-commander with --persistent-shell")
+    parser.add_argument(
+        '--history',
+        type=pathlib.Path,
+        default=DEFAULT_HISTORY,
+        help="file the results of every run are appended to "
+             "(default: benchmarks/history.jsonl)")
+    parser.add_argument(
+        '--no-record',
+        dest='record',
+        action='store_false',
+        help="compare with the history without appending the results")
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=20,
+        help="percentage by which a result must exceed the previous one to "
+             "be reported as a regression (default: %(default)s)")
+    return parser.parse_args()
+
+
+def parse_latency(value: str) -> dict[str, float]:
+    latency = {}
+    for item in value.split(','):
+        cmd, sep, seconds = item.partition('=')
+        if not sep or cmd not in LATENCY_COMMANDS:
+            raise argparse.ArgumentTypeError(
+                f"expected CMD=SECONDS with CMD among "
+                f"{', '.join(LATENCY_COMMANDS)}: '{item}'")
+        latency[cmd] = float(seconds)
+    return latency
+
+
+def run_once(opts: argparse.Namespace, env: dict[str, str],
+             script: pathlib.Path, tmp: pathlib.Path) -> dict[str, float]:
+    """
+    Run ebuild-commander once and derive the duration of each part of the run
+    from its timing report.
+
+    :return: the durations in seconds
+    """
+    report_path = tmp / 'timing.json'
+    args = [sys.executable, str(PROJECT_DIR / 'bin' / 'ebuild-cmder'),
+            '--gentoo-repo', str(tmp), '--skip-cleanup', 'never',
+            '--timing-report', str(report_path), str(script)]
+    if opts.persistent_shell:
+        args.insert(2, '--persistent-shell')
+    launched = time.time()
+    result = subprocess.run(args, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        sys.exit(f"ebuild-cmder exited with status {result.returncode}:\n"
+                 f"{result.stderr}")
+    with open(report_path) as f:
+        spans = json.load(f)['spans']
+
+    run = {name: 0.0 for name in PHASES}
+    for span in spans:
+        if span['kind'] == 'phase' and span['name'] in run:
+            run[span['name']] += span['duration']
+    # Time before the first phase covers the interpreter's start-up, imports
+    # and checks of the options
+    run['startup'] = min(span['start'] for span in spans) - launched
+    commands = [span for span in spans if span['kind'] == 'command']
+    # Include the time between commands, which is part of the overhead of
+    # running a script
+    run['execute'] = commands[-1]['start'] + commands[-1]['duration'] - \
+        commands[0]['start']
+    return run
+
+
+def get_commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                            cwd=PROJECT_DIR, stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else ''
+
+
+def find_previous(history: pathlib.Path, record: dict) -> dict:
+    """
+    :return: the last record in the history that was made on the same host
+        with the same settings, or an empty dictionary if there is none
+    """
+    previous = {}
+    try:
+        with open(history) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if all(entry.get(key) == record[key] for key in
+                       ('host', 'persistent_shell', 'latency')):
+                    previous = entry
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def print_results(record: dict, previous: dict, threshold: float) -> bool:
+    """
+    Print the results next to the previous ones.
+
+    :return: whether any result regressed by more than `threshold` percent
+        and by at least `NOISE_FLOOR` in total
+    """
+    def flatten(results: dict) -> dict[str, tuple[float, int]]:
+        # Each value comes with the number of times it occurs in a run
+        values = {name: (value, 1) for name, value in results.items()
+                  if not isinstance(value, dict)}
+        for num_lines, value in results.get('execute_per_line', {}).items():
+            values[f'execute_per_line[{num_lines}]'] = (value, int(num_lines))
+        return values
+
+    current = flatten(record['results'])
+    old = flatten(previous.get('results', {}))
+    if previous:
+        print(f"Compared with {previous.get('commit') or 'unknown commit'} "
+              f"at {time.ctime(previous['time'])}:")
+    regressed = False
+    width = max(len(name) for name in current)
+    for name, (value, count) in current.items():
+        line = f"  {name.ljust(width)}  {value * 1000:10.3f} ms"
+        old_value = old.get(name, (0, count))[0]
+        if old_value:
+            change = (value - old_value) / old_value * 100
+            line += f"  {change:+7.1f}%"
+            if change > threshold and \
+                    (value - old_value) * count >= NOISE_FLOOR:
+                line += "  REGRESSION"
+                regressed = True
+        print(line)
+    return regressed
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,466 @@
+#  ebuild-commander Library Interface Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+"""
+An interface for running ebuild-commander jobs from other Python programs.
+
+A `JobRunner` runs any number of jobs described by `JobSpec` objects in the
+calling process, many at a time, and returns a `JobResult` for each job
+instead of exiting::
+
+    with JobRunner(max_jobs=4) as runner:
+        results = runner.run([
+            JobSpec([('build', ['emerge app-misc/foo'])], profile=profile)
+            for profile in profiles
+        ])
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import pathlib
+import shutil
+import sys
+import time
+import typing
+
+import ebuild_commander
+import ebuild_commander.cli
+
+from ebuild_commander.async_docker import AsyncCommandocker
+from ebuild_commander.endpoints import Endpoint, EndpointPool, \
+    get_endpoint_docker_cmd, run_on_endpoints
+from ebuild_commander.host import Tuning
+from ebuild_commander.jobs import create_job_container, get_job_cells, \
+    get_job_tmpfs_size, get_job_tuning, get_run_estimates, is_cleanup_needed
+from ebuild_commander.matrix import get_start_order, get_threads_per_cell
+from ebuild_commander.out_fmt import PrefixedWriter
+from ebuild_commander.policy import ExecutionPolicy, LineResult
+from ebuild_commander.pull import PullPolicy
+from ebuild_commander.timing import Origin, TimingRecorder
+
+# Exit status of a job whose commands all succeeded
+EXIT_SUCCESS = 0
+
+# Exit status of a job in which any command failed
+EXIT_COMMAND_FAILED = 1
+
+# Exit status of a job whose container could not be started or removed
+EXIT_CONTAINER_ERROR = 3
+
+
+class JobSpec(typing.NamedTuple):
+    """
+    The settings of a job, which mirror the command-line options of the same
+    names.  A field left as `None` takes the default value of its option.
+    """
+    # The name and the lines of each script to run, in order
+    scripts: list[tuple[str, list[str]]]
+    profile: typing.Optional[str] = None
+    docker_image: typing.Optional[str] = None
+    portage_config: typing.Optional[list[pathlib.Path]] = None
+    gentoo_repo: typing.Optional[pathlib.Path] = None
+    custom_repo: typing.Optional[list[pathlib.Path]] = None
+    # With `None`, the host's threads are divided among the jobs run at the
+    # same time; when the job runs on an endpoint, this is the number of
+    # threads of the endpoint, which are divided among the jobs it runs at the
+    # same time, and it is required
+    threads: typing.Optional[int] = None
+    emerge_opts: typing.Optional[str] = None
+    pull: bool = False
+    pull_policy: typing.Optional[PullPolicy] = None
+    storage_opt: typing.Optional[str] = None
+    docker_socket: typing.Optional[pathlib.Path] = None
+    persistent_shell: bool = False
+    binpkg_cache: typing.Optional[pathlib.Path] = None
+    binpkg_cache_size: typing.Optional[int] = None
+    distfiles_cache: typing.Optional[pathlib.Path] = None
+    distfiles_cache_size: typing.Optional[int] = None
+    ccache: typing.Optional[pathlib.Path] = None
+    ccache_size: typing.Optional[int] = None
+    metadata_cache: typing.Optional[pathlib.Path] = None
+    metadata_cache_size: typing.Optional[int] = None
+    tmpfs: bool = False
+    tmpfs_size: typing.Optional[int] = None
+    tmpfs_exclude: typing.Optional[list[str]] = None
+    auto_tune: bool = False
+    snapshot: bool = False
+    layer_cache: bool = False
+    layer_cache_max_layers: typing.Optional[int] = None
+    layer_cache_size: typing.Optional[int] = None
+    log_dir: typing.Optional[pathlib.Path] = None
+    log_tail: typing.Optional[int] = None
+    fail_fast: bool = False
+    history: bool = False
+    # One of 'always', 'on-fail' and 'never'
+    skip_cleanup: typing.Optional[str] = None
+    background_cleanup: bool = False
+
+    def to_options(self) -> argparse.Namespace:
+        """
+        :return: the parsed command-line arguments equivalent to this job's
+            settings, except for the scripts
+        """
+        opts = ebuild_commander.cli.parse_args([], exit_on_error=False)
+        for name, value in self._asdict().items():
+            if name == 'scripts' or value is None:
+                continue
+            if name in ('profile', 'docker_image'):
+                # The options accept more than one value for build matrices
+                value = [value]
+            setattr(opts, name, value)
+        return opts
+
+
+class CommandResult(typing.NamedTuple):
+    """
+    The result of a command run by a job.
+    """
+    command: str
+    # The command's location in the job's scripts
+    origin: typing.Optional[Origin]
+    status: int
+    # The time the command started, in seconds since the epoch
+    start: float
+    # The command's duration in seconds
+    duration: float
+
+
+class JobResult(typing.NamedTuple):
+    """
+    The result of a job.
+    """
+    # One of the EXIT_* constants
+    exit_status: int
+    container_name: str
+    # The commands run in the container, in order; commands whose results the
+    # container was created with are not run
+    commands: list[CommandResult]
+    # The number of commands whose results the container was created with
+    skipped_commands: int
+    # The total time in seconds spent in each phase of the container's life
+    # cycle
+    phases: dict[str, float]
+    # Whether the container was removed
+    cleaned_up: bool
+    # The outcome of every line of the scripts, including the lines skipped
+    # after failures
+    lines: list[LineResult]
+    # The host of the endpoint the job ran on, if the job ran on an endpoint
+    endpoint: typing.Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.exit_status == EXIT_SUCCESS
+
+
+class _Job(typing.NamedTuple):
+    spec: JobSpec
+    # The parsed command-line arguments equivalent to the job's settings
+    opts: argparse.Namespace
+    num_threads: int
+    tmpfs_size: typing.Optional[int]
+    tuning: typing.Optional[Tuning]
+
+
+class JobRunner:
+    """
+    Run jobs in the calling process, driving the container of every job from
+    a single event loop.
+
+    A runner should be used as a context manager.  Each job removes its
+    container when it finishes unless its `skip_cleanup` setting says
+    otherwise, and containers of jobs that were stopped by an exception are
+    removed when the `with` statement is left.
+    """
+
+    def __init__(self, program_name: str = 'ebuild-cmder',
+                 max_jobs: typing.Optional[int] = None,
+                 docker_cmd: typing.Optional[str] = None,
+                 output: typing.Optional[typing.BinaryIO] = None,
+                 endpoints: typing.Optional[typing.Sequence[Endpoint]] = None,
+                 endpoint_retries: int = 2):
+        """
+        :param program_name: the program name for messages, which also
+            prefixes the name of every container
+        :param max_jobs: the maximum number of jobs that run at the same time
+            (default: unlimited)
+        :param docker_cmd: the executable providing Docker functionalities
+            (default: the one the environment variable for the command-line
+            interface specifies)
+        :param output: the stream for the output of the commands, prefixed
+            with each job's number (default: this program's standard output)
+        :param endpoints: if specified, the Docker daemons to place the jobs
+            on, as an `EndpointPool` does, through `docker_cmd`
+        :param endpoint_retries: the number of other endpoints to try when a
+            job's container cannot be started on an endpoint
+        :raise FileNotFoundError: if the executable cannot be found
+        :raise ValueError: if an endpoint is specified more than once
+        :raise OSError: if the executables for the endpoints cannot be
+            created
+        """
+        if docker_cmd is None:
+            docker_cmd = os.getenv(ebuild_commander.__env_var_docker__,
+                                   ebuild_commander.__env_default_docker__)
+        if shutil.which(docker_cmd) is None:
+            raise FileNotFoundError(
+                f"Executable for Docker functionalities '{docker_cmd}' not "
+                f"found")
+        self._program_name = program_name
+        self._max_jobs = max_jobs
+        self._docker_cmd = docker_cmd
+        self._output = output
+        self._endpoints = list(endpoints or [])
+        hosts = [endpoint.host for endpoint in self._endpoints]
+        if len(set(hosts)) < len(hosts):
+            raise ValueError("duplicate endpoint")
+        self._endpoint_retries = endpoint_retries
+        # The executable for each endpoint, by the endpoint's host
+        self._endpoint_cmds = {
+            endpoint.host: get_endpoint_docker_cmd(docker_cmd, endpoint)
+            for endpoint in self._endpoints}
+        self._name_prefix = \
+            f'{program_name}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        self._counter = itertools.count(1)
+        # Containers of jobs that have not finished
+        self._pending: dict[str, AsyncCommandocker] = {}
+
+    def __enter__(self) -> 'JobRunner':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    async def __aenter__(self) -> 'JobRunner':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.aclose()
+
+    def run(self, specs: typing.Sequence[JobSpec]) -> list[JobResult]:
+        """
+        Run jobs, and wait for all of them to finish.  This function must not
+        be called from a running event loop; use `run_async` there instead.
+
+        :param specs: the jobs' settings
+        :return: the result of each job
+        :raise ValueError: if any job's settings are invalid
+        """
+        return asyncio.run(self.run_async(specs))
+
+    async def run_async(
+            self, specs: typing.Sequence[JobSpec]) -> list[JobResult]:
+        """
+        Asynchronous version of `run`.  If the task is cancelled, the commands
+        being run are killed, and the containers are removed before
+        `asyncio.CancelledError` is raised.
+
+        :param specs: the jobs' settings
+        :return: the result of each job
+        :raise ValueError: if any job's settings are invalid
+        """
+        if not specs:
+            return []
+        max_jobs = self._max_jobs
+        if max_jobs is None or max_jobs < 1:
+            max_jobs = len(specs)
+        num_containers = min(len(specs), max_jobs)
+        # Everything that can go wrong with the settings is checked before
+        # any container is created
+        jobs = [self._prepare(spec, len(specs), max_jobs, num_containers)
+                for spec in specs]
+        estimates = None
+        if max_jobs < len(jobs):
+            # Jobs acquire the semaphore in the order they are started
+            estimates = [self._estimate(job) for job in jobs]
+        order = get_start_order(estimates, len(jobs))
+        semaphore = asyncio.Semaphore(max_jobs)
+        pool = None
+        if self._endpoints:
+            pool = EndpointPool(self._program_name, self._endpoints)
+        results = await asyncio.gather(
+            *(self._run_job(i + 1, jobs[i], semaphore, pool) for i in order))
+        return [result for _, result in sorted(zip(order, results),
+                                               key=lambda item: item[0])]
+
+    def close(self) -> None:
+        """
+        Remove the containers of jobs that have not finished.  This function
+        must not be called from a running event loop; use `aclose` there
+        instead.
+        """
+        if self._pending:
+            asyncio.run(self.aclose())
+
+    async def aclose(self) -> None:
+        """
+        Asynchronous version of `close`.
+        """
+        while self._pending:
+            _, container = self._pending.popitem()
+            await container.cleanup()
+
+    def _prepare(self, spec: JobSpec, num_jobs: int, max_jobs: int,
+                 num_containers: int) -> _Job:
+        opts = spec.to_options()
+        if opts.skip_cleanup not in ('always', 'on-fail', 'never'):
+            raise ValueError(f"invalid skip_cleanup value: "
+                             f"'{opts.skip_cleanup}'")
+        if self._endpoints:
+            # These settings depend on the host this program runs on
+            if spec.docker_socket is not None or spec.auto_tune:
+                raise ValueError("docker_socket and auto_tune cannot be "
+                                 "used with endpoints")
+            if spec.threads is None:
+                raise ValueError("threads is required with endpoints")
+            if spec.tmpfs and spec.tmpfs_size is None:
+                raise ValueError("tmpfs requires tmpfs_size with endpoints")
+        tuning = get_job_tuning(self._program_name, opts, self._docker_cmd,
+                                num_containers)
+        if tuning is not None:
+            num_threads = tuning.make_jobs
+        elif spec.threads is None:
+            num_threads = get_threads_per_cell(os.cpu_count() or 1,
+                                               num_jobs, max_jobs)
+        else:
+            num_threads = spec.threads
+        tmpfs_size = get_job_tmpfs_size(self._program_name, opts,
+                                        num_threads, num_containers, tuning)
+        return _Job(spec, opts, num_threads, tmpfs_size, tuning)
+
+    def _estimate(self, job: _Job) -> typing.Optional[float]:
+        estimates = get_run_estimates(self._program_name, job.opts,
+                                      get_job_cells(job.opts),
+                                      job.spec.scripts)
+        return None if estimates is None else estimates[0]
+
+    async def _run_job(self, index: int, job: _Job,
+                       semaphore: asyncio.Semaphore,
+                       pool: typing.Optional[EndpointPool]) -> JobResult:
+        async with semaphore:
+            output = PrefixedWriter(
+                self._output if self._output is not None
+                else sys.stdout.buffer, f'[{index}] ')
+            try:
+                if pool is None:
+                    return await self._run_container(index, job, output)
+                return await self._run_on_endpoints(index, job, output, pool)
+            finally:
+                output.close()
+
+    async def _run_on_endpoints(self, index: int, job: _Job,
+                                output: PrefixedWriter,
+                                pool: EndpointPool) -> JobResult:
+        """
+        Run a job on the endpoints, trying another endpoint when the job's
+        container cannot be started.
+        """
+        async def attempt(endpoint: Endpoint, can_retry: bool) \
+                -> typing.Optional[tuple[JobResult, bool]]:
+            result = await self._run_container(index, job, output, endpoint,
+                                               can_retry)
+            if result is None:
+                return None
+            # A container that cannot be removed also counts against the
+            # endpoint
+            return result, result.exit_status != EXIT_CONTAINER_ERROR
+
+        result = await run_on_endpoints(
+            pool, f'{self._program_name}[{index}]', self._endpoint_retries,
+            attempt)
+        if result is None:
+            return JobResult(EXIT_CONTAINER_ERROR, '', [], 0, {}, False, [])
+        return result
+
+    async def _run_container(
+            self, index: int, job: _Job, output: PrefixedWriter,
+            endpoint: typing.Optional[Endpoint] = None,
+            can_retry: bool = False) -> typing.Optional[JobResult]:
+        """
+        Run a job with a container.
+
+        :param endpoint: the endpoint to create the container on, if any
+        :param can_retry: whether the job can be run on another endpoint if
+            the container cannot be started
+        :return: the job's result, or `None` if the container could not be
+            started and the job should be run on another endpoint
+        """
+        container_name = f'{self._name_prefix}-{next(self._counter)}'
+        recorder = TimingRecorder()
+        docker_cmd = self._docker_cmd
+        num_threads = job.num_threads
+        if endpoint is not None:
+            docker_cmd = self._endpoint_cmds[endpoint.host]
+            # The threads of each endpoint are shared by its jobs
+            num_threads = max(1, job.spec.threads // endpoint.weight)
+        container = create_job_container(
+            f'{self._program_name}[{index}]', container_name, job.opts,
+            docker_cmd, get_job_cells(job.opts)[0], num_threads,
+            job.tmpfs_size, recorder, output, AsyncCommandocker, job.tuning,
+            endpoint)
+        self._pending[container_name] = container
+        policy = ExecutionPolicy(f'{self._program_name}[{index}]',
+                                 job.opts.fail_fast)
+        try:
+            exit_status = await container.run_scripts(job.spec.scripts,
+                                                      policy)
+        except asyncio.CancelledError:
+            await container.finish()
+            self._pending.pop(container_name, None)
+            await container.cleanup()
+            raise
+        await container.finish()
+        # Only a container that cannot be started results in this status
+        # before it is cleaned up
+        if exit_status == EXIT_CONTAINER_ERROR and can_retry:
+            self._pending.pop(container_name, None)
+            # Whatever has been created for the container is not useful
+            await container.cleanup()
+            return None
+        cleaned_up = is_cleanup_needed(job.opts, exit_status)
+        self._pending.pop(container_name, None)
+        if cleaned_up and not await container.cleanup():
+            exit_status = EXIT_CONTAINER_ERROR
+        return _get_result(exit_status, container, recorder, cleaned_up,
+                           policy,
+                           endpoint.host if endpoint is not None else None)
+
+
+def _get_result(exit_status: int, container: AsyncCommandocker,
+                recorder: TimingRecorder, cleaned_up: bool,
+                policy: ExecutionPolicy,
+                endpoint: typing.Optional[str] = None) -> JobResult:
+    commands = []
+    phases = {}
+    for span in recorder.get_report()['spans']:
+        if span['kind'] == 'phase':
+            phases[span['name']] = \
+                phases.get(span['name'], 0) + span['duration']
+            continue
+        origin = None
+        if 'script' in span:
+            origin = Origin(span['script'], span['line'])
+        commands.append(CommandResult(span['command'], origin,
+                                      span['status'], span['start'],
+                                      span['duration']))
+    return JobResult(exit_status, container.name, commands,
+                     container.skipped_commands, phases, cleaned_up,
+                     policy.results, endpoint)
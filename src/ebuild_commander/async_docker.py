@@ -0,0 +1,427 @@
+#  asyncio-based Docker Abstraction for ebuild-commander
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import functools
+import io
+import secrets
+import subprocess
+import sys
+import time
+import typing
+
+from ebuild_commander.docker import Commandocker, _SessionProtocol
+from ebuild_commander.layer import is_noop
+from ebuild_commander.out_fmt import error
+from ebuild_commander.policy import ExecutionPolicy
+from ebuild_commander.timing import Origin
+
+# Exit status of a command that timed out, which is the same as timeout(1)'s
+TIMEOUT_STATUS = 124
+
+# Seconds to wait for a killed command's processes to exit after SIGTERM
+# before sending SIGKILL
+_KILL_GRACE_PERIOD = 10
+
+_READ_SIZE = 65536
+
+# Runs the remaining arguments in a new session, whose ID is written to the
+# file given as $0 so that every process of the command can be killed with
+# one signal; the file is removed when the command finishes
+_KILLABLE_WRAPPER = ('echo "$$" > "$0" && "$@"; status=$?; rm -f "$0"; '
+                     'exit "${status}"')
+
+# Sends the signal given as $0 to the session whose ID is in the file given
+# as $1, waiting a moment for the file if the command has just been started
+_KILL_SCRIPT = ('for i in $(seq 50); do [ -s "$1" ] && break; sleep 0.1; '
+                'done; sid=$(cat "$1" 2>/dev/null) && '
+                'kill -s "$0" -- "-${sid}" 2>/dev/null; rm -f "$1"; exit 0')
+
+
+class AsyncCommandocker(Commandocker):
+    """
+    A variant of `Commandocker` whose `start`, `execute`, `finish` and
+    `cleanup` methods are coroutines, so a single event loop can drive many
+    containers at the same time.
+
+    Commands are run by asyncio subprocesses, and their output is copied as
+    soon as it is produced.  A command can be given a timeout, and the task
+    running it can be cancelled; either way, every process of the command in
+    the container is killed before `execute` returns or raises
+    `asyncio.CancelledError`.  This requires setsid(1) in the container, which
+    every Gentoo stage3 image provides.
+
+    Starting the container and releasing resources on the host take little
+    time compared to the commands, so they are done by the blocking
+    implementation in `Commandocker` on a worker thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_session = None
+
+    async def start(self, commands: typing.Sequence[str] = ()) -> bool:
+        """
+        Asynchronous version of `Commandocker.start`.  If the task is
+        cancelled, this function still waits for the container to be started,
+        so the container can be cleaned up afterwards.
+
+        :param commands: the commands that will be run in the container, in
+            order (default: unknown)
+        :return: whether or not the Docker container is successfully started
+        """
+        return await self._run_blocking(
+            functools.partial(super().start, commands))
+
+    async def execute(self, cmd: str, fatal_on_failure: bool = True,
+                      origin: typing.Optional[Origin] = None,
+                      timeout: typing.Optional[float] = None) -> bool:
+        """
+        Asynchronous version of `Commandocker.execute`.
+
+        :param cmd: the command to be run
+        :param fatal_on_failure: whether a failure to run the command indicates
+            a fatal error; used for determining error message format
+            (default: `True`)
+        :param origin: the command's location in the scripts, which is
+            included in the timing report (default: `None`)
+        :param timeout: the number of seconds after which the command is
+            killed and considered failed with exit status `TIMEOUT_STATUS`
+            (default: no timeout)
+        :return: whether or not the Docker process exited with a successful
+            status
+        """
+        start = time.time()
+        start_counter = time.perf_counter()
+        timed_out = False
+        log = self._open_log(cmd, origin)
+        output = self._output if log is None else log
+        try:
+            if self._use_session:
+                returncode = await asyncio.wait_for(
+                    self._run_in_session(cmd, output), timeout)
+            else:
+                returncode = await asyncio.wait_for(
+                    self._run_command(cmd, output), timeout)
+        except asyncio.TimeoutError:
+            print(f"{error(self._program_name)}: Timed out after {timeout} "
+                  f"second(s) during execution of the following command in "
+                  f"container {self._container_name}: \n"
+                  f"\t{cmd}",
+                  file=sys.stderr)
+            returncode = TIMEOUT_STATUS
+            timed_out = True
+        finally:
+            if log is not None:
+                log.close()
+        if log is not None:
+            self._report_log(log, returncode)
+        if self._recorder is not None:
+            self._recorder.record_command(
+                self._container_name, cmd, start,
+                time.perf_counter() - start_counter, returncode, origin)
+        if timed_out:
+            self._layer_key = None
+            return False
+        if returncode != 0:
+            self._report_failure(cmd, returncode, fatal_on_failure)
+            self._layer_key = None
+            return False
+        if self._layer_key is not None and not is_noop(cmd):
+            await self._run_blocking(functools.partial(self._add_layer, cmd))
+        return True
+
+    async def run_scripts(
+            self, scripts: list[tuple[str, list[str]]],
+            policy: ExecutionPolicy, start: bool = True,
+            after_line: typing.Optional[typing.Callable[
+                [str, Origin, bool], typing.Awaitable[None]]] = None
+    ) -> int:
+        """
+        Asynchronous version of `Commandocker.run_scripts`.
+
+        :param scripts: the name and the lines of each script
+        :param policy: the policy that selects the lines to run, to which the
+            outcome of each line is given
+        :param start: whether the container should be started; if not, it
+            must have been started (default: `True`)
+        :param after_line: a coroutine function called with each line run,
+            its origin and whether it succeeded, after the line is run
+            (default: `None`)
+        :return: 3 if the container cannot be started, 1 if any line failed,
+            or 0 otherwise
+        """
+        if start and not await self.start([line for _, lines in scripts
+                                           for line in lines]):
+            return 3
+        exit_status = 0
+        for line, origin in policy.select_scripts(scripts,
+                                                  self.skipped_commands):
+            succeeded = await self.execute(line, origin=origin)
+            policy.record(succeeded)
+            if not succeeded:
+                exit_status = 1
+            if after_line is not None:
+                await after_line(line, origin, succeeded)
+        return exit_status
+
+    async def capture(self, cmd: str) -> tuple[int, bytes]:
+        """
+        Run a command in a new Bash process in the Docker container, and
+        return its output instead of copying it.  The command is not recorded
+        by the timing recorder.
+
+        :param cmd: the command to be run
+        :return: the Docker process's exit status, and the command's standard
+            output and standard error
+        """
+        output = io.BytesIO()
+        returncode = await self._run_command(cmd, output)
+        return returncode, output.getvalue()
+
+    async def finish(self) -> None:
+        """
+        Asynchronous version of `Commandocker.finish`.
+        """
+        await self._run_blocking(super().finish)
+
+    async def cleanup(self) -> bool:
+        """
+        Asynchronous version of `Commandocker.cleanup`.
+
+        :return: whether or not the Docker container is successfully removed
+        """
+        with self._phase('cleanup'):
+            if self._async_session is not None:
+                await self._async_session.close()
+                self._async_session = None
+            if self._engine is not None:
+                return await self._run_blocking(
+                    self._remove_container_with_engine)
+            if self._background_cleanup:
+                return self._remove_container_in_background()
+            args = [self._docker_cmd, 'rm', '-f', self._container_name]
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            returncode = await process.wait()
+        if returncode != 0:
+            print(f"{error(self._program_name)}: Command {args} failed with "
+                  f"exit status {returncode}", file=sys.stderr)
+            return False
+        return True
+
+    @staticmethod
+    async def _run_blocking(func: typing.Callable[[], typing.Any]):
+        future = asyncio.get_running_loop().run_in_executor(None, func)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The worker thread cannot be interrupted
+            await asyncio.wait([future])
+            raise
+
+    async def _run_command(self, cmd: str,
+                           output: typing.Optional[typing.BinaryIO]) -> int:
+        pid_file = _get_pid_file()
+        args = ['/bin/bash', '-c', cmd]
+        if output is None:
+            # Let the command write to this program's standard output and
+            # standard error directly
+            process = await _create_killable_process(
+                self._docker_cmd, self._container_name, pid_file, args,
+                stdin=subprocess.DEVNULL)
+        else:
+            process = await _create_killable_process(
+                self._docker_cmd, self._container_name, pid_file, args,
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        try:
+            if output is not None:
+                while True:
+                    chunk = await process.stdout.read(_READ_SIZE)
+                    if not chunk:
+                        break
+                    output.write(chunk)
+                    output.flush()
+            return await process.wait()
+        except asyncio.CancelledError:
+            await _kill(self._docker_cmd, self._container_name, process,
+                        pid_file)
+            raise
+
+    async def _run_in_session(
+            self, cmd: str, output: typing.Optional[typing.BinaryIO]) -> int:
+        if self._async_session is None:
+            self._async_session = await _AsyncShellSession.create(
+                self._docker_cmd, self._container_name,
+                self._merges_stderr())
+        session = self._async_session
+        try:
+            returncode = await session.run(cmd, output)
+        except asyncio.CancelledError:
+            # The session's state is unknown after the command is killed, so
+            # the next command will get a new one
+            self._async_session = None
+            await session.kill()
+            raise
+        if not session.is_alive():
+            # The command ended the shell, e.g. with 'exit'
+            self._async_session = None
+        return returncode
+
+
+class _AsyncShellSession:
+    """
+    An asyncio counterpart of `ebuild_commander.docker._ShellSession`, whose
+    processes can be killed.
+    """
+
+    def __init__(self, docker_cmd: str, container_name: str, pid_file: str,
+                 process: asyncio.subprocess.Process):
+        self._docker_cmd = docker_cmd
+        self._container_name = container_name
+        self._pid_file = pid_file
+        self._process = process
+        self._protocol = _SessionProtocol()
+
+    @classmethod
+    async def create(cls, docker_cmd: str, container_name: str,
+                     merge_stderr: bool = False) -> '_AsyncShellSession':
+        pid_file = _get_pid_file()
+        process = await _create_killable_process(
+            docker_cmd, container_name, pid_file, ['/bin/bash'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else None)
+        return cls(docker_cmd, container_name, pid_file, process)
+
+    def is_alive(self) -> bool:
+        return self._process.returncode is None
+
+    async def run(self, cmd: str,
+                  output: typing.Optional[typing.BinaryIO] = None) -> int:
+        """
+        Run a command in the session, and copy its standard output to the
+        specified stream.
+
+        :param cmd: the command to be run
+        :param output: the stream to which the command's standard output is
+            copied (default: this program's standard output)
+        :return: the command's exit status, or the exit status of the Docker
+            process if the session ended during the command
+        """
+        if output is None:
+            output = sys.stdout.buffer
+        try:
+            self._process.stdin.write(self._protocol.format_command(cmd))
+            await self._process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            return await self._process.wait()
+
+        buf = b''
+        while True:
+            data, buf, returncode = self._protocol.parse(buf)
+            _write(output, data)
+            if returncode is not None:
+                return returncode
+            chunk = await self._process.stdout.read(_READ_SIZE)
+            if not chunk:
+                _write(output, buf)
+                return await self._process.wait()
+            buf += chunk
+
+    async def close(self) -> None:
+        """
+        End the session, killing its processes if it does not exit in time.
+        """
+        self._process.stdin.close()
+        try:
+            await asyncio.wait_for(self._process.wait(), _KILL_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            await self.kill()
+
+    async def kill(self) -> None:
+        """
+        Kill the session's processes, including any command it is running.
+        """
+        await _kill(self._docker_cmd, self._container_name, self._process,
+                    self._pid_file)
+
+
+def _get_pid_file() -> str:
+    return f'/tmp/.ebuild-commander-{secrets.token_hex(8)}.pid'
+
+
+async def _create_killable_process(
+        docker_cmd: str, container_name: str, pid_file: str, args: list[str],
+        **kwargs) -> asyncio.subprocess.Process:
+    """
+    Run a command in a container with 'docker exec' such that every process
+    of the command can be killed by `_kill`.  If the task is cancelled, any
+    process that is created regardless is killed.
+
+    :param docker_cmd: the executable providing Docker functionalities
+    :param container_name: the container's name
+    :param pid_file: the path in the container to the file that will hold the
+        ID of the command's session
+    :param args: the command's arguments
+    :param kwargs: keyword arguments for `asyncio.create_subprocess_exec`
+    :return: the 'docker exec' process
+    """
+    spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+        docker_cmd, 'exec', '--interactive', container_name,
+        'setsid', '--wait', '/bin/sh', '-c', _KILLABLE_WRAPPER, pid_file,
+        *args, **kwargs))
+    try:
+        return await asyncio.shield(spawn)
+    except asyncio.CancelledError:
+        await asyncio.wait([spawn])
+        if not spawn.cancelled() and spawn.exception() is None:
+            await _kill(docker_cmd, container_name, spawn.result(), pid_file)
+        raise
+
+
+async def _kill(docker_cmd: str, container_name: str,
+               process: asyncio.subprocess.Process, pid_file: str) -> None:
+    """
+    Kill a command started by `_create_killable_process`, along with the
+    'docker exec' process running it.  Killing the 'docker exec'
+    process alone does not stop the command in the container.
+    """
+    for signal_name in ('TERM', 'KILL'):
+        killer = await asyncio.create_subprocess_exec(
+            docker_cmd, 'exec', container_name,
+            '/bin/sh', '-c', _KILL_SCRIPT, signal_name, pid_file,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        await killer.wait()
+        try:
+            await asyncio.wait_for(process.wait(), _KILL_GRACE_PERIOD)
+            return
+        except asyncio.TimeoutError:
+            pass
+    if process.returncode is None:
+        process.kill()
+        await process.wait()
+
+
+def _write(output: typing.BinaryIO, data: bytes) -> None:
+    if data:
+        output.write(data)
+        output.flush()
@@ -0,0 +1,229 @@
+#  ebuild-commander Host Cache Directory Management
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import os
+import pathlib
+import shutil
+import typing
+
+# Name of the lock file in a cache directory; like any other hidden entry, it
+# is never considered for eviction
+_LOCK_FILE_NAME = '.ebuild-commander.lock'
+
+
+class CacheUsage(typing.NamedTuple):
+    # Number of entries that existed before and were accessed while the cache
+    # directory was in use
+    hits: int
+    # Number of entries that were added while the cache directory was in use
+    misses: int
+    # Total size of the added entries in bytes
+    miss_size: int
+
+
+class CacheDir:
+    """
+    A directory on the host which is mounted into containers and shared by
+    concurrent instances of this program.
+
+    While a cache directory is in use, a shared lock is held on it.  Eviction
+    takes an exclusive lock, so it only happens when no other instance is
+    using the cache directory.  Each non-hidden entry directly under the cache
+    directory is an eviction unit; entries are evicted in order of least
+    recent use until the total size is within the limit.
+
+    The last use of a directory entry is when it was last passed to
+    `get_partition`.  The last use of a file entry is determined from its
+    access time, so it may be earlier than the actual last use if the file
+    system is mounted with the 'relatime' or 'noatime' option.
+    """
+
+    def __init__(self, path: pathlib.Path,
+                 max_size: typing.Optional[int] = None):
+        self._path = path
+        self._max_size = max_size
+        self._lock_file = None
+        self._acquire_time = None
+        self._initial_entries = set()
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def acquire(self) -> None:
+        """
+        Create the cache directory if it does not exist, and take a shared
+        lock on it.  This function blocks while eviction is in progress.
+
+        :raise OSError: if the cache directory cannot be created or locked
+        """
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self._path / _LOCK_FILE_NAME, 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+        # Take the time from the file system, whose clock may be coarser than
+        # the system time, so it can be compared with time stamps of entries
+        os.utime(self._lock_file.fileno())
+        self._acquire_time = os.fstat(self._lock_file.fileno()).st_mtime
+        self._initial_entries = {entry.name for entry in self._list_entries()}
+
+    def release(self, keep: typing.Iterable[str] = ()) -> list[str]:
+        """
+        Release the lock on the cache directory, and evict entries if the
+        cache directory is over its size limit and no other instance of this
+        program is using it.
+
+        :param keep: names of entries that must not be evicted
+        :return: names of the evicted entries
+        """
+        if self._lock_file is None:
+            return []
+        evicted = []
+        try:
+            if self._max_size is not None:
+                try:
+                    fcntl.flock(self._lock_file,
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    evicted = self._evict(set(keep))
+                except BlockingIOError:
+                    # Another instance is using the cache; it will evict
+                    # entries when it finishes
+                    pass
+        finally:
+            self._lock_file.close()
+            self._lock_file = None
+        return evicted
+
+    def get_partition(self, key: str) -> pathlib.Path:
+        """
+        Get a subdirectory of the cache directory for a key, creating it if
+        needed, and mark it as recently used.
+
+        :param key: the key identifying the partition
+        :return: the path to the partition
+        """
+        partition = self._path / key
+        partition.mkdir(exist_ok=True)
+        os.utime(partition)
+        return partition
+
+    def get_usage(self) -> CacheUsage:
+        """
+        Get statistics about the use of the cache directory since it was
+        acquired, including uses by any other concurrent instance.  Like
+        determination of the last use, counting of hits relies on access times
+        of files.
+
+        :return: the statistics
+        """
+        hits = misses = miss_size = 0
+        for entry in self._list_entries():
+            if entry.name not in self._initial_entries:
+                misses += 1
+                miss_size += _get_size(entry)
+            elif _get_last_use(entry) >= self._acquire_time:
+                hits += 1
+        return CacheUsage(hits, misses, miss_size)
+
+    def get_size(self) -> int:
+        """
+        :return: the total size of the non-hidden entries in bytes
+        """
+        return sum(_get_size(entry) for entry in self._list_entries())
+
+    def _list_entries(self) -> list[pathlib.Path]:
+        return [entry for entry in self._path.iterdir()
+                if not entry.name.startswith('.')]
+
+    def _evict(self, keep: set) -> list[str]:
+        entries = []
+        total_size = 0
+        for entry in self._list_entries():
+            size = _get_size(entry)
+            total_size += size
+            entries.append((_get_last_use(entry), entry, size))
+        entries.sort()
+        evicted = []
+        for _, entry, size in entries:
+            if total_size <= self._max_size:
+                break
+            if entry.name in keep:
+                continue
+            _remove(entry)
+            total_size -= size
+            evicted.append(entry.name)
+        return evicted
+
+
+def get_user_cache_dir() -> pathlib.Path:
+    """
+    :return: the directory for this program's caches of the current user,
+        which follows the XDG Base Directory Specification
+    """
+    cache_home = os.getenv('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return pathlib.Path(cache_home, 'ebuild-commander')
+
+
+def hash_key(*parts: typing.Union[str, bytes]) -> str:
+    """
+    Compute a short key from the given parts that is suitable as a file name.
+    Different sequences of parts produce different keys.
+
+    :param parts: the parts from which the key is computed
+    :return: the key
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()[:32]
+
+
+def _get_last_use(path: pathlib.Path) -> float:
+    st = path.lstat()
+    if path.is_dir() and not path.is_symlink():
+        # Access times of directories are changed by scans of the cache
+        # directory, so they do not reflect uses
+        return st.st_ctime
+    # Modification times of downloaded files may come from the server, so the
+    # change time is used to find out when a file was added
+    return max(st.st_atime, st.st_ctime)
+
+
+def _get_size(path: pathlib.Path) -> int:
+    if not path.is_dir() or path.is_symlink():
+        return path.lstat().st_size
+    size = 0
+    for top, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(top, name)).st_size
+    return size
+
+
+def _remove(path: pathlib.Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
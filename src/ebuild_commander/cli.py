@@ -21,14 +21,59 @@
 import argparse
 import os
 import pathlib
+import re
 
 import ebuild_commander
 
+from ebuild_commander.endpoints import Endpoint
+from ebuild_commander.layer import DEFAULT_MAX_LAYERS
+from ebuild_commander.log import DEFAULT_TAIL_LINES
+from ebuild_commander.pull import PULL_ALWAYS, PULL_IF_MISSING, \
+    PULL_IF_OLDER_THAN, PullPolicy
+
+DEFAULT_PROFILE = 'default/linux/amd64/17.1'
+
+DEFAULT_DOCKER_IMAGE = 'gentoo/stage3'
+
+# Number of seconds in each unit of a duration
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+class _NonExitingParser(argparse.ArgumentParser):
+    """
+    An argument parser that raises `argparse.ArgumentError` instead of
+    printing messages and exiting, for arguments that do not come from this
+    program's own command line.
+    """
+
+    def _print_message(self, message, file=None) -> None:
+        pass
+
+    def exit(self, status=0, message=None):
+        # Only reached for actions like '--help' and '--version'
+        raise argparse.ArgumentError(
+            None, message or "options that print information and exit "
+                             "cannot be used here")
+
+    def error(self, message):
+        raise argparse.ArgumentError(None, message)
+
 
 def parse_args(args, exit_on_error: bool = True) -> argparse.Namespace:
+    """
+    :param args: the command-line arguments
+    :param exit_on_error: whether to print messages and exit on invalid
+        arguments and on options like '--help', as for this program's own
+        command line, instead of raising `argparse.ArgumentError`
+    :return: the parsed arguments
+    :raise argparse.ArgumentError: if `exit_on_error` is `False` and the
+        arguments are invalid or request printing information
+    """
     env_var_docker = ebuild_commander.__env_var_docker__
     default_docker = ebuild_commander.__env_default_docker__
-    parser = argparse.ArgumentParser(
+    parser_type = argparse.ArgumentParser if exit_on_error \
+        else _NonExitingParser
+    parser = parser_type(
         usage="%(prog)s [OPTION]... [SCRIPT]...",
         description="""
 Run the SCRIPTs in a Docker container derived from a Gentoo stage3 image.
@@ -72,9 +117,20 @@ exit status:
     parser.add_argument(
         '--profile',
         metavar='TARGET',
-        default='default/linux/amd64/17.1',
-        help="run 'eselect profile set TARGET' when container starts\n"
-             "(default: %(default)s)"
+        action='append',
+        help="run 'eselect profile set TARGET' when container starts;\n"
+             "can be set repeatedly to run the SCRIPTs with each\n"
+             f"profile (default: {DEFAULT_PROFILE})"
+    )
+    parser.add_argument(
+        '--config-set',
+        metavar='DIRS',
+        type=path_list,
+        action='append',
+        help="like setting '--portage-config' once for each directory\n"
+             f"in the list DIRS separated by '{os.pathsep}'; can be set "
+             "repeatedly\nto run the SCRIPTs with each set of directories,\n"
+             "overriding '--portage-config'"
     )
     parser.add_argument(
         '--gentoo-repo',
@@ -96,9 +152,19 @@ exit status:
         '--threads',
         metavar='JOBS',
         type=int,
-        default=os.cpu_count(),
-        help="specify '-j JOBS' in MAKEOPTS\n"
-             "(default: number of CPU threads)"
+        help="specify '-j JOBS' in MAKEOPTS; when multiple containers\n"
+             "run at the same time, JOBS is divided among them\n"
+             "(default: number of CPU threads; required with\n"
+             "--endpoint)"
+    )
+    parser.add_argument(
+        '--auto-tune',
+        action='store_true',
+        help="derive MAKEOPTS' -j and -l, emerge's --jobs and\n"
+             "--load-average, and the containers' CPU and memory\n"
+             "limits from the host's CPUs, memory, cgroup limits and\n"
+             "load and the containers of other running instances,\n"
+             "instead of using --threads"
     )
     parser.add_argument(
         '--emerge-opts',
@@ -108,23 +174,360 @@ exit status:
              "(default: %(default)s)"
     )
 
+    parser.add_argument(
+        '--binpkg-cache',
+        metavar='DIR',
+        type=pathlib.Path,
+        help="build binary packages into and reuse them from DIR,\n"
+             "which is partitioned by the profile, the Docker image\n"
+             "and other settings affecting the packages' contents;\n"
+             "DIR can be shared by concurrent instances"
+    )
+    parser.add_argument(
+        '--binpkg-cache-size',
+        metavar='SIZE',
+        type=size,
+        help="evict least recently used partitions of the binary\n"
+             "package cache when its size exceeds SIZE, which is a\n"
+             "number optionally followed by K, M, G or T\n"
+             "(default: no limit)"
+    )
+
+    parser.add_argument(
+        '--distfiles-cache',
+        metavar='DIR',
+        type=pathlib.Path,
+        help="use DIR as the container's DISTDIR so source files are\n"
+             "downloaded only once across runs; DIR can be shared by\n"
+             "concurrent instances"
+    )
+    parser.add_argument(
+        '--distfiles-cache-size',
+        metavar='SIZE',
+        type=size,
+        help="evict least recently used files from the distfiles\n"
+             "cache when its size exceeds SIZE\n"
+             "(default: no limit)"
+    )
+
+    parser.add_argument(
+        '--ccache',
+        metavar='DIR',
+        type=pathlib.Path,
+        help="enable FEATURES=\"ccache\" with a compiler cache in DIR,\n"
+             "which is segmented by the Docker image and compiler\n"
+             "settings; dev-util/ccache must be installed in the\n"
+             "container by the SCRIPTs for the cache to be used"
+    )
+    parser.add_argument(
+        '--ccache-size',
+        metavar='SIZE',
+        type=size,
+        help="set ccache's maximum cache size for each segment to SIZE\n"
+             "(default: ccache's default)"
+    )
+
+    parser.add_argument(
+        '--metadata-cache',
+        metavar='DIR',
+        type=pathlib.Path,
+        help="keep the metadata cache of each custom repository in\n"
+             "DIR, updating it before the SCRIPTs run for changed\n"
+             "ebuilds and eclasses only; DIR can be shared by\n"
+             "concurrent instances"
+    )
+    parser.add_argument(
+        '--metadata-cache-size',
+        metavar='SIZE',
+        type=size,
+        help="evict least recently used repositories from the\n"
+             "metadata cache when its size exceeds SIZE\n"
+             "(default: no limit)"
+    )
+
+    parser.add_argument(
+        '--tmpfs',
+        action='store_true',
+        help="mount a tmpfs on /var/tmp/portage for building packages\n"
+             "in memory, sized from the memory available on the host\n"
+             "and the number of threads"
+    )
+    parser.add_argument(
+        '--tmpfs-size',
+        metavar='SIZE',
+        type=size,
+        help="set the size of the tmpfs enabled by --tmpfs to SIZE\n"
+             "instead of sizing it automatically"
+    )
+    parser.add_argument(
+        '--tmpfs-exclude',
+        metavar='ATOM',
+        action='append',
+        help="build packages matching ATOM on disk when --tmpfs is\n"
+             "set, e.g. for packages whose build trees would not fit\n"
+             "in the tmpfs; can be set repeatedly"
+    )
+
+    parser.add_argument(
+        '--snapshot',
+        action='store_true',
+        help="save the configured container as a snapshot image, and\n"
+             "create the container from a snapshot saved earlier with\n"
+             "the same Docker image and settings to skip configuration"
+    )
+    parser.add_argument(
+        '--list-snapshots',
+        action='store_true',
+        help="list snapshot images and whether each is stale, then exit"
+    )
+    parser.add_argument(
+        '--prune-snapshots',
+        action='store_true',
+        help="remove stale snapshot images, whose Docker image has been\n"
+             "updated or removed since they were saved, then exit"
+    )
+
+    parser.add_argument(
+        '--gc-containers',
+        action='store_true',
+        help="remove containers left behind by earlier runs, then exit;\n"
+             "containers of processes that are still running are kept, and\n"
+             "so are containers created in the last week that may have been\n"
+             "kept on purpose by --skip-cleanup, unless --gc-all is given"
+    )
+    parser.add_argument(
+        '--gc-max-age',
+        metavar='DURATION',
+        type=duration,
+        help="with --gc-containers, only remove containers created more\n"
+             "than DURATION ago, which is a number of seconds optionally\n"
+             "followed by m, h, d or w for minutes, hours, days or weeks,\n"
+             "unless --gc-keep is exceeded"
+    )
+    parser.add_argument(
+        '--gc-keep',
+        metavar='N',
+        type=int,
+        help="with --gc-containers, keep the N most recently created\n"
+             "containers, unless --gc-max-age is exceeded"
+    )
+    parser.add_argument(
+        '--gc-all',
+        action='store_true',
+        help="with --gc-containers, also remove containers created in the\n"
+             "last week that may have been kept on purpose, or whose\n"
+             "processes cannot be checked, e.g. because they ran on\n"
+             "another host"
+    )
+
+    parser.add_argument(
+        '--layer-cache',
+        action='store_true',
+        help="save the container as a layer image after each\n"
+             "successful command, and create the container from the\n"
+             "layer for the longest sequence of leading commands that\n"
+             "has been run before, skipping those commands; cannot be\n"
+             "used with --persistent-shell"
+    )
+    parser.add_argument(
+        '--layer-cache-max-layers',
+        metavar='N',
+        type=int,
+        default=DEFAULT_MAX_LAYERS,
+        help="remove least recently used layers when there are more\n"
+             "than N layers (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--layer-cache-size',
+        metavar='SIZE',
+        type=size,
+        help="remove least recently used layers when the layers take\n"
+             "more than SIZE of disk space (default: no limit)"
+    )
+
+    parser.add_argument(
+        '--persistent-shell',
+        action='store_true',
+        help="run all commands in a single long-lived Bash process in\n"
+             "the container instead of starting a new one for each\n"
+             "command, so the environment and the working directory\n"
+             "persist between commands"
+    )
+
     parser.add_argument(
         '--docker-image',
         metavar='IMAGE',
-        default='gentoo/stage3',
-        help="create the container from the specified Docker IMAGE\n"
-             "(default: %(default)s)"
+        action='append',
+        help="create the container from the specified Docker IMAGE;\n"
+             "can be set repeatedly to run the SCRIPTs with each\n"
+             f"image (default: {DEFAULT_DOCKER_IMAGE})"
     )
     parser.add_argument(
         '--pull',
         action='store_true',
-        help="download the latest version of the Docker image"
+        help="download the latest version of the Docker image;\n"
+             "same as '--pull-policy always'"
+    )
+    parser.add_argument(
+        '--pull-policy',
+        metavar='POLICY',
+        type=pull_policy,
+        help="decide whether to download the latest version of the\n"
+             "Docker image with POLICY, which is one of 'always',\n"
+             "'if-missing' (only if the image is not available\n"
+             "locally) and 'if-older-than=DURATION' (only if the\n"
+             "image has not been downloaded by this program for\n"
+             "DURATION, an integer followed by 's', 'm', 'h', 'd' or\n"
+             "'w'); overrides '--pull'"
     )
     parser.add_argument(
         '--storage-opt',
         metavar='OPTS',
         help="set '--storage-opt OPTS' in Docker's arguments"
     )
+    parser.add_argument(
+        '--docker-socket',
+        metavar='SOCKET',
+        type=pathlib.Path,
+        help="create, run commands in and remove containers and pull\n"
+             "images through the Docker Engine API on the Unix socket\n"
+             "SOCKET instead of the Docker executable, like\n"
+             "/var/run/docker.sock or Podman's /run/podman/podman.sock;\n"
+             "the executable, which is still used for other operations,\n"
+             "must use the same daemon"
+    )
+    parser.add_argument(
+        '--endpoint',
+        metavar='HOST[=WEIGHT]',
+        action='append',
+        type=endpoint,
+        help="run containers on the Docker daemon HOST, which is either\n"
+             "the name of a Docker context or a URL like\n"
+             "ssh://user@host or tcp://host:2376, running at most\n"
+             "WEIGHT containers on it at the same time (default: 1);\n"
+             "can be specified multiple times to place each cell of a\n"
+             "build matrix on the least loaded endpoint, in which case\n"
+             "--threads is the number of threads of each endpoint"
+    )
+    parser.add_argument(
+        '--endpoint-retries',
+        metavar='N',
+        type=int,
+        default=2,
+        help="when a container cannot be started on an endpoint, try\n"
+             "up to N other endpoints (default: %(default)s)"
+    )
+
+    parser.add_argument(
+        '--matrix-jobs',
+        metavar='N',
+        type=int,
+        help="when the SCRIPTs are run with multiple profiles, images\n"
+             "or configuration sets, run at most N containers at the\n"
+             "same time (default: all combinations at once)"
+    )
+
+    parser.add_argument(
+        '--shard-packages',
+        metavar='FILE',
+        help="merge the packages whose atoms are listed in FILE with\n"
+             "several containers sharing the binary package cache,\n"
+             "after running the SCRIPTs given on the command line, if\n"
+             "any, in every container; requires --binpkg-cache"
+    )
+    parser.add_argument(
+        '--shards',
+        metavar='N',
+        type=int,
+        default=2,
+        help="divide the packages for --shard-packages among N\n"
+             "containers, which share the threads (default: %(default)s)"
+    )
+
+    parser.add_argument(
+        '--serve',
+        metavar='SOCKET',
+        type=pathlib.Path,
+        help="run as a daemon that accepts jobs from '--connect SOCKET'\n"
+             "clients on the Unix socket SOCKET, keeping started\n"
+             "containers ready for each distinct set of options the\n"
+             "clients use; all other options come from the clients"
+    )
+    parser.add_argument(
+        '--pool-size',
+        metavar='N',
+        type=int,
+        default=1,
+        help="keep N started containers ready for each distinct set of\n"
+             "options in daemon mode (default: 1)"
+    )
+    parser.add_argument(
+        '--connect',
+        metavar='SOCKET',
+        type=pathlib.Path,
+        help="run the SCRIPTs with a container from the daemon\n"
+             "listening on the Unix socket SOCKET instead of creating\n"
+             "one; the daemon must be able to access the files the\n"
+             "options refer to"
+    )
+
+    parser.add_argument(
+        '--timing-report',
+        metavar='FILE',
+        help="write a JSON report of the time spent in each phase and\n"
+             "each command to FILE"
+    )
+    parser.add_argument(
+        '--timing-summary',
+        metavar='N',
+        type=int,
+        help="print the time spent in each phase and the N slowest\n"
+             "commands before exiting"
+    )
+
+    parser.add_argument(
+        '--show-history',
+        metavar='PACKAGE',
+        nargs='?',
+        const='',
+        help="print how long each package took to build in earlier runs,\n"
+             "or only PACKAGE (like 'sys-libs/zlib') if it is given,\n"
+             "then exit"
+    )
+    parser.add_argument(
+        '--history',
+        action='store_true',
+        help="record build and run durations from emerge's log in each\n"
+             "container, and use them to estimate run durations and to\n"
+             "balance build matrices and shards"
+    )
+
+    parser.add_argument(
+        '--log-dir',
+        metavar='DIR',
+        type=pathlib.Path,
+        help="save the output of each command to a compressed log file\n"
+             "under DIR instead of printing it, and print only the last\n"
+             "lines of the output of commands that fail once they finish;\n"
+             "the output of running and successful commands is not printed"
+    )
+    parser.add_argument(
+        '--log-tail',
+        metavar='N',
+        type=int,
+        default=DEFAULT_TAIL_LINES,
+        help="number of lines of a failed command's output to print with\n"
+             "--log-dir (default: %(default)s)"
+    )
+
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help="skip all remaining commands after a command fails; use\n"
+             "'#@ stop-on-error' in a script to only skip the rest of\n"
+             "the script, or '#@ id=NAME' and '#@ after=NAME' on lines\n"
+             "to only skip the commands that depend on a failed one"
+    )
 
     parser.add_argument(
         '--skip-cleanup',
@@ -133,6 +536,13 @@ exit status:
         help="skip container clean-up before exiting\n"
              "(default: %(default)s)"
     )
+    parser.add_argument(
+        '--background-cleanup',
+        action='store_true',
+        help="exit without waiting for containers to be removed; the\n"
+             "removal goes on in the background, and its failures are\n"
+             "not reported (not supported with --docker-socket)"
+    )
 
     parser.add_argument(
         '--help',
@@ -150,6 +560,96 @@ exit status:
     return opts
 
 
+def path_list(value: str) -> list[pathlib.Path]:
+    """
+    Convert a list of paths separated by `os.pathsep` to a list of
+    `pathlib.Path` objects.  This function can be used as the type of an
+    argument for `argparse`.
+
+    :param value: the list of paths
+    :return: the list of `pathlib.Path` objects
+    :raise ValueError: if the list contains an empty path
+    """
+    paths = value.split(os.pathsep)
+    if '' in paths:
+        raise ValueError(f"empty path in '{value}'")
+    return [pathlib.Path(path) for path in paths]
+
+
+def size(value: str) -> int:
+    """
+    Convert a size specification, which is a non-negative integer optionally
+    followed by a binary unit prefix (K, M, G or T) and an optional 'B' or
+    'iB', to a number of bytes.  This function can be used as the type of an
+    argument for `argparse`.
+
+    :param value: the size specification
+    :return: the number of bytes
+    :raise ValueError: if the size specification is invalid
+    """
+    match = re.fullmatch(r'(\d+)\s*([KMGT]?)(?:i?B)?', value.strip(),
+                         re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"invalid size: '{value}'")
+    exponent = ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(match.group(1)) * 1024 ** exponent
+
+
+def duration(value: str) -> int:
+    """
+    Convert a duration specification, which is a non-negative integer
+    optionally followed by a unit (s, m, h, d or w for seconds, minutes, hours,
+    days or weeks respectively; default: s), to a number of seconds.  This
+    function can be used as the type of an argument for `argparse`.
+
+    :param value: the duration specification
+    :return: the number of seconds
+    :raise ValueError: if the duration specification is invalid
+    """
+    match = re.fullmatch(r'(\d+)\s*([smhdw]?)', value.strip(), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"invalid duration: '{value}'")
+    unit = match.group(2).lower() or 's'
+    return int(match.group(1)) * _DURATION_UNITS[unit]
+
+
+def pull_policy(value: str) -> PullPolicy:
+    """
+    Convert a pull policy specification, which is either 'always',
+    'if-missing' or 'if-older-than=DURATION', to a `PullPolicy`.  This
+    function can be used as the type of an argument for `argparse`.
+
+    :param value: the pull policy specification
+    :return: the `PullPolicy`
+    :raise ValueError: if the pull policy specification is invalid
+    """
+    kind, sep, arg = value.partition('=')
+    if kind in (PULL_ALWAYS, PULL_IF_MISSING) and not sep:
+        return PullPolicy(kind)
+    if kind == PULL_IF_OLDER_THAN and sep:
+        return PullPolicy(kind, duration(arg))
+    raise ValueError(f"invalid pull policy: '{value}'")
+
+
+def endpoint(value: str) -> Endpoint:
+    """
+    Convert an endpoint specification, which is the name of a Docker context
+    or the URL of a Docker daemon, optionally followed by '=' and a positive
+    weight, to an `Endpoint`.  This function can be used as the type of an
+    argument for `argparse`.
+
+    :param value: the endpoint specification
+    :return: the `Endpoint`
+    :raise ValueError: if the endpoint specification is invalid
+    """
+    host, sep, weight = value.rpartition('=')
+    if not sep or not re.fullmatch(r'\d+', weight):
+        host, weight = value, '1'
+    if not host or int(weight) < 1:
+        raise ValueError(f"invalid endpoint: '{value}'")
+    return Endpoint(host, int(weight))
+
+
 def get_version_message() -> str:
     return f"""
 ebuild-commander {ebuild_commander.__version__}
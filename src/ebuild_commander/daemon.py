@@ -0,0 +1,493 @@
+#  ebuild-commander Daemon Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import pathlib
+import signal
+import socket
+import stat
+import sys
+import time
+import typing
+
+import ebuild_commander.cli
+
+from ebuild_commander.async_docker import AsyncCommandocker
+from ebuild_commander.out_fmt import info, warn, error
+from ebuild_commander.policy import PASSED, ExecutionPolicy
+from ebuild_commander.timing import Origin
+
+# Version of the protocol between the daemon and its clients; please increase
+# it when making incompatible changes to the protocol
+PROTOCOL_VERSION = 1
+
+# Maximum size of a job request, which contains the lines of the scripts
+_MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+
+class _JobOutput:
+    """
+    The output stream of a container in a pool, which forwards the output to
+    the client of the job the container is running, if any.
+    """
+
+    def __init__(self):
+        self.writer: typing.Optional[asyncio.StreamWriter] = None
+
+    def write(self, data: bytes) -> int:
+        if self.writer is not None and data:
+            _send(self.writer, {
+                'type': 'output',
+                'data': base64.b64encode(data).decode(),
+            })
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class _Pool:
+    """
+    The started containers that are ready to run jobs with the same container
+    settings.
+    """
+
+    def __init__(self, opts: argparse.Namespace):
+        # The options of the job that caused the pool to be created, for
+        # creating more containers; options that only affect a job, and not
+        # its container, must be read from the job's own options instead
+        self.opts = opts
+        self.idle: list[tuple[AsyncCommandocker, _JobOutput]] = []
+        self.num_starting = 0
+
+
+class Daemon:
+    """
+    A server that runs scripts submitted by clients over a Unix socket.
+
+    For each distinct combination of container settings in the jobs it has
+    received, the daemon keeps a pool of containers that have already been
+    started and configured, so a job with the same settings can start
+    immediately.  A container runs only one job; after the job, the container
+    is removed in the background, and a new one is started to replace it.
+    """
+
+    def __init__(
+            self,
+            program_name: str,
+            socket_path: pathlib.Path,
+            pool_size: int,
+            create_container: typing.Callable[
+                [argparse.Namespace, str, typing.BinaryIO], AsyncCommandocker],
+            get_fingerprint: typing.Callable[[argparse.Namespace], str],
+            should_cleanup: typing.Callable[[argparse.Namespace, int], bool],
+            interrupt_status: int
+    ):
+        """
+        :param program_name: the program name for messages
+        :param socket_path: the path to the Unix socket to listen on
+        :param pool_size: the number of idle containers to keep for each
+            combination of container settings
+        :param create_container: a function that creates a container, given a
+            job's options, the container's name and the stream for its output
+        :param get_fingerprint: a function that identifies the container
+            settings in a job's options; jobs whose options have the same
+            fingerprint can use each other's containers
+        :param should_cleanup: a function that decides whether a container
+            should be removed, given the job's options and exit status
+        :param interrupt_status: the exit status of a job that was stopped
+            because its client disconnected or the daemon is exiting
+        """
+        self._program_name = program_name
+        self._socket_path = socket_path
+        self._pool_size = pool_size
+        self._create_container = create_container
+        self._get_fingerprint = get_fingerprint
+        self._should_cleanup = should_cleanup
+        self._interrupt_status = interrupt_status
+        self._pools: dict[str, _Pool] = {}
+        self._num_containers = 0
+        self._num_jobs = 0
+        # Tasks handling clients
+        self._clients: set[asyncio.Task] = set()
+        # Tasks starting containers for the pools
+        self._warming: set[asyncio.Task] = set()
+        # Tasks removing used containers
+        self._retiring: set[asyncio.Task] = set()
+
+    def run(self) -> int:
+        """
+        Serve clients until SIGINT or SIGTERM is received, then remove all
+        containers that are not running a job and stop any running jobs.
+
+        :return: the exit status for the program
+        """
+        return asyncio.run(self._serve())
+
+    async def _serve(self) -> int:
+        if not self._remove_stale_socket():
+            return 3
+        # Anyone who can connect can run commands in containers with access
+        # to the host's files, so only the owner may use the socket
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(
+                self._handle_client, path=str(self._socket_path),
+                limit=_MAX_REQUEST_SIZE)
+        except OSError as err:
+            print(f"{error(self._program_name)}: {self._socket_path}: "
+                  f"{err.strerror}", file=sys.stderr)
+            return 3
+        finally:
+            os.umask(old_umask)
+
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        print(f"{info(self._program_name)}: Listening on {self._socket_path}",
+              file=sys.stderr)
+        try:
+            await stop.wait()
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+
+        print(f"{info(self._program_name)}: Exiting; removing containers...",
+              file=sys.stderr)
+        server.close()
+        for task in self._clients:
+            task.cancel()
+        await asyncio.gather(*self._clients, return_exceptions=True)
+        for task in self._warming:
+            task.cancel()
+        await asyncio.gather(*self._warming, return_exceptions=True)
+        await asyncio.gather(*self._retiring, return_exceptions=True)
+        for pool in self._pools.values():
+            for container, _ in pool.idle:
+                # No job has used the container, so the clean-up options of
+                # the job that created the pool do not apply
+                await container.finish()
+                await container.cleanup()
+            pool.idle.clear()
+        try:
+            os.unlink(self._socket_path)
+        except OSError:
+            pass
+        return 0
+
+    def _remove_stale_socket(self) -> bool:
+        try:
+            if not stat.S_ISSOCK(os.stat(self._socket_path).st_mode):
+                print(f"{error(self._program_name)}: {self._socket_path}: "
+                      f"File exists", file=sys.stderr)
+                return False
+        except FileNotFoundError:
+            return True
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(self._socket_path))
+            except ConnectionRefusedError:
+                # Left behind by a daemon that did not exit cleanly
+                os.unlink(self._socket_path)
+                return True
+        print(f"{error(self._program_name)}: Another daemon is listening on "
+              f"{self._socket_path}", file=sys.stderr)
+        return False
+
+    async def _handle_client(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._clients.add(task)
+        try:
+            await self._serve_client(reader, writer)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self._clients.discard(task)
+            writer.close()
+
+    async def _serve_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            if request.get('version') != PROTOCOL_VERSION:
+                raise ValueError(f"unsupported protocol version "
+                                 f"{request.get('version')}")
+            opts = _parse_job_options(request['args'],
+                                      pathlib.Path(request['cwd']))
+            scripts = [(str(script), [str(line) for line in lines])
+                       for script, lines in request['scripts']]
+            fingerprint = self._get_fingerprint(opts)
+        except (ValueError, KeyError, TypeError) as err:
+            _send(writer, {'type': 'error', 'message': f"Bad request: {err}"})
+            await writer.drain()
+            return
+
+        self._num_jobs += 1
+        job_id = self._num_jobs
+        pool = self._pools.get(fingerprint)
+        if pool is None:
+            pool = _Pool(opts)
+            self._pools[fingerprint] = pool
+        container, output = await self._take(pool, opts, job_id)
+        self._refill(pool)
+        if container is None:
+            _send(writer, {'type': 'error',
+                           'message': "Cannot start a container"})
+            await writer.drain()
+            return
+        # The container may have been created for another job in the pool
+        container.background_cleanup = opts.background_cleanup
+
+        policy = ExecutionPolicy(f'{self._program_name}[{job_id}]',
+                                 opts.fail_fast)
+        job = asyncio.ensure_future(
+            self._run_job(container, output, scripts, policy, writer))
+        # The client closes the connection to stop the job
+        disconnect = asyncio.ensure_future(reader.read())
+        try:
+            await asyncio.wait([job, disconnect],
+                               return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # The daemon is exiting; let the client know the job is stopped
+            pass
+        disconnect.cancel()
+        job.cancel()
+        await asyncio.wait([job])
+        if job.cancelled():
+            exit_status = self._interrupt_status
+        else:
+            exit_status = job.result()
+        output.writer = None
+        removed = self._should_cleanup(opts, exit_status)
+        self._start_task(self._retiring,
+                         self._retire(container, opts, exit_status))
+        print(f"{info(self._program_name)}: Job {job_id} finished with exit "
+              f"status {exit_status} in container {container.name}",
+              file=sys.stderr)
+        if any(result.outcome != PASSED for result in policy.results):
+            _send(writer, {'type': 'report',
+                           'lines': policy.format_report()})
+        _send(writer, {'type': 'exit', 'status': exit_status,
+                       'container': container.name, 'removed': removed})
+        await writer.drain()
+
+    async def _run_job(self, container: AsyncCommandocker,
+                       output: _JobOutput,
+                       scripts: list[tuple[str, list[str]]],
+                       policy: ExecutionPolicy,
+                       writer: asyncio.StreamWriter) -> int:
+        output.writer = writer
+
+        async def report(line: str, origin: Origin, succeeded: bool) -> None:
+            if not succeeded:
+                _send(writer, {'type': 'failed', 'script': origin.script,
+                               'line': origin.line,
+                               'command': line.rstrip('\n')})
+            await writer.drain()
+
+        try:
+            exit_status = await container.run_scripts(
+                scripts, policy, start=False, after_line=report)
+        except asyncio.CancelledError:
+            exit_status = self._interrupt_status
+        except ConnectionError:
+            # The client is gone; stop the job as if it was interrupted
+            exit_status = self._interrupt_status
+        finally:
+            output.writer = None
+        return exit_status
+
+    async def _take(self, pool: _Pool, opts: argparse.Namespace,
+                    job_id: int) \
+            -> tuple[typing.Optional[AsyncCommandocker], _JobOutput]:
+        if pool.idle:
+            container, output = pool.idle.pop(0)
+            print(f"{info(self._program_name)}: Job {job_id}: using "
+                  f"container {container.name} from the pool",
+                  file=sys.stderr)
+            return container, output
+        container, output = self._new_container(opts)
+        print(f"{info(self._program_name)}: Job {job_id}: no container in "
+              f"the pool; creating container {container.name}...",
+              file=sys.stderr)
+        try:
+            started = await container.start()
+        except asyncio.CancelledError:
+            await self._retire(container, opts, self._interrupt_status)
+            raise
+        if not started:
+            await self._retire(container, opts, 3)
+            return None, output
+        return container, output
+
+    def _refill(self, pool: _Pool) -> None:
+        while len(pool.idle) + pool.num_starting < self._pool_size:
+            pool.num_starting += 1
+            self._start_task(self._warming, self._warm(pool))
+
+    async def _warm(self, pool: _Pool) -> None:
+        container, output = self._new_container(pool.opts)
+        try:
+            started = await container.start()
+        except asyncio.CancelledError:
+            started = False
+        finally:
+            pool.num_starting -= 1
+        if started:
+            pool.idle.append((container, output))
+        else:
+            print(f"{warn(self._program_name)}: Cannot start container "
+                  f"{container.name} for the pool", file=sys.stderr)
+            await self._retire(container, pool.opts, 3)
+
+    async def _retire(self, container: AsyncCommandocker,
+                      opts: argparse.Namespace, exit_status: int) -> None:
+        await container.finish()
+        if self._should_cleanup(opts, exit_status):
+            await container.cleanup()
+        else:
+            print(f"{info(self._program_name)}: Skipping clean-up of "
+                  f"container {container.name}", file=sys.stderr)
+
+    def _new_container(
+            self,
+            opts: argparse.Namespace
+    ) -> tuple[AsyncCommandocker, _JobOutput]:
+        self._num_containers += 1
+        name = (f'{self._program_name}-{time.strftime("%Y%m%d-%H%M%S")}-'
+                f'{os.getpid()}-{self._num_containers}')
+        output = _JobOutput()
+        return self._create_container(opts, name, output), output
+
+    @staticmethod
+    def _start_task(tasks: set[asyncio.Task],
+                    coro: typing.Awaitable) -> None:
+        task = asyncio.ensure_future(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+def run_client(program_name: str, socket_path: pathlib.Path, args: list[str],
+               scripts: list[tuple[str, list[str]]],
+               interrupt_status: int) -> int:
+    """
+    Submit scripts to a daemon as a job, copy the job's output to this
+    program's standard output, and wait for the job to finish.  If this
+    program is interrupted, the job is stopped.
+
+    :param program_name: the program name for messages
+    :param socket_path: the path to the daemon's Unix socket
+    :param args: this program's command-line arguments, from which the daemon
+        takes the options for the job
+    :param scripts: the name and the lines of each script
+    :param interrupt_status: the exit status to return when this program is
+        interrupted
+    :return: the job's exit status, or an exit status indicating the failure
+        to run the job
+    """
+    request = {
+        'version': PROTOCOL_VERSION,
+        'cwd': os.getcwd(),
+        'args': list(args),
+        'scripts': scripts,
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_path))
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as messages:
+                for line in messages:
+                    message = json.loads(line)
+                    if message['type'] == 'output':
+                        sys.stdout.buffer.write(
+                            base64.b64decode(message['data']))
+                        sys.stdout.buffer.flush()
+                    elif message['type'] == 'failed':
+                        print(f"{error(program_name)}: Failure encountered "
+                              f"during execution of the following command "
+                              f"at {message['script']}:{message['line']}: \n"
+                              f"\t{message['command']}", file=sys.stderr)
+                    elif message['type'] == 'report':
+                        for report_line in message['lines']:
+                            print(f"{info(program_name)}: {report_line}",
+                                  file=sys.stderr)
+                    elif message['type'] == 'error':
+                        print(f"{error(program_name)}: {message['message']}",
+                              file=sys.stderr)
+                        return 3
+                    elif message['type'] == 'exit':
+                        if not message['removed']:
+                            print(f"{info(program_name)}: Skipping clean-up "
+                                  f"of container {message['container']}",
+                                  file=sys.stderr)
+                        return message['status']
+    except OSError as err:
+        print(f"{error(program_name)}: {socket_path}: {err.strerror}",
+              file=sys.stderr)
+        return 3
+    except KeyboardInterrupt:
+        # Closing the connection stops the job
+        print(f"{error(program_name)}: Exiting on SIGINT", file=sys.stderr)
+        return interrupt_status
+    print(f"{error(program_name)}: The daemon closed the connection "
+          f"unexpectedly", file=sys.stderr)
+    return 3
+
+
+def _parse_job_options(args: list[str],
+                       cwd: pathlib.Path) -> argparse.Namespace:
+    """
+    Parse a client's command-line arguments, resolving relative paths against
+    the client's working directory.
+
+    :raise ValueError: if the arguments are invalid
+    """
+    try:
+        opts = ebuild_commander.cli.parse_args(args, exit_on_error=False)
+    except argparse.ArgumentError as err:
+        raise ValueError(str(err))
+    if opts.timing_report is not None or opts.timing_summary is not None:
+        # Containers in the pools are started before any job takes them, so
+        # their timing could not be reported to the job's client
+        raise ValueError("--timing-report and --timing-summary cannot be "
+                         "used with --connect")
+    for key, value in vars(opts).items():
+        setattr(opts, key, _resolve_paths(value, cwd))
+    if opts.threads is None:
+        opts.threads = os.cpu_count() or 1
+    return opts
+
+
+def _resolve_paths(value, cwd: pathlib.Path):
+    if isinstance(value, pathlib.Path):
+        return cwd / value
+    if isinstance(value, list):
+        return [_resolve_paths(item, cwd) for item in value]
+    return value
+
+
+def _send(writer: asyncio.StreamWriter, message: dict) -> None:
+    writer.write(json.dumps(message).encode() + b'\n')
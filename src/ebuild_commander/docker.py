@@ -18,15 +18,130 @@
 #  along with ebuild-commander.  If not, see
 #  <https://www.gnu.org/licenses/>.
 
-import math
+import contextlib
+import functools
+import io
 import os
 import pathlib
+import secrets
+import shlex
+import sqlite3
 import subprocess
 import sys
+import time
+import typing
 
-from ebuild_commander.out_fmt import warn, error
+from ebuild_commander.cache import CacheDir, hash_key
+from ebuild_commander.engine import EngineClient, EngineError
+from ebuild_commander.history import EMERGE_LOG_PATH, BuildHistory, \
+    get_run_key, parse_emerge_log
+from ebuild_commander.host import Tuning
+from ebuild_commander.layer import LayerCache, find_deepest_layer, \
+    get_layer_key, get_layer_name, is_noop
+from ebuild_commander.leftovers import get_labels, remove_in_background
+from ebuild_commander.log import CommandLog, LogDir
+from ebuild_commander.metadata import get_repo_digest, is_up_to_date, \
+    mark_up_to_date
+from ebuild_commander.out_fmt import info, warn, error, format_duration, \
+    format_size
+from ebuild_commander.pipeline import TaskGraph
+from ebuild_commander.policy import ExecutionPolicy
+from ebuild_commander.portage_config import PortageConfig, find_assignments
+from ebuild_commander.pull import PULL_ALWAYS, PullPolicy, PullRecord, \
+    PullRecords, should_pull
+from ebuild_commander.snapshot import create_snapshot, get_image_id, \
+    get_snapshot_name
+from ebuild_commander.timing import Origin, TimingRecorder
 
-_CONTAINER_PORTAGE_CONFIGS_PATH = '/var/tmp/portage-configs'
+# make.conf variables that affect the contents of binary packages
+_BINPKG_MAKE_CONF_VARS = ('CHOST', 'COMMON_FLAGS', 'CFLAGS', 'CXXFLAGS',
+                          'FCFLAGS', 'FFLAGS', 'LDFLAGS', 'RUSTFLAGS', 'USE',
+                          'ACCEPT_KEYWORDS')
+
+_CONTAINER_BINPKG_PATH = '/var/cache/binpkgs'
+
+_CONTAINER_DISTFILES_PATH = '/var/cache/distfiles'
+
+_CONTAINER_CCACHE_PATH = '/var/cache/ccache'
+
+# Portage's default PORTAGE_DEPCACHEDIR, where the metadata cache of a
+# repository without a pre-generated one is stored under the repository's path
+_CONTAINER_DEPCACHE_PATH = '/var/cache/edb/dep'
+
+# Updates the metadata cache in PORTAGE_DEPCACHEDIR for the repository named
+# by the first argument, with the number of jobs given by the second argument;
+# unlike 'emerge --regen', it does not check the Gentoo repository, and unlike
+# egencache, it does not write into the repository, which is mounted read-only
+_METADATA_REGEN_SCRIPT = """\
+import sys
+import portage
+from _emerge.MetadataRegen import MetadataRegen
+portdb = portage.db[portage.root]['porttree'].dbapi
+portdb.porttrees = [portdb.getRepositoryPath(sys.argv[1])]
+regen = MetadataRegen(portdb, max_jobs=int(sys.argv[2]), main=True)
+regen.run()
+sys.exit(regen.returncode)
+"""
+
+# The default PORTAGE_TMPDIR is /var/tmp, under which Portage builds packages
+_CONTAINER_TMPFS_PATH = '/var/tmp/portage'
+
+# PORTAGE_TMPDIR for packages excluded from the tmpfs
+_CONTAINER_NOTMPFS_PATH = '/var/tmp/notmpfs'
+
+_NOTMPFS_ENV_FILE = 'ebuild-commander-notmpfs.conf'
+
+# UID and GID of the 'portage' user and group on Gentoo, which own the
+# directory Portage builds packages in
+_PORTAGE_UID = 250
+
+# Working directory of commands run in the container
+_CONTAINER_WORKDIR = '/root'
+
+# Capabilities the container is given
+_CAPABILITIES = ('CAP_MKNOD', 'CAP_NET_ADMIN', 'CAP_SYS_ADMIN',
+                 'CAP_SYS_PTRACE')
+
+# Security options of the container
+_SECURITY_OPTS = (
+    # Needed on host systems with SELinux enabled
+    'label=disable',
+    # https://github.com/moby/moby/issues/16429
+    # Use equal sign instead of colon for compatibility with Podman
+    'apparmor=unconfined',
+    # Needed to build packages like x11-libs/gdk-pixbuf with glibc >=2.34 on
+    # GitHub Actions runners as of March 2022
+    # https://github.com/actions/virtual-environments/issues/3812
+    'seccomp=unconfined',
+)
+
+# make.conf variables that select the compiler, whose ccache entries cannot be
+# shared with other compilers
+_CCACHE_MAKE_CONF_VARS = ('CHOST', 'CC', 'CXX', 'CPP')
+
+# Keys in the output of 'ccache --print-stats' that count cache hits and misses
+_CCACHE_HIT_STATS = ('direct_cache_hit', 'preprocessed_cache_hit')
+_CCACHE_MISS_STATS = ('cache_miss',)
+
+# The socket paths of the Docker Engine APIs and the Docker executables found
+# to use the same daemon
+_CHECKED_ENGINES: set[tuple[str, str]] = set()
+
+
+def _timed_phase(name: str):
+    """
+    Make a method of `Commandocker` record a span for a phase covering every
+    call to it when timing is enabled.
+
+    :param name: the phase's name
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self._phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class Commandocker:
@@ -43,7 +158,27 @@ class Commandocker:
             docker_image: str,
             should_pull_image: bool,
             storage_opt: str,
-            docker_cmd: str
+            docker_cmd: str,
+            use_session: bool = False,
+            binpkg_cache: typing.Optional[CacheDir] = None,
+            distfiles_cache: typing.Optional[CacheDir] = None,
+            ccache: typing.Optional[CacheDir] = None,
+            ccache_size: typing.Optional[int] = None,
+            metadata_cache: typing.Optional[CacheDir] = None,
+            tmpfs_size: typing.Optional[int] = None,
+            tmpfs_excludes: typing.Optional[list[str]] = None,
+            tuning: typing.Optional[Tuning] = None,
+            use_snapshots: bool = False,
+            layer_cache: typing.Optional[LayerCache] = None,
+            pull_policy: typing.Optional[PullPolicy] = None,
+            pull_records: typing.Optional[PullRecords] = None,
+            log_dir: typing.Optional[LogDir] = None,
+            engine: typing.Optional[EngineClient] = None,
+            background_cleanup: bool = False,
+            kept: bool = False,
+            build_history: typing.Optional[BuildHistory] = None,
+            output: typing.Optional[typing.BinaryIO] = None,
+            recorder: typing.Optional[TimingRecorder] = None
     ):
         self._program_name = program_name
         self._container_name = container_name
@@ -54,74 +189,455 @@ class Commandocker:
         self._emerge_opts = emerge_opts
         self._num_threads = num_threads
         self._docker_image = docker_image
-        self._should_pull_image = should_pull_image
+        if pull_policy is None and should_pull_image:
+            pull_policy = PullPolicy(PULL_ALWAYS)
+        self._pull_policy = pull_policy
+        self._pull_records = pull_records
         self._storage_opt = storage_opt
         self._docker_cmd = docker_cmd
+        self._use_session = use_session
+        self._session = None
+        self._binpkg_cache = binpkg_cache
+        self._binpkg_partition = None
+        self._distfiles_cache = distfiles_cache
+        self._distfiles_cache_acquired = False
+        self._ccache = ccache
+        self._ccache_size = ccache_size
+        self._tmpfs_size = tmpfs_size
+        self._tmpfs_excludes = tmpfs_excludes or []
+        self._tuning = tuning
+        self._ccache_partition = None
+        self._ccache_baseline = {}
+        # The names of the custom repositories and the volumes for all
+        # repositories, which are known after the repositories are scanned
+        # when the container is started
+        self._custom_repo_names: list[str] = []
+        self._repo_volumes: list[str] = []
+        self._metadata_cache = metadata_cache
+        # The metadata cache partition of each custom repository, along with
+        # the digest of the repository's contents
+        self._metadata_partitions: dict[str, tuple[pathlib.Path, str]] = {}
+        self._portage_config = None
+        self._use_snapshots = use_snapshots
+        self._layer_cache = layer_cache
+        # The key of the layer for the container's current state, or `None`
+        # if no more layers should be created
+        self._layer_key = None
+        # The image the container's current state is compared with to
+        # determine the size of the next layer
+        self._layer_parent = None
+        self._used_layer_keys = []
+        self._skipped_commands = 0
+        self._image_id = None
+        self._log_dir = log_dir
+        self._engine = engine
+        self._background_cleanup = background_cleanup
+        # Whether the container may be kept on purpose after its job, which
+        # garbage collection of leftover containers respects
+        self._kept = kept
+        self._build_history = build_history
+        # The key of the commands passed to `start` for the build history
+        self._run_key = None
+        # The time the container was started, if it has been started and
+        # its builds should be recorded in the build history
+        self._run_start = None
+        self._output = output
+        self._recorder = recorder
 
-        self._custom_repo_names = self._get_repo_names()
+    @property
+    def name(self) -> str:
+        """
+        The container's name.
+        """
+        return self._container_name
 
-    def start(self) -> bool:
+    @property
+    def background_cleanup(self) -> bool:
+        """
+        Whether `cleanup` removes the container in the background, which can
+        be changed until `cleanup` is called.
+        """
+        return self._background_cleanup
+
+    @background_cleanup.setter
+    def background_cleanup(self, value: bool) -> None:
+        self._background_cleanup = value
+
+    def start(self, commands: typing.Sequence[str] = ()) -> bool:
         """
         Pull the specified Docker image if requested, then initialize and start
         a Docker container, with custom Portage settings applied.
 
-        If image pull failed, the function will continue with any local copy of
+        Whether the image is pulled is decided by the pull policy, using the
+        records of earlier pulls if this object was created with
+        `pull_records`.  The image is pulled while the custom repositories
+        are scanned and the Portage configuration is prepared on the host, and
+        the caches are set up as soon as what they depend on is ready.  If
+        image pull failed, the function will continue with any local copy of
         the image, or it will exit with a status indicating the failure if no
         local copy of the image is available.
 
+        If this object was created with `use_snapshots` set, the configured
+        container is committed to a snapshot image, whose tag is derived from
+        the image ID and all settings that affect the configuration.  When a
+        snapshot for the same image and settings exists, the container is
+        created from the snapshot, and the configuration step is skipped.
+
+        If this object was created with `layer_cache`, the container is created
+        from the layer for the longest prefix of `commands` that has been run
+        successfully before, if any; the number of commands in the prefix,
+        which the caller should skip, is available as `skipped_commands`.
+
+        If this object was created with `build_history` and `commands` are
+        given, the run's duration is estimated from earlier runs of the same
+        commands.  A run that skips commands because the container is created
+        from a layer is not recorded as a run of the commands.
+
         This function will return `False` if a container has already been
         started by it and has not been removed.
 
+        :param commands: the commands that will be run in the container, in
+            order (default: unknown)
         :return: whether or not the Docker container is successfully started
         """
-        if self._should_pull_image:
-            if not self._pull_image():
-                print(f"{warn(self._program_name)}: Proceeding with any local "
-                      f"copy of image {self._docker_image} -- will exit with "
-                      f"failure if the image is not available locally",
-                      file=sys.stderr)
-        if not self._run_container():
+        start = time.time()
+        if self._build_history is not None and commands:
+            self._run_key = get_run_key(commands)
+            self._report_estimate(start)
+        try:
+            prepared = self._prepare()
+        except OSError as err:
+            print(f"{error(self._program_name)}: "
+                  f"{err.filename}: {err.strerror}", file=sys.stderr)
             return False
-        self._config_portage()
+        if not prepared.get('pull_image', True):
+            print(f"{warn(self._program_name)}: Proceeding with any local "
+                  f"copy of image {self._docker_image} -- will exit with "
+                  f"failure if the image is not available locally",
+                  file=sys.stderr)
+        if self._layer_cache is not None and self._use_session:
+            print(f"{warn(self._program_name)}: The state of a persistent "
+                  f"shell cannot be saved in layers -- not using the layer "
+                  f"cache", file=sys.stderr)
+            self._layer_cache = None
+        layer_key = None
+        if self._layer_cache is not None:
+            config_key = self._get_config_key('the layer cache')
+            if config_key is not None:
+                layer_key = self._find_layer(config_key, commands)
+                if layer_key is None:
+                    self._layer_key = config_key
+        snapshot_key = None
+        if self._use_snapshots and layer_key is None:
+            snapshot_key = self._get_config_key('snapshots')
+        snapshot_name = None
+        if snapshot_key is not None:
+            snapshot_name = get_snapshot_name(snapshot_key)
+            if get_image_id(self._docker_cmd, snapshot_name) is None:
+                snapshot_name = None
+        if layer_key is not None:
+            if not self._run_container(get_layer_name(layer_key)):
+                return False
+        elif snapshot_name is not None:
+            print(f"{info(self._program_name)}: Using snapshot "
+                  f"{snapshot_name}", file=sys.stderr)
+            if not self._run_container(snapshot_name):
+                return False
+            self._layer_parent = snapshot_name
+        else:
+            if not self._run_container(self._docker_image):
+                return False
+            self._layer_parent = self._docker_image
+            configured = self._config_portage()
+            if not configured:
+                # The container is not in the state the layers are based on
+                self._layer_key = None
+            if configured and snapshot_key is not None:
+                with self._phase('create_snapshot'):
+                    created = create_snapshot(
+                        self._docker_cmd, self._container_name, snapshot_key,
+                        self._docker_image, self._image_id)
+                if not created:
+                    print(f"{warn(self._program_name)}: Cannot create "
+                          f"snapshot of container {self._container_name}",
+                          file=sys.stderr)
+        if self._metadata_partitions:
+            self._generate_metadata()
+        if self._ccache_partition is not None:
+            # ccache may not be installed yet, in which case all statistics
+            # are effectively zero
+            self._ccache_baseline = self._get_ccache_stats() or {}
+        if self._build_history is not None:
+            self._run_start = start
         return True
 
-    def execute(self, cmd: str, fatal_on_failure: bool = True) -> bool:
+    def execute(self, cmd: str, fatal_on_failure: bool = True,
+                origin: typing.Optional[Origin] = None) -> bool:
         """
         Run a command in the Docker container.  The container must be running.
         The container's standard output and standard error will be redirected
-        to this program's standard output and standard error respectively.
+        to this program's standard output and standard error respectively, or
+        both to the stream given as `output` when this object was created.
+
+        If this object was created with `log_dir`, the command's output is
+        written to a compressed log file instead, and only the last lines of
+        the output are shown if the command fails.
+
+        If this object was created with `use_session` set, the command is run
+        by a long-lived Bash process in the container that is shared by all
+        commands, so the environment and the working directory persist between
+        calls to this function.  Otherwise, every command is run by a new
+        Bash process started with `docker exec`.
 
         :param cmd: the command to be run
         :param fatal_on_failure: whether a failure to run the command indicates
             a fatal error; used for determining error message format
             (default: `True`)
+        :param origin: the command's location in the scripts, which is
+            included in the timing report (default: `None`)
         :return: whether or not the Docker process exited with a successful
             status
         """
-        args = [self._docker_cmd, 'exec', '--interactive',
-                self._container_name, '/bin/bash', '-c', cmd]
+        start = time.time()
+        start_counter = time.perf_counter()
+        log = self._open_log(cmd, origin)
+        output = self._output if log is None else log
         try:
-            subprocess.run(args, check=True, stdin=subprocess.DEVNULL)
-            return True
-        except subprocess.CalledProcessError as err:
-            if fatal_on_failure:
-                program_name = error(self._program_name)
+            if self._use_session:
+                if self._session is None:
+                    self._session = _ShellSession(
+                        self._docker_cmd, self._container_name,
+                        self._merges_stderr())
+                returncode = self._session.run(cmd, output)
+                if not self._session.is_alive():
+                    # The command ended the shell, e.g. with 'exit'; the next
+                    # command will get a new one
+                    self._session = None
             else:
-                program_name = warn(self._program_name)
-            print(f"{program_name}: Exit status {err.returncode} encountered "
-                  f"during execution of the following command in container "
-                  f"{self._container_name}: \n"
-                  f"\t{cmd}",
-                  file=sys.stderr)
+                returncode = self._run_exec(['/bin/bash', '-c', cmd],
+                                            output=output)
+        finally:
+            if log is not None:
+                log.close()
+        if log is not None:
+            self._report_log(log, returncode)
+        if self._recorder is not None:
+            self._recorder.record_command(
+                self._container_name, cmd, start,
+                time.perf_counter() - start_counter, returncode, origin)
+        if returncode != 0:
+            self._report_failure(cmd, returncode, fatal_on_failure)
+            self._layer_key = None
             return False
+        if self._layer_key is not None and not is_noop(cmd):
+            self._add_layer(cmd)
+        return True
+
+    def run_scripts(self, scripts: list[tuple[str, list[str]]],
+                    policy: ExecutionPolicy, start: bool = True) -> int:
+        """
+        Start the container with the scripts' commands, then run the lines of
+        the scripts selected by an execution policy, except for those whose
+        results the container was created with.
+
+        :param scripts: the name and the lines of each script
+        :param policy: the policy that selects the lines to run, to which the
+            outcome of each line is given
+        :param start: whether the container should be started; if not, it
+            must have been started (default: `True`)
+        :return: 3 if the container cannot be started, 1 if any line failed,
+            or 0 otherwise
+        """
+        if start and not self.start([line for _, lines in scripts
+                                     for line in lines]):
+            return 3
+        exit_status = 0
+        for line, origin in policy.select_scripts(scripts,
+                                                  self.skipped_commands):
+            succeeded = self.execute(line, origin=origin)
+            policy.record(succeeded)
+            if not succeeded:
+                exit_status = 1
+        return exit_status
+
+    @property
+    def skipped_commands(self) -> int:
+        """
+        The number of leading commands passed to `start` whose results the
+        container was created with, which should not be run again.
+        """
+        return self._skipped_commands
 
+    @_timed_phase('finish')
+    def finish(self) -> None:
+        """
+        Release the resources on the host that are held for the container, like
+        locks on cache directories.  This function should be called once after
+        all commands have been run, regardless of whether the container will
+        be removed.
+
+        If this object was created with `build_history`, the durations of the
+        packages merged in the container, and the duration of the run if
+        commands were passed to `start` and none of them were skipped, are
+        recorded.
+        """
+        if self._run_start is not None:
+            self._record_history()
+            self._run_start = None
+        if self._binpkg_partition is not None:
+            self._release_cache(self._binpkg_cache, 'binary package cache',
+                                keep=[self._binpkg_partition.name])
+            self._binpkg_partition = None
+        if self._distfiles_cache_acquired:
+            try:
+                usage = self._distfiles_cache.get_usage()
+                print(f"{info(self._program_name)}: Distfiles cache: "
+                      f"{usage.hits} hit(s), {usage.misses} miss(es), "
+                      f"{format_size(usage.miss_size)} downloaded",
+                      file=sys.stderr)
+            except OSError as err:
+                print(f"{warn(self._program_name)}: "
+                      f"{err.filename}: {err.strerror}", file=sys.stderr)
+            self._release_cache(self._distfiles_cache, 'distfiles cache')
+            self._distfiles_cache_acquired = False
+        if self._ccache_partition is not None:
+            self._report_ccache_stats()
+            self._release_cache(self._ccache, 'ccache directory',
+                                keep=[self._ccache_partition.name])
+            self._ccache_partition = None
+        if self._metadata_partitions:
+            self._release_cache(
+                self._metadata_cache, 'metadata cache',
+                keep=[partition.name for partition, _ in
+                      self._metadata_partitions.values()])
+            self._metadata_partitions = {}
+        if self._layer_cache is not None:
+            try:
+                evicted = self._layer_cache.evict(self._used_layer_keys)
+                if evicted:
+                    print(f"{info(self._program_name)}: Evicted "
+                          f"{len(evicted)} least recently used layer(s)",
+                          file=sys.stderr)
+            except OSError as err:
+                print(f"{warn(self._program_name)}: "
+                      f"{err.filename}: {err.strerror}", file=sys.stderr)
+            except subprocess.CalledProcessError as err:
+                print(f"{warn(self._program_name)}: Command {err.cmd} failed "
+                      f"with exit status {err.returncode}", file=sys.stderr)
+
+    def _prepare(self) -> dict[str, typing.Any]:
+        """
+        Do the work on the host that must be done before the container is
+        created, running steps that do not depend on each other at the same
+        time: the custom repositories are scanned and the Portage
+        configuration is prepared while the image is pulled, and the caches
+        that depend on the image's ID are set up once the ID is known.  Each
+        timed step has a phase of its own, so the spans of a phase never
+        overlap each other.
+
+        :return: the value returned by each step, by the step's name
+        """
+        graph = TaskGraph()
+        graph.add('scan_repos', self._scan_repos)
+        graph.add('pull_image', self._pull_image_by_policy)
+        graph.add('prepare_config', self._prepare_config, ['scan_repos'])
+        cache_deps = ['prepare_config']
+        if self._binpkg_cache is not None or self._ccache is not None or \
+                self._layer_cache is not None or self._use_snapshots:
+            graph.add('get_image_id', self._get_image_id, ['pull_image'])
+            cache_deps.append('get_image_id')
+        else:
+            cache_deps.append('pull_image')
+        # The caches are set up one after another, as they all add settings
+        # to the Portage configuration, whose digest depends on their order
+        graph.add('setup_caches', self._setup_caches, cache_deps)
+        if self._metadata_cache is not None and self._custom_repos:
+            graph.add('setup_metadata_cache', self._setup_metadata_cache,
+                      ['scan_repos'])
+        return graph.run()
+
+    def _scan_repos(self) -> None:
+        self._custom_repo_names = self._get_repo_names()
+        # Docker needs all paths on the host machine to be absolute ones
+        self._repo_volumes = \
+            [f'{self._gentoo_repo.resolve()}:/var/db/repos/gentoo:ro']
+        custom_repo_info = zip(self._custom_repos, self._custom_repo_names)
+        for repo_path, repo_name in custom_repo_info:
+            self._repo_volumes.append(f'{repo_path.resolve()}:'
+                                      f'/var/db/repos/{repo_name}:ro')
+
+    @_timed_phase('prepare_config')
+    def _prepare_config(self) -> None:
+        self._portage_config = self._build_portage_config()
+
+    @_timed_phase('setup_caches')
+    def _setup_caches(self) -> None:
+        if self._binpkg_cache is not None:
+            self._setup_binpkg_cache()
+        if self._distfiles_cache is not None:
+            self._setup_distfiles_cache()
+        if self._ccache is not None:
+            self._setup_ccache()
+
+    def _report_estimate(self, start: float) -> None:
+        try:
+            estimate = self._build_history.estimate_run(
+                self._run_key, self._profile, self._docker_image)
+        except (sqlite3.Error, OSError) as err:
+            print(f"{warn(self._program_name)}: Cannot read build history "
+                  f"{self._build_history.path}: {err}", file=sys.stderr)
+            return
+        if estimate is None:
+            return
+        duration, num_runs = estimate
+        finish_time = time.strftime('%H:%M', time.localtime(start + duration))
+        print(f"{info(self._program_name)}: Estimated to finish in "
+              f"{format_duration(duration)}, at {finish_time}, based on "
+              f"{num_runs} earlier run(s)", file=sys.stderr)
+
+    def _record_history(self) -> None:
+        duration = time.time() - self._run_start
+        output = io.BytesIO()
+        if self._run_exec(['cat', EMERGE_LOG_PATH], output=output) == 0:
+            builds = parse_emerge_log(
+                output.getvalue().decode(errors='replace'), self._run_start)
+        else:
+            # No package has been merged
+            builds = []
+        try:
+            if builds:
+                self._build_history.add_builds(
+                    builds, self._profile, self._docker_image,
+                    self._container_name)
+            # A run resumed from a layer is shorter than a full run of the
+            # commands, which the estimates are for
+            if self._run_key is not None and not self._skipped_commands:
+                self._build_history.add_run(
+                    self._run_key, self._profile, self._docker_image,
+                    self._run_start, duration, self._container_name)
+        except (sqlite3.Error, OSError) as err:
+            print(f"{warn(self._program_name)}: Cannot update build history "
+                  f"{self._build_history.path}: {err}", file=sys.stderr)
+
+    @_timed_phase('cleanup')
     def cleanup(self) -> bool:
         """
         Remove the container.  If the container cannot be properly removed,
         `False` will be returned.
 
+        With background clean-up, this function returns once the removal has
+        started, and the container is removed after this program exits; a
+        failure to remove the container is then not reported.
+
         :return: whether or not the Docker container is successfully removed
         """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._engine is not None:
+            return self._remove_container_with_engine()
+        if self._background_cleanup:
+            return self._remove_container_in_background()
         try:
             subprocess.run([self._docker_cmd, 'rm', '-f',
                             self._container_name],
@@ -132,6 +648,134 @@ class Commandocker:
                   f"with exit status {err.returncode}", file=sys.stderr)
             return False
 
+    def _remove_container_in_background(self) -> bool:
+        if remove_in_background(self._docker_cmd, [self._container_name]):
+            return True
+        print(f"{error(self._program_name)}: Cannot start removing container "
+              f"{self._container_name} in the background", file=sys.stderr)
+        return False
+
+    def _remove_container_with_engine(self) -> bool:
+        try:
+            self._engine.remove_container(self._container_name)
+            return True
+        except (EngineError, OSError) as err:
+            print(f"{error(self._program_name)}: Cannot remove container "
+                  f"{self._container_name}: {err}", file=sys.stderr)
+            return False
+
+    def _phase(self, name: str) -> typing.ContextManager:
+        if self._recorder is None:
+            return contextlib.nullcontext()
+        return self._recorder.phase(self._container_name, name)
+
+    def _run_exec(self, cmd: list[str],
+                  input_data: typing.Optional[bytes] = None,
+                  output: typing.Optional[typing.BinaryIO] = None) -> int:
+        """
+        Run a command in the container with 'docker exec', or with the Docker
+        Engine API if this object was created with `engine`, sending its
+        output to `output` if it was given when this object was created.
+
+        :param cmd: the command's arguments
+        :param input_data: data for the command's standard input (default:
+            redirect standard input from /dev/null)
+        :param output: the stream to send the command's output to instead
+            (default: `None`)
+        :return: the command's exit status, or 125 if the Docker Engine API
+            reports an error, like 'docker exec' does
+        """
+        if output is None:
+            output = self._output
+        if self._engine is not None:
+            try:
+                return self._engine.exec(self._container_name, cmd,
+                                         input_data, output)
+            except (EngineError, OSError, EOFError) as err:
+                print(f"{error(self._program_name)}: Cannot run command in "
+                      f"container {self._container_name}: {err}",
+                      file=sys.stderr)
+                return 125
+        args = [self._docker_cmd, 'exec', '--interactive',
+                self._container_name, *cmd]
+        if output is None:
+            if input_data is None:
+                return subprocess.run(args,
+                                      stdin=subprocess.DEVNULL).returncode
+            return subprocess.run(args, input=input_data).returncode
+        stdin = subprocess.DEVNULL if input_data is None else subprocess.PIPE
+        with subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT) as process:
+            if input_data is not None:
+                try:
+                    process.stdin.write(input_data)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            for chunk in iter(lambda: process.stdout.read1(65536), b''):
+                output.write(chunk)
+            output.flush()
+        return process.returncode
+
+    def _merges_stderr(self) -> bool:
+        """
+        :return: whether commands' standard error should be sent to the same
+            stream as their standard output
+        """
+        return self._output is not None or self._log_dir is not None
+
+    def _open_log(self, cmd: str, origin: typing.Optional[Origin]) \
+            -> typing.Optional[CommandLog]:
+        if self._log_dir is None:
+            return None
+        try:
+            return self._log_dir.open(self._container_name, cmd, origin)
+        except OSError as err:
+            print(f"{warn(self._program_name)}: {err.filename}: "
+                  f"{err.strerror} -- showing the command's output",
+                  file=sys.stderr)
+            return None
+
+    def _report_log(self, log: CommandLog, returncode: int) -> None:
+        """
+        Show where a command's output has been saved, and the last lines of
+        the output if the command failed.
+        """
+        tail = log.get_tail()
+        if returncode != 0 and tail:
+            print(f"{info(self._program_name)}: Last {len(tail)} line(s) of "
+                  f"output from the command:", file=sys.stderr)
+            console = self._output if self._output is not None \
+                else sys.stdout.buffer
+            console.write(b''.join(line + b'\n' for line in tail))
+            console.flush()
+        print(f"{info(self._program_name)}: Output saved to {log.path}",
+              file=sys.stderr)
+
+    def _release_cache(self, cache: CacheDir, description: str,
+                       keep: typing.Iterable[str] = ()) -> None:
+        try:
+            evicted = cache.release(keep)
+            if evicted:
+                print(f"{info(self._program_name)}: Evicted {len(evicted)} "
+                      f"least recently used item(s) from {description} "
+                      f"{cache.path}", file=sys.stderr)
+        except OSError as err:
+            print(f"{warn(self._program_name)}: "
+                  f"{err.filename}: {err.strerror}", file=sys.stderr)
+
+    def _report_failure(self, cmd: str, returncode: int,
+                        fatal_on_failure: bool) -> None:
+        if fatal_on_failure:
+            program_name = error(self._program_name)
+        else:
+            program_name = warn(self._program_name)
+        print(f"{program_name}: Exit status {returncode} encountered "
+              f"during execution of the following command in container "
+              f"{self._container_name}: \n"
+              f"\t{cmd}",
+              file=sys.stderr)
+
     def _get_repo_names(self) -> list:
         repo_names = []
         for repo in self._custom_repos:
@@ -145,7 +789,72 @@ class Commandocker:
                       f"{err.filename}: {err.strerror}", file=sys.stderr)
         return repo_names
 
+    def _get_image_id(self) -> typing.Optional[str]:
+        if self._image_id is None:
+            self._image_id = get_image_id(self._docker_cmd, self._docker_image)
+        if self._image_id is None and self._pull_policy is None:
+            # The image has not been pulled yet, but its ID is needed
+            self._pull_image()
+            self._image_id = get_image_id(self._docker_cmd,
+                                          self._docker_image)
+        return self._image_id
+
+    def _pull_image_by_policy(self) -> bool:
+        """
+        :return: `False` if the image should be pulled but the pull failed;
+            otherwise `True`
+        """
+        if self._pull_policy is None:
+            return True
+        if self._pull_records is None:
+            if should_pull(self._pull_policy, None,
+                           get_image_id(self._docker_cmd, self._docker_image),
+                           time.time()):
+                return self._pull_image()
+            return True
+        with contextlib.ExitStack() as stack:
+            try:
+                stack.enter_context(
+                    self._pull_records.lock(self._docker_image))
+            except OSError as err:
+                # Pulling without the records is the least that can be done
+                print(f"{warn(self._program_name)}: "
+                      f"{err.filename}: {err.strerror}", file=sys.stderr)
+                return self._pull_image()
+            return self._pull_image_with_records()
+
+    def _pull_image_with_records(self) -> bool:
+        record = self._pull_records.get(self._docker_image)
+        local_image_id = get_image_id(self._docker_cmd, self._docker_image)
+        now = time.time()
+        if not should_pull(self._pull_policy, record, local_image_id, now):
+            print(f"{info(self._program_name)}: Image {self._docker_image} "
+                  f"is up to date -- skipping pull", file=sys.stderr)
+            return True
+        if not self._pull_image():
+            return False
+        image_id = get_image_id(self._docker_cmd, self._docker_image)
+        if image_id is not None:
+            try:
+                self._pull_records.put(self._docker_image,
+                                       PullRecord(now, image_id))
+            except OSError as err:
+                # The image has been pulled, so it is not pulled again
+                print(f"{warn(self._program_name)}: "
+                      f"{err.filename}: {err.strerror} -- the pull will not "
+                      f"be recorded", file=sys.stderr)
+        return True
+
+    @_timed_phase('pull_image')
     def _pull_image(self) -> bool:
+        if self._engine is not None:
+            try:
+                self._engine.pull_image(self._docker_image)
+                return True
+            except (EngineError, OSError) as err:
+                print(f"{warn(self._program_name)}: Cannot pull image "
+                      f"{self._docker_image}: {err}", file=sys.stderr)
+                return False
         try:
             subprocess.run([self._docker_cmd, 'pull', self._docker_image],
                            check=True, stdin=subprocess.DEVNULL)
@@ -155,55 +864,71 @@ class Commandocker:
                   f"exit status {err.returncode}", file=sys.stderr)
             return False
 
-    def _run_container(self) -> bool:
+    @_timed_phase('run_container')
+    def _run_container(self, image: str) -> bool:
+        volumes = list(self._repo_volumes)
+
+        if self._binpkg_partition is not None:
+            volumes.append(f'{self._binpkg_partition.resolve()}:'
+                           f'{_CONTAINER_BINPKG_PATH}')
+
+        if self._distfiles_cache_acquired:
+            volumes.append(f'{self._distfiles_cache.path.resolve()}:'
+                           f'{_CONTAINER_DISTFILES_PATH}')
+
+        if self._ccache_partition is not None:
+            volumes.append(f'{self._ccache_partition.resolve()}:'
+                           f'{_CONTAINER_CCACHE_PATH}')
+
+        for repo_name, (partition, _) in self._metadata_partitions.items():
+            volumes.append(f'{partition.resolve()}:'
+                           f'{_CONTAINER_DEPCACHE_PATH}'
+                           f'/var/db/repos/{repo_name}')
+
+        tmpfs = {}
+        if self._tmpfs_size is not None:
+            # Both Docker and Podman mount a tmpfs with 'noexec' by default,
+            # but build systems run programs they have just built
+            tmpfs[_CONTAINER_TMPFS_PATH] = \
+                f'rw,exec,size={self._tmpfs_size},mode=0775,' \
+                f'uid={_PORTAGE_UID},gid={_PORTAGE_UID}'
+
+        if self._engine is not None:
+            return self._run_container_with_engine(image, volumes, tmpfs)
+
         docker_args = [
             self._docker_cmd, 'run', '--detach',
             '--name', self._container_name,
             '--tty',
-            '--cap-add', 'CAP_MKNOD',
-            '--cap-add', 'CAP_NET_ADMIN',
-            '--cap-add', 'CAP_SYS_ADMIN',
-            '--cap-add', 'CAP_SYS_PTRACE',
-            # Needed on host systems with SELinux enabled
-            '--security-opt', 'label=disable',
-            # https://github.com/moby/moby/issues/16429
-            # Use equal sign instead of colon for compatibility with Podman
-            '--security-opt', 'apparmor=unconfined',
-            # Needed to build packages like x11-libs/gdk-pixbuf with
-            # glibc >=2.34 on GitHub Actions runners as of March 2022
-            # https://github.com/actions/virtual-environments/issues/3812
-            '--security-opt', 'seccomp=unconfined',
-            '--workdir', '/root',
-            # Docker needs all paths on the host machine to be absolute ones
-            '--volume', f'{self._gentoo_repo.resolve()}:'
-                        f'/var/db/repos/gentoo:ro'
+            '--workdir', _CONTAINER_WORKDIR,
         ]
-
-        # Bind each config directory to a path whose base name is the
-        # directory's index in the array; pad each index with enough digits to
-        # ensure iteration order in Bash shell expansion is desired, or else
-        # the iteration order would be like [0, 10, 1, 2, ...]
-        num_configs = len(self._portage_configs)
-        padding = math.ceil(math.log10(num_configs))
-        for i in range(len(self._portage_configs)):
-            portage_config = self._portage_configs[i]
-            padded_i = f'{i:0{padding}}'
+        for key, value in get_labels(self._kept).items():
+            docker_args.append('--label')
+            docker_args.append(f'{key}={value}')
+        for capability in _CAPABILITIES:
+            docker_args.append('--cap-add')
+            docker_args.append(capability)
+        for security_opt in _SECURITY_OPTS:
+            docker_args.append('--security-opt')
+            docker_args.append(security_opt)
+        for volume in volumes:
             docker_args.append('--volume')
-            docker_args.append(f'{portage_config.resolve()}:'
-                               f'{_CONTAINER_PORTAGE_CONFIGS_PATH}/'
-                               f'{padded_i}:ro')
+            docker_args.append(volume)
+        for path, options in tmpfs.items():
+            docker_args.append('--tmpfs')
+            docker_args.append(f'{path}:{options}')
 
-        custom_repo_info = zip(self._custom_repos, self._custom_repo_names)
-        for repo_path, repo_name in custom_repo_info:
-            docker_args.append('--volume')
-            docker_args.append(f'{repo_path.resolve()}:'
-                               f'/var/db/repos/{repo_name}:ro')
+        if self._tuning is not None:
+            docker_args.append('--cpus')
+            docker_args.append(f'{self._tuning.cpus:g}')
+            docker_args.append('--memory')
+            docker_args.append(str(self._tuning.memory))
 
         if self._storage_opt is not None:
             docker_args.append('--storage-opt')
             docker_args.append(self._storage_opt)
 
-        docker_args.append(self._docker_image)
+        docker_args.append(image)
         try:
             subprocess.run(docker_args, check=True,
                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
@@ -213,53 +938,489 @@ class Commandocker:
                   f"with exit status {err.returncode}", file=sys.stderr)
             return False
 
-    def _config_portage(self) -> None:
-        self._copy_portage_config()
-        self._add_comment_to_make_conf()
-        self._set_makeopts_num_jobs()
-        self._set_emerge_opts()
-        self._enable_custom_repos()
-        self._set_profile()
-
-    def _copy_portage_config(self) -> None:
-        self.execute(f'rm -rf /etc/portage/*',
-                     fatal_on_failure=False)
-        self.execute(f'for dir in "{_CONTAINER_PORTAGE_CONFIGS_PATH}"/*; do '
-                     f'cp -r "$dir"/* /etc/portage; done',
-                     fatal_on_failure=False)
-        self.execute(f'rm -f /etc/portage/make.profile',
-                     fatal_on_failure=False)
-        self.execute(f'rm -rf /etc/portage/repos.conf',
-                     fatal_on_failure=False)
-
-    def _add_comment_to_make_conf(self) -> None:
-        self.execute('echo -e "\\n# Settings added by ebuild-commander" '
-                     '>> /etc/portage/make.conf',
-                     fatal_on_failure=False)
-
-    def _set_makeopts_num_jobs(self) -> None:
-        self.execute('echo \'MAKEOPTS="${MAKEOPTS} '
-                     f'-j{self._num_threads}"\' '
-                     '>> /etc/portage/make.conf',
-                     fatal_on_failure=False)
-
-    def _set_emerge_opts(self) -> None:
-        self.execute('echo \'EMERGE_DEFAULT_OPTS="${EMERGE_DEFAULT_OPTS} '
-                     f'{self._emerge_opts}"\' '
-                     '>> /etc/portage/make.conf',
-                     fatal_on_failure=False)
-
-    def _enable_custom_repos(self) -> None:
-        self.execute('mkdir /etc/portage/repos.conf', fatal_on_failure=False)
+    def _run_container_with_engine(self, image: str, volumes: list[str],
+                                   tmpfs: dict[str, str]) -> bool:
+        """
+        Create and start the container with the Docker Engine API, using the
+        same settings as `_run_container`.
+        """
+        host_config = {
+            'Binds': volumes,
+            'Tmpfs': tmpfs,
+            'CapAdd': list(_CAPABILITIES),
+            'SecurityOpt': list(_SECURITY_OPTS),
+        }
+        if self._tuning is not None:
+            host_config['NanoCpus'] = round(self._tuning.cpus * 1e9)
+            host_config['Memory'] = self._tuning.memory
+        if self._storage_opt is not None:
+            key, _, value = self._storage_opt.partition('=')
+            host_config['StorageOpt'] = {key: value}
+        config = {
+            'Image': image,
+            'Tty': True,
+            'WorkingDir': _CONTAINER_WORKDIR,
+            'Labels': get_labels(self._kept),
+            'HostConfig': host_config,
+        }
+        try:
+            try:
+                container_id = self._engine.create_container(
+                    self._container_name, config)
+            except EngineError as err:
+                if err.status != 404:
+                    raise
+                # Unlike 'docker run', the API does not pull missing images
+                self._engine.pull_image(image)
+                container_id = self._engine.create_container(
+                    self._container_name, config)
+            self._engine.start_container(self._container_name)
+        except (EngineError, OSError) as err:
+            print(f"{error(self._program_name)}: Cannot start container "
+                  f"{self._container_name}: {err}", file=sys.stderr)
+            return False
+        return self._check_engine(container_id)
+
+    def _check_engine(self, container_id: str) -> bool:
+        """
+        Check that the Docker executable, which still runs commands in the
+        container and handles images for some features, sees the container
+        created through the Docker Engine API.  Otherwise, the two use
+        different daemons, and those commands would fail.
+
+        :param container_id: the container's ID from the API
+        :return: whether or not the executable sees the container
+        """
+        key = (self._engine.socket_path, self._docker_cmd)
+        if key in _CHECKED_ENGINES:
+            return True
+        try:
+            result = subprocess.run(
+                [self._docker_cmd, 'container', 'inspect', '--format',
+                 '{{.Id}}', self._container_name],
+                stdin=subprocess.DEVNULL, capture_output=True, text=True)
+            found = result.returncode == 0 and \
+                result.stdout.strip() == container_id
+        except OSError:
+            found = False
+        if not found:
+            print(f"{error(self._program_name)}: Container "
+                  f"{self._container_name} created through "
+                  f"{self._engine.socket_path} is not found by "
+                  f"'{self._docker_cmd}' -- the Docker Engine API socket and "
+                  f"the Docker executable must use the same daemon",
+                  file=sys.stderr)
+            return False
+        _CHECKED_ENGINES.add(key)
+        return True
+
+    @_timed_phase('config_portage')
+    def _config_portage(self) -> bool:
+        # The final /etc/portage is prepared on the host and applied with a
+        # single 'docker exec' to avoid the overhead of one process per step
+        cmd = (f'rm -rf /etc/portage/* && '
+               f'tar --extract --file - --directory /etc/portage && '
+               f'eselect profile set {shlex.quote(self._profile)}')
+        if self._tmpfs_size is not None and self._tmpfs_excludes:
+            cmd += f' && mkdir -p {_CONTAINER_NOTMPFS_PATH}'
+        returncode = self._run_exec(['/bin/bash', '-c', cmd],
+                                    self._portage_config.to_tar())
+        if returncode != 0:
+            self._report_failure(cmd, returncode, fatal_on_failure=False)
+            return False
+        return True
+
+    def _build_portage_config(self) -> PortageConfig:
+        config = PortageConfig(self._portage_configs)
+        makeopts = f'-j{self._num_threads}'
+        emerge_opts = self._emerge_opts
+        if self._tuning is not None:
+            load_average = f'{self._tuning.load_average:g}'
+            makeopts += f' -l{load_average}'
+            emerge_opts = (f'--jobs={self._tuning.emerge_jobs} '
+                           f'--load-average={load_average} {emerge_opts}')
+        config.append_to_file(
+            'make.conf',
+            '\n'
+            '# Settings added by ebuild-commander\n'
+            f'MAKEOPTS="${{MAKEOPTS}} {makeopts}"\n'
+            f'EMERGE_DEFAULT_OPTS="${{EMERGE_DEFAULT_OPTS}} '
+            f'{emerge_opts}"\n'
+        )
         for repo in self._custom_repo_names:
-            self.execute(
-                f'echo -e "'
+            config.add_file(
+                f'repos.conf/{repo}.conf',
                 f'[{repo}]\n'
                 f'location = /var/db/repos/{repo}\n'
-                f'master = gentoo" > /etc/portage/repos.conf/{repo}.conf',
-                fatal_on_failure=False
+                f'master = gentoo\n'
+            )
+        if self._tmpfs_size is not None and self._tmpfs_excludes:
+            config.add_file(
+                f'env/{_NOTMPFS_ENV_FILE}',
+                f'PORTAGE_TMPDIR="{_CONTAINER_NOTMPFS_PATH}"\n'
+            )
+            config.append_to_file(
+                'package.env',
+                '\n' + ''.join(f'{atom} {_NOTMPFS_ENV_FILE}\n'
+                               for atom in self._tmpfs_excludes)
             )
+        return config
+
+    def _setup_binpkg_cache(self) -> None:
+        image_id = self._get_image_id()
+        if image_id is None:
+            print(f"{warn(self._program_name)}: Cannot determine the ID of "
+                  f"image {self._docker_image} -- not using the binary "
+                  f"package cache", file=sys.stderr)
+            return
+        try:
+            self._binpkg_cache.acquire()
+            self._binpkg_partition = self._binpkg_cache.get_partition(
+                self._get_binpkg_cache_key(image_id))
+        except OSError as err:
+            print(f"{warn(self._program_name)}: {err.filename}: "
+                  f"{err.strerror} -- not using the binary package cache",
+                  file=sys.stderr)
+            self._binpkg_cache.release()
+            return
+        self._portage_config.append_to_file(
+            'make.conf',
+            f'PKGDIR="{_CONTAINER_BINPKG_PATH}"\n'
+            'FEATURES="${FEATURES} buildpkg"\n'
+            'EMERGE_DEFAULT_OPTS="${EMERGE_DEFAULT_OPTS} '
+            '--usepkg --binpkg-respect-use=y"\n'
+        )
+
+    def _setup_distfiles_cache(self) -> None:
+        try:
+            self._distfiles_cache.acquire()
+        except OSError as err:
+            print(f"{warn(self._program_name)}: {err.filename}: "
+                  f"{err.strerror} -- not using the distfiles cache",
+                  file=sys.stderr)
+            self._distfiles_cache.release()
+            return
+        self._distfiles_cache_acquired = True
+        self._portage_config.append_to_file(
+            'make.conf', f'DISTDIR="{_CONTAINER_DISTFILES_PATH}"\n')
+
+    def _setup_ccache(self) -> None:
+        image_id = self._get_image_id()
+        if image_id is None:
+            print(f"{warn(self._program_name)}: Cannot determine the ID of "
+                  f"image {self._docker_image} -- not using ccache",
+                  file=sys.stderr)
+            return
+        make_conf = self._portage_config.get_file_contents('make.conf') or b''
+        assignments = find_assignments(make_conf.decode(errors='replace'),
+                                       _CCACHE_MAKE_CONF_VARS)
+        # Compilers in different images or for different profiles, like ones
+        # for different libc implementations, should not share a segment
+        key = hash_key(image_id, self._profile, '\n'.join(assignments))
+        try:
+            self._ccache.acquire()
+            self._ccache_partition = self._ccache.get_partition(key)
+            if self._ccache_size is not None:
+                # A size without a suffix would be taken as gigabytes
+                max_size_kib = max(1, self._ccache_size // 1024)
+                (self._ccache_partition / 'ccache.conf').write_text(
+                    f'max_size = {max_size_kib}Ki\n')
+        except OSError as err:
+            print(f"{warn(self._program_name)}: {err.filename}: "
+                  f"{err.strerror} -- not using ccache", file=sys.stderr)
+            self._ccache.release()
+            self._ccache_partition = None
+            return
+        self._portage_config.append_to_file(
+            'make.conf',
+            'FEATURES="${FEATURES} ccache"\n'
+            f'CCACHE_DIR="{_CONTAINER_CCACHE_PATH}"\n'
+        )
+
+    @_timed_phase('setup_metadata_cache')
+    def _setup_metadata_cache(self) -> None:
+        try:
+            self._metadata_cache.acquire()
+            for repo_path, repo_name in zip(self._custom_repos,
+                                            self._custom_repo_names):
+                # A repository keeps its partition when its contents change,
+                # so the cache can be updated incrementally
+                partition = self._metadata_cache.get_partition(
+                    hash_key(repo_name, str(repo_path.resolve())))
+                digest = get_repo_digest(repo_path, [self._gentoo_repo])
+                self._metadata_partitions[repo_name] = (partition, digest)
+        except OSError as err:
+            print(f"{warn(self._program_name)}: {err.filename}: "
+                  f"{err.strerror} -- not using the metadata cache",
+                  file=sys.stderr)
+            self._metadata_cache.release()
+            self._metadata_partitions = {}
+
+    @_timed_phase('generate_metadata')
+    def _generate_metadata(self) -> None:
+        """
+        Update the metadata cache of every custom repository whose contents
+        have changed since the cache was last generated.  Only entries for
+        ebuilds that have changed or whose eclasses have changed are
+        regenerated.
+        """
+        for repo_name, (partition, digest) in \
+                self._metadata_partitions.items():
+            if is_up_to_date(partition, digest):
+                continue
+            print(f"{info(self._program_name)}: Updating metadata cache for "
+                  f"repository {repo_name}", file=sys.stderr)
+            returncode = self._run_exec(
+                ['python3', '-c', _METADATA_REGEN_SCRIPT, repo_name,
+                 str(self._num_threads)])
+            if returncode != 0:
+                print(f"{warn(self._program_name)}: Cannot update metadata "
+                      f"cache for repository {repo_name} -- exit status "
+                      f"{returncode}", file=sys.stderr)
+                continue
+            try:
+                mark_up_to_date(partition, digest)
+            except OSError as err:
+                print(f"{warn(self._program_name)}: "
+                      f"{err.filename}: {err.strerror}", file=sys.stderr)
+
+    def _find_layer(self, base_key: str,
+                    commands: typing.Sequence[str]) -> typing.Optional[str]:
+        """
+        Find the layer to create the container from, and prepare for creating
+        layers on top of it.
+
+        :return: the key of the layer, or `None` if the container should be
+            created and configured as usual
+        """
+        try:
+            available = self._layer_cache.list_keys()
+        except subprocess.CalledProcessError as err:
+            print(f"{warn(self._program_name)}: Command {err.cmd} failed "
+                  f"with exit status {err.returncode} -- not using the "
+                  f"layer cache", file=sys.stderr)
+            self._layer_cache = None
+            return None
+        count, layer_key = find_deepest_layer(base_key, commands, available)
+        if layer_key is None:
+            return None
+        print(f"{info(self._program_name)}: Using layer for the first "
+              f"{count} command(s)", file=sys.stderr)
+        self._layer_cache.use(layer_key)
+        self._used_layer_keys.append(layer_key)
+        self._layer_key = layer_key
+        self._layer_parent = get_layer_name(layer_key)
+        self._skipped_commands = count
+        return layer_key
+
+    @_timed_phase('commit_layer')
+    def _add_layer(self, cmd: str) -> None:
+        """
+        Save the container's state after a successful command in a layer.
+        """
+        key = get_layer_key(self._layer_key, cmd)
+        if not self._layer_cache.add(self._container_name, key,
+                                     self._layer_parent):
+            print(f"{warn(self._program_name)}: Cannot save layer for "
+                  f"command in container {self._container_name}: \n"
+                  f"\t{cmd}", file=sys.stderr)
+            self._layer_key = None
+            return
+        self._used_layer_keys.append(key)
+        self._layer_key = key
+        self._layer_parent = get_layer_name(key)
+
+    def _get_ccache_stats(self) -> typing.Optional[dict[str, int]]:
+        result = subprocess.run(
+            [self._docker_cmd, 'exec', '--env',
+             f'CCACHE_DIR={_CONTAINER_CCACHE_PATH}', self._container_name,
+             'ccache', '--print-stats'],
+            stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        stats = {}
+        for line in result.stdout.splitlines():
+            key, _, value = line.partition('\t')
+            if value.strip().isdigit():
+                stats[key] = int(value)
+        return stats
+
+    def _report_ccache_stats(self) -> None:
+        stats = self._get_ccache_stats()
+        if stats is None:
+            print(f"{warn(self._program_name)}: Cannot get ccache statistics "
+                  f"-- is dev-util/ccache installed in the container?",
+                  file=sys.stderr)
+            return
+
+        def count(keys: tuple) -> int:
+            return sum(stats.get(key, 0) - self._ccache_baseline.get(key, 0)
+                       for key in keys)
+
+        hits = count(_CCACHE_HIT_STATS)
+        misses = count(_CCACHE_MISS_STATS)
+        total = hits + misses
+        hit_rate = f'{hits / total:.1%}' if total else 'n/a'
+        print(f"{info(self._program_name)}: ccache: {hits} hit(s), "
+              f"{misses} miss(es), hit rate {hit_rate}", file=sys.stderr)
+
+    def _get_config_key(self, feature: str) -> typing.Optional[str]:
+        """
+        Compute the key identifying all inputs used to configure the
+        container, for snapshots and layers.
+
+        :param feature: the name of the feature that needs the key, for
+            messages
+        :return: the key, or `None` if the key cannot be computed
+        """
+        image_id = self._get_image_id()
+        if image_id is None:
+            print(f"{warn(self._program_name)}: Cannot determine the ID of "
+                  f"image {self._docker_image} -- not using {feature}",
+                  file=sys.stderr)
+            return None
+        return hash_key(image_id, self._portage_config.get_digest(),
+                        self._profile, str(self._num_threads),
+                        self._emerge_opts,
+                        '\n'.join(self._custom_repo_names))
+
+    def _get_binpkg_cache_key(self, image_id: str) -> str:
+        """
+        Compute the key of the binary package cache partition that is
+        compatible with the container's build configuration.
+        """
+        make_conf = self._portage_config.get_file_contents('make.conf') or b''
+        assignments = find_assignments(make_conf.decode(errors='replace'),
+                                       _BINPKG_MAKE_CONF_VARS)
+        package_use = self._portage_config.get_file_contents('package.use')
+        return hash_key(self._profile, image_id, '\n'.join(assignments),
+                        package_use or b'',
+                        '\n'.join(sorted(self._custom_repo_names)))
+
+
+class _SessionProtocol:
+    """
+    The framing of commands sent to a Bash process that reads commands from
+    its standard input and runs them one after another.
+
+    After each command, the process prints a line consisting of a marker that
+    is unique to the session, a colon, and the command's exit status.  The
+    marker allows the command's output to be told apart from the exit status
+    without requiring the output to end with a newline.
+    """
+
+    def __init__(self):
+        self._marker = f'__ebuild_commander_{secrets.token_hex(16)}__'.encode()
+
+    def format_command(self, cmd: str) -> bytes:
+        """
+        :param cmd: the command to be run
+        :return: the line to write to the Bash process's standard input to run
+            the command, whose standard input is redirected from /dev/null so
+            it cannot consume the commands that follow it
+        """
+        # 'eval' reports syntax errors in the command as a non-zero exit
+        # status instead of aborting the session
+        return (f'eval -- {shlex.quote(cmd)} < /dev/null; '
+                f'printf \'%s:%d\\n\' {self._marker.decode()} "$?"\n').encode()
+
+    def parse(self, buf: bytes) -> tuple[bytes, bytes, typing.Optional[int]]:
+        """
+        Split the data read from the Bash process so far.
+
+        :param buf: the data that has not been consumed yet
+        :return: the command's output that can be copied now, the data to keep
+            for parsing once more data is read, and the command's exit status
+            if the command has finished
+        """
+        pos = buf.find(self._marker)
+        if pos >= 0:
+            end = buf.find(b'\n', pos)
+            if end < 0:
+                return buf[:pos], buf[pos:], None
+            return buf[:pos], buf[end + 1:], \
+                int(buf[pos + len(self._marker) + 1:end])
+        # Hold back only what might be the start of the marker
+        held = self._partial_marker_length(buf)
+        return buf[:len(buf) - held], buf[len(buf) - held:], None
+
+    def _partial_marker_length(self, buf: bytes) -> int:
+        for length in range(min(len(buf), len(self._marker) - 1), 0, -1):
+            if self._marker.startswith(buf[-length:]):
+                return length
+        return 0
+
+
+class _ShellSession:
+    """
+    A Bash process in a Docker container that reads commands from its standard
+    input and runs them one after another, framed by a `_SessionProtocol`.
+    """
+
+    _READ_SIZE = 65536
+
+    def __init__(self, docker_cmd: str, container_name: str,
+                 merge_stderr: bool = False):
+        self._protocol = _SessionProtocol()
+        self._process = subprocess.Popen(
+            [docker_cmd, 'exec', '--interactive', container_name, '/bin/bash'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else None)
+
+    def is_alive(self) -> bool:
+        return self._process.poll() is None
+
+    def run(self, cmd: str,
+            output: typing.Optional[typing.BinaryIO] = None) -> int:
+        """
+        Run a command in the session, and copy its standard output to the
+        specified stream.  The command's standard input is redirected from
+        /dev/null so it cannot consume the commands that follow it.
+
+        :param cmd: the command to be run
+        :param output: the stream to which the command's standard output is
+            copied (default: this program's standard output)
+        :return: the command's exit status, or the exit status of the Docker
+            process if the session ended during the command
+        """
+        if output is None:
+            output = sys.stdout.buffer
+        try:
+            self._process.stdin.write(self._protocol.format_command(cmd))
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            return self._process.wait()
+
+        fd = self._process.stdout.fileno()
+        buf = b''
+        while True:
+            data, buf, returncode = self._protocol.parse(buf)
+            self._write(output, data)
+            if returncode is not None:
+                return returncode
+            chunk = os.read(fd, self._READ_SIZE)
+            if not chunk:
+                self._write(output, buf)
+                return self._process.wait()
+            buf += chunk
+
+    def close(self) -> None:
+        """
+        End the session, killing the Bash process if it does not exit in time.
+        """
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process.stdout.close()
 
-    def _set_profile(self) -> None:
-        self.execute(f'eselect profile set {self._profile}',
-                     fatal_on_failure=False)
+    @staticmethod
+    def _write(output: typing.BinaryIO, data: bytes) -> None:
+        if data:
+            output.write(data)
+            output.flush()
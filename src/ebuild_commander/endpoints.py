@@ -0,0 +1,224 @@
+#  ebuild-commander Docker Endpoints Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import shlex
+import shutil
+import sys
+import typing
+
+from ebuild_commander.cache import get_user_cache_dir, hash_key
+from ebuild_commander.out_fmt import info, warn, error
+
+# Environment variable with the URL of the Docker daemon to use
+_ENV_HOST = 'DOCKER_HOST'
+
+# Environment variable with the name of the Docker context to use
+_ENV_CONTEXT = 'DOCKER_CONTEXT'
+
+# Number of times in a row a container cannot be started on an endpoint
+# after which no more jobs are placed on the endpoint
+_MAX_FAILURES = 3
+
+_T = typing.TypeVar('_T')
+
+
+class Endpoint(typing.NamedTuple):
+    """
+    A Docker daemon that jobs can be placed on.
+    """
+    # The name of a Docker context, or the URL of the daemon in the format of
+    # DOCKER_HOST, like 'ssh://user@host' or 'tcp://host:2376'
+    host: str
+    # The maximum number of jobs that run on the endpoint at the same time
+    weight: int = 1
+
+    def get_environment(self) -> dict[str, typing.Optional[str]]:
+        """
+        :return: the environment variables that make the Docker executable
+            use this endpoint, where `None` means a variable must be unset
+        """
+        if '://' in self.host:
+            return {_ENV_HOST: self.host, _ENV_CONTEXT: None}
+        # DOCKER_HOST would take precedence over the context
+        return {_ENV_HOST: None, _ENV_CONTEXT: self.host}
+
+
+def get_endpoint_docker_cmd(docker_cmd: str, endpoint: Endpoint) -> str:
+    """
+    Get an executable that runs the Docker executable with an endpoint.  The
+    executable is a shell script in the user's cache directory setting the
+    environment variables for the endpoint, so it can be used wherever the
+    Docker executable is, even by processes outliving this program, like
+    ones removing containers in the background.
+
+    :param docker_cmd: the Docker executable
+    :param endpoint: the endpoint
+    :return: the path to the executable
+    :raise FileNotFoundError: if the Docker executable cannot be found
+    :raise OSError: if the executable cannot be created
+    """
+    path = shutil.which(docker_cmd)
+    if path is None:
+        raise FileNotFoundError(
+            f"Executable for Docker functionalities '{docker_cmd}' not found")
+    lines = ['#!/bin/sh']
+    for name, value in endpoint.get_environment().items():
+        if value is None:
+            lines.append(f'unset {name}')
+        else:
+            lines.append(f'{name}={shlex.quote(value)}')
+            lines.append(f'export {name}')
+    lines.append(f'exec {shlex.quote(os.path.abspath(path))} "$@"')
+    contents = '\n'.join(lines) + '\n'
+    directory = get_user_cache_dir() / 'endpoints'
+    script = directory / f'docker-{hash_key(contents)}'
+    if script.is_file() and os.access(script, os.X_OK):
+        return str(script)
+    directory.mkdir(parents=True, exist_ok=True)
+    # Other instances might be using the same script
+    temp_script = directory / f'.{script.name}.{os.getpid()}'
+    temp_script.write_text(contents)
+    temp_script.chmod(0o755)
+    os.replace(temp_script, script)
+    return str(script)
+
+
+class EndpointPool:
+    """
+    Place jobs on endpoints.  A job is placed on the endpoint running the
+    fewest jobs relative to its weight, among the endpoints running fewer
+    jobs than their weights, waiting until there is such an endpoint.  If
+    containers cannot be started on an endpoint several times in a row, no
+    more jobs are placed on it.
+
+    An instance must be created and used in the same event loop.
+    """
+
+    def __init__(self, program_name: str, endpoints: list[Endpoint]):
+        """
+        :param program_name: the program name for messages
+        :param endpoints: the endpoints, which must have different hosts; an
+            endpoint listed earlier is preferred when the loads are equal
+        """
+        self._program_name = program_name
+        self._endpoints = endpoints
+        self._running = {endpoint.host: 0 for endpoint in endpoints}
+        self._failures = {endpoint.host: 0 for endpoint in endpoints}
+        self._condition = asyncio.Condition()
+
+    async def acquire(
+            self, exclude: typing.Collection[Endpoint] = ()
+    ) -> typing.Optional[Endpoint]:
+        """
+        Place a job on an endpoint, waiting until an endpoint can take it.
+        The job must be removed from the endpoint with `release` when it
+        finishes.
+
+        :param exclude: the endpoints not to place the job on, like the ones
+            the job has failed on
+        :return: the endpoint, or `None` if no endpoint can ever take the job
+        """
+        async with self._condition:
+            while True:
+                candidates = [endpoint for endpoint in self._endpoints
+                              if endpoint not in exclude and
+                              self._failures[endpoint.host] < _MAX_FAILURES]
+                if not candidates:
+                    return None
+                available = [endpoint for endpoint in candidates
+                             if self._running[endpoint.host] <
+                             endpoint.weight]
+                if available:
+                    endpoint = min(available, key=self._get_load)
+                    self._running[endpoint.host] += 1
+                    return endpoint
+                await self._condition.wait()
+
+    async def release(self, endpoint: Endpoint,
+                      started: typing.Optional[bool] = None) -> None:
+        """
+        Remove a finished job from an endpoint.
+
+        :param endpoint: the endpoint the job was placed on
+        :param started: whether the job's container was started, or `None`
+            if the job did not try to start a container
+        """
+        async with self._condition:
+            self._running[endpoint.host] -= 1
+            if started:
+                self._failures[endpoint.host] = 0
+            elif started is not None:
+                self._failures[endpoint.host] += 1
+                if self._failures[endpoint.host] == _MAX_FAILURES:
+                    print(f"{warn(self._program_name)}: Containers cannot "
+                          f"be started on endpoint {endpoint.host} -- not "
+                          f"using it any more", file=sys.stderr)
+            # Waiting jobs might be able to run, or to give up
+            self._condition.notify_all()
+
+    def _get_load(self, endpoint: Endpoint) -> float:
+        return self._running[endpoint.host] / endpoint.weight
+
+
+async def run_on_endpoints(
+        pool: EndpointPool, program_name: str, retries: int,
+        attempt: typing.Callable[
+            [Endpoint, bool],
+            typing.Awaitable[typing.Optional[
+                tuple[_T, typing.Optional[bool]]]]]
+) -> typing.Optional[_T]:
+    """
+    Run a job on the endpoints in a pool, trying another endpoint when the
+    job's container cannot be started.
+
+    :param pool: the pool to place the job with
+    :param program_name: the program name for messages about the job
+    :param retries: the number of other endpoints to try
+    :param attempt: a coroutine function that runs the job on an endpoint
+        given whether the job can be tried on another endpoint, and returns
+        the job's result along with whether its container was started, as
+        `EndpointPool.release` takes it, or `None` if the container could
+        not be started and the job should be tried on another endpoint
+    :return: the job's result, or `None` if no endpoint can run the job
+    """
+    failed_endpoints = []
+    while True:
+        endpoint = await pool.acquire(failed_endpoints)
+        if endpoint is None:
+            print(f"{error(program_name)}: No endpoint can run the job",
+                  file=sys.stderr)
+            return None
+        print(f"{info(program_name)}: Running on endpoint {endpoint.host}",
+              file=sys.stderr)
+        try:
+            outcome = await attempt(endpoint,
+                                    len(failed_endpoints) < retries)
+        except BaseException:
+            await pool.release(endpoint)
+            raise
+        if outcome is not None:
+            await pool.release(endpoint, outcome[1])
+            return outcome[0]
+        await pool.release(endpoint, False)
+        print(f"{warn(program_name)}: Cannot start container on endpoint "
+              f"{endpoint.host} -- trying another endpoint", file=sys.stderr)
+        failed_endpoints.append(endpoint)
@@ -0,0 +1,377 @@
+#  ebuild-commander Docker Engine API Client Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import http.client
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+# Default path to the Docker Engine API's Unix socket
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+# Stream types in the header of each frame of multiplexed exec output
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
+
+# Maximum number of idle connections kept for reuse
+_MAX_IDLE_CONNECTIONS = 8
+
+# Number of seconds to wait for the exit status of an exec instance after its
+# output ends
+_EXEC_EXIT_TIMEOUT = 10
+
+
+class EngineError(Exception):
+    """
+    An error response from the Docker Engine API.
+    """
+
+    def __init__(self, method: str, path: str, status: int, message: str):
+        super().__init__(f"{method} {path} failed with status {status}: "
+                         f"{message}")
+        self.status = status
+        self.message = message
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str):
+        # The host name only appears in the 'Host' header
+        super().__init__('localhost')
+        self._socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def split_image_name(image: str) -> tuple[str, str]:
+    """
+    Split an image's name into the repository and the tag or digest, as the
+    API's image pull endpoint expects them.
+
+    :param image: the image's name, like in 'docker pull'
+    :return: the repository and the tag or digest, which defaults to 'latest'
+    """
+    if '@' in image:
+        name, _, digest = image.partition('@')
+        return name, digest
+    name, sep, tag = image.rpartition(':')
+    # A colon before the last slash separates a registry's port instead
+    if sep and '/' not in tag:
+        return name, tag
+    return image, 'latest'
+
+
+def read_frames(stream: typing.BinaryIO) \
+        -> typing.Iterator[tuple[int, bytes]]:
+    """
+    Demultiplex the output of an exec instance without a TTY, which consists
+    of frames that each have an 8-byte header holding the stream type and the
+    size of the payload.
+
+    :param stream: the stream to read the frames from
+    :return: an iterator over the stream type and the payload of each frame
+    :raise EOFError: if the stream ends in the middle of a frame
+    """
+    while True:
+        header = _read_exactly(stream, 8)
+        if header is None:
+            return
+        stream_type, size = struct.unpack('>BxxxL', header)
+        payload = _read_exactly(stream, size) if size else b''
+        if payload is None:
+            raise EOFError('incomplete frame in exec output')
+        yield stream_type, payload
+
+
+def _read_exactly(stream: typing.BinaryIO,
+                  size: int) -> typing.Optional[bytes]:
+    """
+    :return: `size` bytes read from the stream, or `None` if the stream ends
+        before any byte is read
+    :raise EOFError: if the stream ends after some bytes are read
+    """
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            if data:
+                raise EOFError('incomplete frame in exec output')
+            return None
+        data += chunk
+    return data
+
+
+class EngineClient:
+    """
+    A client of the Docker Engine API on a Unix socket, which is also provided
+    by Podman, for the container operations `Commandocker` needs.
+
+    Requests reuse idle connections, so most of them do not need a new
+    connection, and the client can be shared by many threads.  Running a
+    command takes over a connection for the command's input and output, which
+    is closed afterwards.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET):
+        """
+        :param socket_path: the path to the API's Unix socket
+        """
+        self._socket_path = socket_path
+        self._lock = threading.Lock()
+        self._idle: list[_UnixHTTPConnection] = []
+
+    @property
+    def socket_path(self) -> str:
+        return self._socket_path
+
+    def create_container(self, name: str, config: dict) -> str:
+        """
+        Create a container.
+
+        :param name: the container's name
+        :param config: the container's configuration, in the API's format
+        :return: the container's ID
+        :raise EngineError: if the API reports an error, e.g. with status 404
+            if the image is not available locally
+        :raise OSError: if the API cannot be reached
+        """
+        result = self._request('POST', '/containers/create', {'name': name},
+                               config)
+        return result['Id']
+
+    def start_container(self, name: str) -> None:
+        """
+        :param name: the container's name or ID
+        :raise EngineError: if the API reports an error
+        :raise OSError: if the API cannot be reached
+        """
+        self._request('POST', f'/containers/{_quote(name)}/start')
+
+    def remove_container(self, name: str) -> None:
+        """
+        Remove a container, stopping it if it is running.
+
+        :param name: the container's name or ID
+        :raise EngineError: if the API reports an error
+        :raise OSError: if the API cannot be reached
+        """
+        self._request('DELETE', f'/containers/{_quote(name)}',
+                      {'force': 'true'})
+
+    def pull_image(self, image: str) -> None:
+        """
+        Pull an image, and wait for the pull to finish.
+
+        :param image: the image's name
+        :raise EngineError: if the API reports an error
+        :raise OSError: if the API cannot be reached
+        """
+        name, tag = split_image_name(image)
+        path = '/images/create'
+        body = self._request('POST', path, {'fromImage': name, 'tag': tag},
+                             parse=False)
+        # The progress of the pull is reported as a sequence of JSON objects,
+        # and a failure only appears as the last one
+        for line in body.splitlines():
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(message, dict) and 'error' in message:
+                raise EngineError('POST', path, 200, str(message['error']))
+
+    def exec(self, container: str, cmd: list[str],
+             input_data: typing.Optional[bytes] = None,
+             output: typing.Optional[typing.BinaryIO] = None) -> int:
+        """
+        Run a command in a running container, and wait for it to finish.
+
+        :param container: the container's name or ID
+        :param cmd: the command's arguments
+        :param input_data: data for the command's standard input (default:
+            no standard input)
+        :param output: the stream to send both the command's standard output
+            and standard error to (default: this program's standard output
+            and standard error respectively)
+        :return: the command's exit status
+        :raise EngineError: if the API reports an error
+        :raise OSError: if the API cannot be reached
+        """
+        exec_id = self._request(
+            'POST', f'/containers/{_quote(container)}/exec',
+            body={'AttachStdin': input_data is not None,
+                  'AttachStdout': True, 'AttachStderr': True, 'Tty': False,
+                  'Cmd': cmd})['Id']
+        path = f'/exec/{_quote(exec_id)}/start'
+        conn = _UnixHTTPConnection(self._socket_path)
+        try:
+            conn.request('POST', path,
+                         json.dumps({'Detach': False, 'Tty': False}),
+                         {'Content-Type': 'application/json',
+                          'Connection': 'Upgrade', 'Upgrade': 'tcp'})
+            # The connection might let go of the socket when the response
+            # does not upgrade it
+            sock = conn.sock
+            response = conn.getresponse()
+            if response.status not in (http.client.OK,
+                                       http.client.SWITCHING_PROTOCOLS):
+                raise EngineError('POST', path, response.status,
+                                  _get_message(response.read()))
+            # The connection now carries the command's input and output; the
+            # response object holds any output that has been buffered
+            stream = response.fp
+            writer = None
+            if input_data is not None:
+                writer = threading.Thread(target=_send_input,
+                                          args=(sock, input_data),
+                                          daemon=True)
+                writer.start()
+            for stream_type, payload in read_frames(stream):
+                _write_frame(stream_type, payload, output)
+            if output is not None:
+                output.flush()
+            if writer is not None:
+                writer.join()
+        finally:
+            conn.close()
+        return self._get_exit_code(exec_id)
+
+    def close(self) -> None:
+        """
+        Close the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _get_exit_code(self, exec_id: str) -> int:
+        deadline = time.monotonic() + _EXEC_EXIT_TIMEOUT
+        while True:
+            result = self._request('GET', f'/exec/{_quote(exec_id)}/json')
+            # The exit status might be set a moment after the output ends
+            if not result.get('Running') and \
+                    result.get('ExitCode') is not None:
+                return result['ExitCode']
+            if time.monotonic() >= deadline:
+                raise EngineError('GET', f'/exec/{exec_id}/json', 200,
+                                  'the command did not exit')
+            time.sleep(0.01)
+
+    def _request(self, method: str, path: str,
+                 query: typing.Optional[dict[str, str]] = None,
+                 body: typing.Optional[dict] = None, parse: bool = True):
+        """
+        Send a request on an idle connection if there is any, or a new one
+        otherwise.
+
+        :return: the parsed JSON response if `parse` is set and the response
+            is not empty, or else the raw response
+        :raise EngineError: if the API reports an error
+        :raise OSError: if the API cannot be reached
+        """
+        url = path
+        if query:
+            url += '?' + urllib.parse.urlencode(query)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, url, data, headers)
+                response = conn.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # The API might have closed an idle connection
+                if reused:
+                    continue
+                raise
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        if response.status >= 300:
+            raise EngineError(method, path, response.status,
+                              _get_message(content))
+        if not parse:
+            return content
+        return json.loads(content) if content.strip() else None
+
+    def _acquire(self) -> tuple[_UnixHTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return _UnixHTTPConnection(self._socket_path), False
+
+    def _release(self, conn: _UnixHTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < _MAX_IDLE_CONNECTIONS:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+def _quote(value: str) -> str:
+    return urllib.parse.quote(value, safe='')
+
+
+def _get_message(content: bytes) -> str:
+    try:
+        return str(json.loads(content)['message'])
+    except (ValueError, KeyError, TypeError):
+        return content.decode(errors='replace').strip()
+
+
+def _send_input(sock: socket.socket, data: bytes) -> None:
+    try:
+        sock.sendall(data)
+        # Closing the connection's sending side closes the command's standard
+        # input
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        # The command has exited without reading all of its input
+        pass
+
+
+def _write_frame(stream_type: int, payload: bytes,
+                 output: typing.Optional[typing.BinaryIO]) -> None:
+    if output is not None:
+        output.write(payload)
+        return
+    target = sys.stderr.buffer if stream_type == STREAM_STDERR \
+        else sys.stdout.buffer
+    target.write(payload)
+    target.flush()
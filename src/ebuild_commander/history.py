@@ -0,0 +1,358 @@
+#  ebuild-commander Build History Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import pathlib
+import re
+import sqlite3
+import statistics
+import sys
+import typing
+
+from ebuild_commander.cache import get_user_cache_dir, hash_key
+from ebuild_commander.out_fmt import error, format_duration
+
+# Path to emerge's log in a container
+EMERGE_LOG_PATH = '/var/log/emerge.log'
+
+# Number of most recent builds or runs estimates are derived from
+_RECENT = 5
+
+# Number of seconds to wait for another process writing to the database
+_LOCK_TIMEOUT = 30
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    package TEXT NOT NULL,
+    version TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    image TEXT NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    binary INTEGER NOT NULL,
+    container TEXT NOT NULL,
+    UNIQUE (container, package, version, start)
+);
+CREATE INDEX IF NOT EXISTS builds_by_package
+    ON builds (package, profile, image, start);
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    image TEXT NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    container TEXT NOT NULL UNIQUE
+);
+CREATE INDEX IF NOT EXISTS runs_by_key ON runs (key, profile, image, start);
+'''
+
+_EMERGE_LOG_LINE = re.compile(r'(?P<time>\d+):\s+(?P<message>.*)')
+
+_BUILD_START = re.compile(r'>>> emerge \(\d+ of \d+\) (?P<cpv>\S+) to ')
+
+_BUILD_END = re.compile(r'::: completed emerge \(\d+ of \d+\) (?P<cpv>\S+) '
+                        r'to ')
+
+_BINARY_MERGE = re.compile(r'=== \(\d+ of \d+\) Merging Binary '
+                           r'\((?P<cpv>[^:\s]+)')
+
+# A version at the end of a package's name, which starts with a digit and
+# may have a revision
+_CPV = re.compile(r'(?P<cp>[^/\s]+/\S+?)-(?P<version>\d[^\s:-]*(?:-r\d+)?)'
+                  r'(?::.*)?$')
+
+
+class Build(typing.NamedTuple):
+    """
+    A merge of a package recorded in emerge's log.
+    """
+    # The package's category and name
+    package: str
+    version: str
+    # The time the merge started, in seconds since the epoch
+    start: float
+    duration: float
+    # Whether a binary package was merged instead of building the package
+    binary: bool
+
+
+class Trend(typing.NamedTuple):
+    """
+    The build durations of a package with a profile and an image, in seconds.
+    """
+    package: str
+    profile: str
+    image: str
+    builds: int
+    last: float
+    median: float
+    minimum: float
+    maximum: float
+    # The median of the builds before the last one, or `None` if there is
+    # only one build
+    previous_median: typing.Optional[float]
+
+
+def split_cpv(cpv: str) -> typing.Optional[tuple[str, str]]:
+    """
+    :param cpv: a package's category, name and version, possibly followed by
+        its slot or repository, like 'sys-libs/zlib-1.2.11-r4::gentoo'
+    :return: the package's category and name, and the version, or `None` if
+        `cpv` does not have a version
+    """
+    match = _CPV.match(cpv)
+    if match is None:
+        return None
+    return match.group('cp'), match.group('version')
+
+
+def parse_emerge_log(text: str, since: float = 0) -> list[Build]:
+    """
+    Find the completed merges in the contents of emerge's log.  Merges that
+    did not complete, e.g. because the build failed, are left out.
+
+    :param text: the contents of the log
+    :param since: the time in seconds since the epoch before which merges
+        that started are left out
+    :return: the merges, in the order they completed
+    """
+    started: dict[str, tuple[float, bool]] = {}
+    builds = []
+    for line in text.splitlines():
+        match = _EMERGE_LOG_LINE.match(line)
+        if match is None:
+            continue
+        timestamp = float(match.group('time'))
+        message = match.group('message')
+        if (match := _BUILD_START.match(message)) is not None:
+            started[match.group('cpv')] = (timestamp, False)
+        elif (match := _BINARY_MERGE.match(message)) is not None:
+            if match.group('cpv') in started:
+                started[match.group('cpv')] = \
+                    (started[match.group('cpv')][0], True)
+        elif (match := _BUILD_END.match(message)) is not None:
+            start, binary = started.pop(match.group('cpv'), (None, False))
+            cpv = split_cpv(match.group('cpv'))
+            if start is None or start < since or cpv is None:
+                continue
+            builds.append(Build(cpv[0], cpv[1], start, timestamp - start,
+                                binary))
+    return builds
+
+
+def get_run_key(commands: typing.Sequence[str]) -> str:
+    """
+    :param commands: the commands a run consists of
+    :return: the key identifying runs of the same commands
+    """
+    return hash_key(*commands)
+
+
+def get_default_history_path() -> pathlib.Path:
+    """
+    :return: the default path to the database of a `BuildHistory`
+    """
+    return get_user_cache_dir() / 'history.sqlite'
+
+
+class BuildHistory:
+    """
+    An append-only record of how long packages took to build and how long
+    runs took, by the profile and the image used, stored in an SQLite
+    database that can be shared by concurrent instances of this program.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        """
+        :param path: the path to the database, which is created if it does
+            not exist
+        """
+        self._path = path
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def add_builds(self, builds: typing.Iterable[Build], profile: str,
+                   image: str, container: str) -> None:
+        """
+        Record merges of packages.  Merges that have been recorded for the
+        same container are ignored.
+
+        :param builds: the merges
+        :param profile: the profile the packages were built with
+        :param image: the image of the container the packages were built in
+        :param container: the container's name
+        :raise sqlite3.Error: if the database cannot be updated
+        :raise OSError: if the database's directory cannot be created
+        """
+        with self._connect() as db:
+            db.executemany(
+                'INSERT OR IGNORE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(build.package, build.version, profile, image, build.start,
+                  build.duration, int(build.binary), container)
+                 for build in builds])
+
+    def add_run(self, key: str, profile: str, image: str, start: float,
+                duration: float, container: str) -> None:
+        """
+        Record a run of commands in a container.
+
+        :param key: the key from `get_run_key` for the commands
+        :param profile: the profile of the container
+        :param image: the image of the container
+        :param start: the time the run started, in seconds since the epoch
+        :param duration: the run's duration in seconds
+        :param container: the container's name
+        :raise sqlite3.Error: if the database cannot be updated
+        :raise OSError: if the database's directory cannot be created
+        """
+        with self._connect() as db:
+            db.execute('INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, profile, image, start, duration, container))
+
+    def estimate_run(self, key: str, profile: str, image: str) \
+            -> typing.Optional[tuple[float, int]]:
+        """
+        Estimate the duration of a run from the most recent runs of the same
+        commands with the same profile and image.
+
+        :return: the estimated duration in seconds and the number of runs it
+            is derived from, or `None` if there is no such run
+        :raise sqlite3.Error: if the database cannot be read
+        :raise OSError: if the database's directory cannot be created
+        """
+        with self._connect() as db:
+            durations = [row[0] for row in db.execute(
+                'SELECT duration FROM runs '
+                'WHERE key = ? AND profile = ? AND image = ? '
+                'ORDER BY start DESC LIMIT ?',
+                (key, profile, image, _RECENT))]
+        if not durations:
+            return None
+        return statistics.median(durations), len(durations)
+
+    def get_build_durations(self, profile: str,
+                            image: str) -> dict[str, float]:
+        """
+        Estimate how long each package recorded with a profile and an image
+        takes to build, from its most recent builds that did not merge a
+        binary package.
+
+        :return: the estimated duration in seconds of each package, by the
+            package's category and name
+        :raise sqlite3.Error: if the database cannot be read
+        :raise OSError: if the database's directory cannot be created
+        """
+        recent: dict[str, list[float]] = {}
+        with self._connect() as db:
+            for package, duration in db.execute(
+                    'SELECT package, duration FROM builds '
+                    'WHERE profile = ? AND image = ? AND binary = 0 '
+                    'ORDER BY start DESC', (profile, image)):
+                durations = recent.setdefault(package, [])
+                if len(durations) < _RECENT:
+                    durations.append(duration)
+        return {package: statistics.median(durations)
+                for package, durations in recent.items()}
+
+    def get_trends(self, package: typing.Optional[str] = None) \
+            -> list[Trend]:
+        """
+        Summarize the builds of packages that did not merge a binary package.
+
+        :param package: if specified, only summarize the builds of the package
+            with this category and name
+        :return: the summary for each package, profile and image, sorted by
+            the package
+        :raise sqlite3.Error: if the database cannot be read
+        :raise OSError: if the database's directory cannot be created
+        """
+        query = 'SELECT package, profile, image, duration FROM builds ' \
+                'WHERE binary = 0'
+        params = ()
+        if package is not None:
+            query += ' AND package = ?'
+            params = (package,)
+        query += ' ORDER BY package, profile, image, start'
+        groups: dict[tuple[str, str, str], list[float]] = {}
+        with self._connect() as db:
+            for row in db.execute(query, params):
+                groups.setdefault(row[:3], []).append(row[3])
+        trends = []
+        for (package, profile, image), durations in groups.items():
+            previous = durations[:-1][-_RECENT:]
+            trends.append(Trend(
+                package, profile, image, len(durations), durations[-1],
+                statistics.median(durations), min(durations),
+                max(durations),
+                statistics.median(previous) if previous else None))
+        return trends
+
+    @contextlib.contextmanager
+    def _connect(self) -> typing.Iterator[sqlite3.Connection]:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self._path, timeout=_LOCK_TIMEOUT)
+        try:
+            with db:
+                db.executescript(_SCHEMA)
+            # Commits the changes unless an exception is raised
+            with db:
+                yield db
+        finally:
+            db.close()
+
+
+def print_trends(program_name: str, history: BuildHistory,
+                 package: typing.Optional[str] = None) -> int:
+    """
+    Print a table of the build durations of packages to standard output.  The
+    last column compares the last build with the median of the builds before
+    it.
+
+    :param program_name: the program name for messages
+    :param history: the build history
+    :param package: if specified, only print the builds of the package with
+        this category and name
+    :return: the exit status for the program
+    """
+    try:
+        trends = history.get_trends(package)
+    except (sqlite3.Error, OSError) as err:
+        print(f"{error(program_name)}: {history.path}: {err}",
+              file=sys.stderr)
+        return 3
+    rows = [('PACKAGE', 'PROFILE', 'IMAGE', 'BUILDS', 'LAST', 'MEDIAN',
+             'MIN', 'MAX', 'TREND')]
+    for trend in trends:
+        change = ''
+        if trend.previous_median:
+            change = f'{(trend.last / trend.previous_median - 1) * 100:+.0f}%'
+        rows.append((trend.package, trend.profile, trend.image,
+                     str(trend.builds), format_duration(trend.last),
+                     format_duration(trend.median),
+                     format_duration(trend.minimum),
+                     format_duration(trend.maximum), change))
+    widths = [max(len(row[col]) for row in rows)
+              for col in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.ljust(width)
+                        for value, width in zip(row, widths)).rstrip())
+    return 0
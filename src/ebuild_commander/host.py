@@ -0,0 +1,220 @@
+#  ebuild-commander Host Resource Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import math
+import os
+import pathlib
+import subprocess
+import typing
+
+# Memory left for each job run by 'make' when sizing a tmpfs, since a tmpfs
+# competes with the compilers for memory
+MEMORY_PER_JOB = 1024 ** 3
+
+# Smallest tmpfs worth mounting for PORTAGE_TMPDIR; the build trees of most
+# packages would not fit in anything smaller
+MIN_TMPFS_SIZE = 1024 ** 3
+
+
+def get_available_memory(
+        meminfo_path: str = '/proc/meminfo') -> typing.Optional[int]:
+    """
+    :param meminfo_path: the path to the meminfo file (default:
+        '/proc/meminfo')
+    :return: the amount of memory in bytes available for starting new
+        applications without swapping, or `None` if it cannot be determined
+    """
+    try:
+        with open(meminfo_path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'MemAvailable:':
+                    return int(fields[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_tmpfs_size(available_memory: int, num_threads: int) -> int:
+    """
+    Determine the size of a tmpfs for PORTAGE_TMPDIR that leaves enough
+    memory for the jobs run by 'make'.
+
+    :param available_memory: the memory in bytes available to the container
+    :param num_threads: the number of jobs 'make' runs at the same time
+    :return: the tmpfs's size in bytes, or 0 if there is not enough memory
+        for a tmpfs
+    """
+    tmpfs_size = available_memory - num_threads * MEMORY_PER_JOB
+    if tmpfs_size < MIN_TMPFS_SIZE:
+        return 0
+    return tmpfs_size
+
+
+class Tuning(typing.NamedTuple):
+    """
+    Settings for building packages in a container that fit the container's
+    share of the host's resources.
+    """
+    # Number of jobs 'make' runs at the same time, for '-j' in MAKEOPTS
+    make_jobs: int
+    # Number of packages emerge builds at the same time, for '--jobs'
+    emerge_jobs: int
+    # Load average above which 'make' and emerge start no new jobs, for '-l'
+    # in MAKEOPTS and emerge's '--load-average'
+    load_average: float
+    # Number of CPUs the container may use, for Docker's '--cpus'
+    cpus: float
+    # Memory in bytes the container may use, for Docker's '--memory'
+    memory: int
+
+
+def get_cgroup_dir(
+        cgroup_root: str = '/sys/fs/cgroup',
+        proc_cgroup_path: str = '/proc/self/cgroup'
+) -> typing.Optional[pathlib.Path]:
+    """
+    :param cgroup_root: the mount point of the cgroup v2 hierarchy (default:
+        '/sys/fs/cgroup')
+    :param proc_cgroup_path: the file listing the cgroups of this process
+        (default: '/proc/self/cgroup')
+    :return: the directory of this process's cgroup v2, or `None` if the
+        cgroup v2 hierarchy is not used
+    """
+    try:
+        with open(proc_cgroup_path) as f:
+            for line in f:
+                hierarchy, _, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0':
+                    return pathlib.Path(cgroup_root, path.lstrip('/'))
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_cgroup_cpu_limit(cgroup_dir: pathlib.Path,
+                         cgroup_root: str = '/sys/fs/cgroup') \
+        -> typing.Optional[float]:
+    """
+    :param cgroup_dir: the directory of a cgroup v2
+    :param cgroup_root: the mount point of the cgroup v2 hierarchy (default:
+        '/sys/fs/cgroup')
+    :return: the number of CPUs the cgroup and its ancestors may use, or
+        `None` if there is no limit
+    """
+    limits = []
+    for value in _read_cgroup_files(cgroup_dir, cgroup_root, 'cpu.max'):
+        quota, _, period = value.partition(' ')
+        if quota != 'max' and quota.isdigit() and period.isdigit():
+            limits.append(int(quota) / int(period))
+    return min(limits, default=None)
+
+
+def get_cgroup_memory_limit(cgroup_dir: pathlib.Path,
+                            cgroup_root: str = '/sys/fs/cgroup') \
+        -> typing.Optional[int]:
+    """
+    :param cgroup_dir: the directory of a cgroup v2
+    :param cgroup_root: the mount point of the cgroup v2 hierarchy (default:
+        '/sys/fs/cgroup')
+    :return: the memory in bytes the cgroup and its ancestors may use, or
+        `None` if there is no limit
+    """
+    limits = [int(value) for value in
+              _read_cgroup_files(cgroup_dir, cgroup_root, 'memory.max')
+              if value.isdigit()]
+    return min(limits, default=None)
+
+
+def _read_cgroup_files(cgroup_dir: pathlib.Path, cgroup_root: str,
+                       name: str) -> list[str]:
+    """
+    :return: the stripped contents of the files with the name in the cgroup's
+        directory and its ancestors that can be read and parsed
+    """
+    values = []
+    root = pathlib.Path(cgroup_root)
+    path = cgroup_dir
+    while True:
+        try:
+            values.append((path / name).read_text().strip())
+        except OSError:
+            pass
+        if path == root or path == path.parent:
+            break
+        path = path.parent
+    return [value for value in values if value]
+
+
+def count_running_containers(docker_cmd: str, name_prefix: str) -> int:
+    """
+    :param docker_cmd: the executable providing Docker functionalities
+    :param name_prefix: the prefix of the names of the containers to count
+    :return: the number of running containers whose names start with the
+        prefix, or 0 if it cannot be determined
+    """
+    result = subprocess.run([docker_cmd, 'ps', '--format', '{{.Names}}'],
+                            stdin=subprocess.DEVNULL, capture_output=True,
+                            text=True)
+    if result.returncode != 0:
+        return 0
+    return sum(1 for name in result.stdout.split()
+               if name.startswith(name_prefix))
+
+
+def get_tuning(cpus: float, available_memory: int, load: float,
+               num_running: int, num_new: int) -> Tuning:
+    """
+    Divide the host's resources among containers.
+
+    Each new container gets an even share of the CPUs among all containers,
+    running or new, but no more than its share of the CPUs that are idle now.
+    Its share of the available memory, which already excludes the memory used
+    by running containers, bounds the total number of jobs, leaving
+    `MEMORY_PER_JOB` for each.  The jobs are split between emerge and 'make'
+    so that their product stays within the total, and both stop starting new
+    jobs when the host's load reaches its number of CPUs.
+
+    :param cpus: the number of CPUs available on the host
+    :param available_memory: the memory in bytes available on the host
+    :param load: the host's current load average
+    :param num_running: the number of containers already running on the host
+    :param num_new: the number of containers to be started
+    :return: the settings for each new container
+    """
+    num_new = max(1, num_new)
+    idle_cpus = max(1.0, cpus - load)
+    share_cpus = max(1.0, min(cpus / (num_running + num_new),
+                              idle_cpus / num_new))
+    share_memory = available_memory // num_new
+    num_jobs = max(1, min(int(share_cpus), share_memory // MEMORY_PER_JOB))
+    emerge_jobs = math.isqrt(num_jobs)
+    return Tuning(num_jobs // emerge_jobs, emerge_jobs, float(cpus),
+                  round(share_cpus, 2), share_memory)
+
+
+def get_cpu_count() -> int:
+    """
+    :return: the number of CPUs this process may run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
@@ -0,0 +1,312 @@
+#  ebuild-commander Job Setup Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import argparse
+import functools
+import os
+import pathlib
+import sqlite3
+import sys
+import typing
+
+import ebuild_commander.cli
+
+from ebuild_commander.cache import CacheDir
+from ebuild_commander.docker import Commandocker
+from ebuild_commander.endpoints import Endpoint
+from ebuild_commander.engine import EngineClient
+from ebuild_commander.history import BuildHistory, \
+    get_default_history_path, get_run_key
+from ebuild_commander.host import Tuning, count_running_containers, \
+    get_available_memory, get_cgroup_cpu_limit, get_cgroup_dir, \
+    get_cgroup_memory_limit, get_cpu_count, get_tmpfs_size, get_tuning
+from ebuild_commander.layer import LayerCache, get_default_index_path
+from ebuild_commander.log import LogDir
+from ebuild_commander.matrix import Cell, get_cells
+from ebuild_commander.out_fmt import info, warn, format_size
+from ebuild_commander.pull import PULL_ALWAYS, PullPolicy, PullRecords, \
+    get_default_records_path
+from ebuild_commander.timing import TimingRecorder
+
+# Exit status of a job stopped by SIGINT
+EXIT_SIGINT = 130
+
+
+def get_job_cells(opts: argparse.Namespace) -> list[Cell]:
+    """
+    :param opts: the parsed command-line arguments
+    :return: the cell for each combination of the profiles, images and
+        configuration sets in the options, with the defaults for those not
+        given
+    """
+    config_sets = opts.config_set
+    if config_sets is None:
+        portage_configs = opts.portage_config
+        if portage_configs is None:
+            portage_configs = [pathlib.Path('/etc/portage')]
+        config_sets = [portage_configs]
+    profiles = opts.profile
+    if profiles is None:
+        profiles = [ebuild_commander.cli.DEFAULT_PROFILE]
+    docker_images = opts.docker_image
+    if docker_images is None:
+        docker_images = [ebuild_commander.cli.DEFAULT_DOCKER_IMAGE]
+    return get_cells(profiles, docker_images, config_sets)
+
+
+def is_cleanup_needed(opts: argparse.Namespace, status: int) -> bool:
+    """
+    :param opts: the parsed command-line arguments
+    :param status: the exit status of the job run in the container
+    :return: whether the container should be removed according to the
+        clean-up option
+    """
+    return opts.skip_cleanup == 'never' or \
+        (opts.skip_cleanup == 'on-fail' and
+            (status == 0 or status == EXIT_SIGINT))
+
+
+def create_job_container(
+        program_name: str, container_name: str, opts: argparse.Namespace,
+        docker_cmd: str, cell: Cell, num_threads: int,
+        tmpfs_size: typing.Optional[int],
+        recorder: typing.Optional[TimingRecorder], output=None,
+        container_type: typing.Type[Commandocker] = Commandocker,
+        tuning: typing.Optional[Tuning] = None,
+        endpoint: typing.Optional[Endpoint] = None) -> Commandocker:
+    """
+    Create the object for a container that runs a job with the settings in
+    the options.  Each container gets its own objects for the caches.
+
+    :param program_name: the program name for messages
+    :param container_name: the container's name
+    :param opts: the parsed command-line arguments
+    :param docker_cmd: the executable providing Docker functionalities
+    :param cell: the profile, image and configuration set to use
+    :param num_threads: the number of threads for the container
+    :param tmpfs_size: the size of the tmpfs for PORTAGE_TMPDIR in bytes, or
+        `None` if no tmpfs should be used
+    :param recorder: the recorder for timing, if any
+    :param output: the stream for the output of the container's commands
+        (default: standard output)
+    :param container_type: the class of the object (default: `Commandocker`)
+    :param tuning: the build settings from auto-tuning, if any
+    :param endpoint: the endpoint `docker_cmd` uses, if any
+    :return: the object for the container, which has not been started
+    """
+    custom_repos = opts.custom_repo
+    if custom_repos is None:
+        custom_repos = []
+
+    # Each container needs its own objects for the caches to hold locks on
+    binpkg_cache = None
+    if opts.binpkg_cache is not None:
+        binpkg_cache = CacheDir(opts.binpkg_cache, opts.binpkg_cache_size)
+    distfiles_cache = None
+    if opts.distfiles_cache is not None:
+        distfiles_cache = CacheDir(opts.distfiles_cache,
+                                   opts.distfiles_cache_size)
+    ccache = None
+    if opts.ccache is not None:
+        ccache = CacheDir(opts.ccache)
+    metadata_cache = None
+    if opts.metadata_cache is not None:
+        metadata_cache = CacheDir(opts.metadata_cache,
+                                  opts.metadata_cache_size)
+    layer_cache = None
+    if opts.layer_cache:
+        layer_cache = LayerCache(docker_cmd, get_default_index_path(),
+                                 opts.layer_cache_max_layers,
+                                 opts.layer_cache_size)
+    engine = None
+    if opts.docker_socket is not None:
+        engine = _get_engine(str(opts.docker_socket))
+    log_dir = None
+    if opts.log_dir is not None:
+        log_dir = LogDir(opts.log_dir, opts.log_tail)
+    pull_policy = opts.pull_policy
+    if pull_policy is None and opts.pull:
+        pull_policy = PullPolicy(PULL_ALWAYS)
+
+    return container_type(
+        program_name,
+        container_name,
+        cell.portage_configs,
+        cell.profile,
+        opts.gentoo_repo,
+        custom_repos,
+        num_threads,
+        opts.emerge_opts,
+        cell.docker_image,
+        opts.pull,
+        opts.storage_opt,
+        docker_cmd,
+        use_session=opts.persistent_shell,
+        binpkg_cache=binpkg_cache,
+        distfiles_cache=distfiles_cache,
+        ccache=ccache,
+        ccache_size=opts.ccache_size,
+        metadata_cache=metadata_cache,
+        tmpfs_size=tmpfs_size,
+        tmpfs_excludes=opts.tmpfs_exclude,
+        tuning=tuning,
+        use_snapshots=opts.snapshot,
+        layer_cache=layer_cache,
+        pull_policy=pull_policy,
+        pull_records=PullRecords(get_default_records_path(
+            endpoint.host if endpoint is not None else None)),
+        log_dir=log_dir,
+        engine=engine,
+        background_cleanup=opts.background_cleanup,
+        kept=opts.skip_cleanup != 'never',
+        build_history=get_build_history(opts),
+        output=output,
+        recorder=recorder
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_engine(socket_path: str) -> EngineClient:
+    """
+    :return: the client for the Docker Engine API on the socket, which is
+        shared by all containers so they can reuse its connections
+    """
+    return EngineClient(socket_path)
+
+
+def get_build_history(
+        opts: argparse.Namespace) -> typing.Optional[BuildHistory]:
+    """
+    :param opts: the parsed command-line arguments
+    :return: the build history, or `None` if it is not used
+    """
+    if not opts.history:
+        return None
+    return BuildHistory(get_default_history_path())
+
+
+def get_run_estimates(program_name: str, opts: argparse.Namespace,
+                      cells: list[Cell],
+                      script_lines: list[tuple[str, list[str]]]
+                      ) -> typing.Optional[list[typing.Optional[float]]]:
+    """
+    :return: the estimated duration of running the scripts with each cell, or
+        `None` if the build history is not used or cannot be read
+    """
+    history = get_build_history(opts)
+    if history is None:
+        return None
+    key = get_run_key([line for _, lines in script_lines for line in lines])
+    estimates = []
+    for cell in cells:
+        try:
+            estimate = history.estimate_run(key, cell.profile,
+                                            cell.docker_image)
+        except (sqlite3.Error, OSError) as err:
+            print(f"{warn(program_name)}: Cannot read build history "
+                  f"{history.path}: {err}", file=sys.stderr)
+            return None
+        estimates.append(None if estimate is None else estimate[0])
+    return estimates
+
+
+def get_job_tuning(program_name: str, opts: argparse.Namespace,
+                   docker_cmd: str,
+                   num_containers: int) -> typing.Optional[Tuning]:
+    """
+    Determine the build settings for each container from the host's
+    resources if auto-tuning is enabled.
+
+    :param program_name: the program name for messages
+    :param opts: the parsed command-line arguments
+    :param docker_cmd: the executable providing Docker functionalities
+    :param num_containers: the number of containers that will run at the
+        same time
+    :return: the build settings, or `None` if auto-tuning is disabled or the
+        memory available cannot be determined
+    """
+    if not opts.auto_tune:
+        return None
+    available_memory = get_available_memory()
+    if available_memory is None:
+        print(f"{warn(program_name)}: Cannot determine the memory available "
+              f"on the host -- not auto-tuning", file=sys.stderr)
+        return None
+    cpus = get_cpu_count()
+    cgroup_dir = get_cgroup_dir()
+    if cgroup_dir is not None:
+        cpu_limit = get_cgroup_cpu_limit(cgroup_dir)
+        if cpu_limit is not None:
+            cpus = min(cpus, cpu_limit)
+        memory_limit = get_cgroup_memory_limit(cgroup_dir)
+        if memory_limit is not None:
+            available_memory = min(available_memory, memory_limit)
+    num_running = count_running_containers(docker_cmd, f'{program_name}-')
+    tuning = get_tuning(cpus, available_memory, os.getloadavg()[0],
+                        num_running, num_containers)
+    print(f"{info(program_name)}: Auto-tuned for {num_running} running "
+          f"container(s): MAKEOPTS -j{tuning.make_jobs} "
+          f"-l{tuning.load_average:g}, emerge --jobs={tuning.emerge_jobs}, "
+          f"{tuning.cpus:g} CPU(s) and {format_size(tuning.memory)} of "
+          f"memory per container", file=sys.stderr)
+    return tuning
+
+
+def get_job_tmpfs_size(program_name: str, opts: argparse.Namespace,
+                       num_threads: int, num_containers: int,
+                       tuning: typing.Optional[Tuning] = None
+                       ) -> typing.Optional[int]:
+    """
+    Determine the size of the tmpfs for PORTAGE_TMPDIR in each container.
+
+    :param program_name: the program name for messages
+    :param opts: the parsed command-line arguments
+    :param num_threads: the number of threads for each container
+    :param num_containers: the number of containers that run at the same time
+        and share the memory on the host
+    :param tuning: the build settings for each container from auto-tuning,
+        whose memory limit is shared by the tmpfs and the jobs
+    :return: the tmpfs's size in bytes, or `None` if no tmpfs should be used
+    """
+    if not opts.tmpfs:
+        return None
+    if opts.tmpfs_size is not None:
+        return opts.tmpfs_size
+    if tuning is not None:
+        memory = tuning.memory
+        num_jobs = tuning.make_jobs * tuning.emerge_jobs
+    else:
+        available_memory = get_available_memory()
+        if available_memory is None:
+            print(f"{warn(program_name)}: Cannot determine the memory "
+                  f"available on the host -- building packages on disk",
+                  file=sys.stderr)
+            return None
+        memory = available_memory // num_containers
+        num_jobs = num_threads
+    tmpfs_size = get_tmpfs_size(memory, num_jobs)
+    if tmpfs_size == 0:
+        print(f"{warn(program_name)}: Not enough memory available on the "
+              f"host for a tmpfs -- building packages on disk",
+              file=sys.stderr)
+        return None
+    print(f"{info(program_name)}: Building packages in a tmpfs of "
+          f"{format_size(tmpfs_size)}", file=sys.stderr)
+    return tmpfs_size
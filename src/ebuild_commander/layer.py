@@ -0,0 +1,243 @@
+#  ebuild-commander Layer Cache Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import fcntl
+import os
+import pathlib
+import subprocess
+import typing
+
+from ebuild_commander.cache import get_user_cache_dir, hash_key
+
+# Repository name of the images that store layers
+LAYER_REPOSITORY = 'ebuild-commander-layer'
+
+# Default maximum number of layers kept
+DEFAULT_MAX_LAYERS = 50
+
+_LOCK_FILE_NAME = '.lock'
+
+
+def get_layer_name(key: str) -> str:
+    """
+    :param key: the layer's key
+    :return: the image name of the layer for the key
+    """
+    return f'{LAYER_REPOSITORY}:{key}'
+
+
+def is_noop(cmd: str) -> bool:
+    """
+    :param cmd: a line of a script
+    :return: whether the line is empty or a comment, which does not change the
+        container and thus does not get a layer
+    """
+    cmd = cmd.strip()
+    return not cmd or cmd.startswith('#')
+
+
+def get_layer_key(parent_key: str, cmd: str) -> str:
+    """
+    :param parent_key: the key of the layer or the configured container the
+        command is run on
+    :param cmd: the command
+    :return: the key of the layer holding the container's state after the
+        command succeeds
+    """
+    return hash_key(parent_key, cmd.rstrip('\n'))
+
+
+def find_deepest_layer(base_key: str, cmds: typing.Sequence[str],
+                       available: typing.Container[str]) \
+        -> tuple[int, typing.Optional[str]]:
+    """
+    Find the layer for the longest prefix of the commands that is available.
+
+    :param base_key: the key identifying the configured container the
+        commands are run on
+    :param cmds: the commands
+    :param available: the keys of the layers available
+    :return: the number of commands in the prefix, and the key of the layer
+        for the prefix; `(0, None)` if no layer is available
+    """
+    key = base_key
+    deepest = (0, None)
+    for i, cmd in enumerate(cmds, start=1):
+        if not is_noop(cmd):
+            key = get_layer_key(key, cmd)
+        # A layer may be available even if layers for shorter prefixes have
+        # been evicted
+        if key in available:
+            deepest = (i, key)
+    return deepest
+
+
+def get_default_index_path() -> pathlib.Path:
+    """
+    :return: the default directory for the index of a `LayerCache`
+    """
+    return get_user_cache_dir() / 'layers'
+
+
+class LayerCache:
+    """
+    Images committed from containers after each successful command, so a
+    later run of the same commands can start from the state after the longest
+    prefix of the commands that has been run before.
+
+    The key of a layer is derived from the key of its parent, which is either
+    the layer for the previous command or the configured container, and the
+    command, like the cache of 'docker build'.  The layers are stored as
+    images in `LAYER_REPOSITORY`, and an index on the host records when each
+    layer was last used and how much disk space it takes, so the least
+    recently used layers can be evicted once the cache is over its limits.
+    """
+
+    def __init__(self, docker_cmd: str, index_path: pathlib.Path,
+                 max_layers: int = DEFAULT_MAX_LAYERS,
+                 max_size: typing.Optional[int] = None):
+        """
+        :param docker_cmd: the executable providing Docker functionalities
+        :param index_path: the directory of the index
+        :param max_layers: the maximum number of layers to keep
+        :param max_size: the maximum total size of the layers in bytes
+            (default: no limit)
+        """
+        self._docker_cmd = docker_cmd
+        self._index_path = index_path
+        self._max_layers = max_layers
+        self._max_size = max_size
+
+    def list_keys(self) -> set[str]:
+        """
+        :return: the keys of the layers available locally
+        :raise subprocess.CalledProcessError: if a Docker command failed
+        """
+        result = subprocess.run([self._docker_cmd, 'image', 'ls', '--format',
+                                 '{{.Repository}}:{{.Tag}}', LAYER_REPOSITORY],
+                                check=True, stdin=subprocess.DEVNULL,
+                                capture_output=True, text=True)
+        prefix = f'{LAYER_REPOSITORY}:'
+        return {name[len(prefix):] for name in result.stdout.split()
+                if name.startswith(prefix)}
+
+    def use(self, key: str) -> None:
+        """
+        Mark a layer as recently used.
+
+        :param key: the layer's key
+        """
+        try:
+            os.utime(self._index_path / key)
+        except OSError:
+            # The layer was created by an older index or before the index was
+            # removed, so its size is unknown; it will be evicted first
+            pass
+
+    def add(self, container_name: str, key: str, parent_image: str) -> bool:
+        """
+        Commit a container to a layer.
+
+        :param container_name: the container's name
+        :param key: the layer's key
+        :param parent_image: the image the container was created from, for
+            determining the disk space the layer takes
+        :return: whether or not the layer is successfully created
+        """
+        name = get_layer_name(key)
+        if subprocess.run([self._docker_cmd, 'commit', container_name, name],
+                          stdin=subprocess.DEVNULL,
+                          stdout=subprocess.DEVNULL).returncode != 0:
+            return False
+        layer_size = self._get_image_size(name)
+        parent_size = self._get_image_size(parent_image)
+        size = 0
+        if layer_size is not None and parent_size is not None:
+            size = max(0, layer_size - parent_size)
+        try:
+            self._index_path.mkdir(parents=True, exist_ok=True)
+            (self._index_path / key).write_text(f'{size}\n')
+        except OSError:
+            pass
+        return True
+
+    def evict(self, keep: typing.Iterable[str] = ()) -> list[str]:
+        """
+        Remove the least recently used layers until the cache is within its
+        limits.
+
+        :param keep: keys of layers that must not be removed
+        :return: the keys of the removed layers
+        :raise OSError: if the index cannot be locked
+        :raise subprocess.CalledProcessError: if the layers cannot be listed
+        """
+        keep = set(keep)
+        with self._lock():
+            layers = []
+            total_size = 0
+            for key in self.list_keys():
+                try:
+                    st = (self._index_path / key).stat()
+                    size = int((self._index_path / key).read_text())
+                    last_use = st.st_mtime
+                except (OSError, ValueError):
+                    size = 0
+                    last_use = 0
+                total_size += size
+                layers.append((last_use, key, size))
+            layers.sort()
+            num_layers = len(layers)
+            evicted = []
+            for _, key, size in layers:
+                if num_layers <= self._max_layers and \
+                        (self._max_size is None
+                         or total_size <= self._max_size):
+                    break
+                if key in keep:
+                    continue
+                if subprocess.run([self._docker_cmd, 'image', 'rm',
+                                   get_layer_name(key)],
+                                  stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL).returncode != 0:
+                    continue
+                (self._index_path / key).unlink(missing_ok=True)
+                num_layers -= 1
+                total_size -= size
+                evicted.append(key)
+            return evicted
+
+    @contextlib.contextmanager
+    def _lock(self) -> typing.Iterator[None]:
+        self._index_path.mkdir(parents=True, exist_ok=True)
+        with open(self._index_path / _LOCK_FILE_NAME, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _get_image_size(self, image: str) -> typing.Optional[int]:
+        result = subprocess.run([self._docker_cmd, 'image', 'inspect',
+                                 '--format', '{{.Size}}', image],
+                                stdin=subprocess.DEVNULL,
+                                capture_output=True, text=True)
+        try:
+            return int(result.stdout.strip())
+        except ValueError:
+            return None
@@ -0,0 +1,328 @@
+#  ebuild-commander Leftover Container Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import typing
+
+from ebuild_commander.out_fmt import info, warn, error
+
+# Label storing the time a container was created, in seconds since the epoch
+LABEL_CREATED = 'io.github.leo3418.ebuild-commander.created'
+
+# Label storing the host name of the machine of the process that created a
+# container
+LABEL_HOST = 'io.github.leo3418.ebuild-commander.host'
+
+# Label storing the PID of the process that created a container
+LABEL_PID = 'io.github.leo3418.ebuild-commander.pid'
+
+# Label marking a container created with a --skip-cleanup setting that may
+# keep it after its job, on purpose
+LABEL_KEPT = 'io.github.leo3418.ebuild-commander.kept'
+
+# Age in seconds after which a container that may have been kept on purpose,
+# or whose creator cannot be checked, like one created on another host or by
+# an older version, is treated as left behind
+STALE_AGE = 7 * 24 * 3600
+
+# Maximum number of containers removed at the same time
+_MAX_PARALLEL_REMOVALS = 8
+
+
+class LeftoverContainer(typing.NamedTuple):
+    name: str
+    # The time the container was created, in seconds since the epoch
+    created: float
+    # Whether the process that created the container is still running, which
+    # might still be using the container
+    in_use: bool
+    # Whether the process that created the container is known to have exited,
+    # which can only be checked for processes on this host
+    exited: bool = False
+    # Whether the container may have been kept on purpose by --skip-cleanup
+    kept: bool = False
+
+
+def get_labels(kept: bool = False) -> dict[str, str]:
+    """
+    :param kept: whether the container may be kept on purpose after its job
+    :return: the labels to add to a container created by this process, with
+        which leftover containers can be found later
+    """
+    labels = {
+        LABEL_CREATED: str(int(time.time())),
+        LABEL_HOST: socket.gethostname(),
+        LABEL_PID: str(os.getpid()),
+    }
+    if kept:
+        labels[LABEL_KEPT] = 'true'
+    return labels
+
+
+def remove_in_background(docker_cmd: str, names: list[str]) -> bool:
+    """
+    Start removing containers without waiting for the removal to finish.  The
+    removal goes on after this program exits, and it is not stopped by
+    signals sent to this program's process group, like the one for Ctrl-C.
+
+    :param docker_cmd: the executable providing Docker functionalities
+    :param names: the containers' names
+    :return: whether the removal has been started
+    """
+    # The shell exits right after starting the command in the background, so
+    # nothing is left for this program to wait for
+    args = ['sh', '-c', '"$@" > /dev/null 2>&1 &', 'sh',
+            docker_cmd, 'rm', '-f', *names]
+    try:
+        return subprocess.run(args, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL,
+                              start_new_session=True).returncode == 0
+    except OSError:
+        return False
+
+
+def list_leftover_containers(docker_cmd: str,
+                             program_name: str) -> list[LeftoverContainer]:
+    """
+    Find the containers created by this program, either with the labels from
+    `get_labels` or with a name that starts with the program name followed by
+    a timestamp, which is what earlier versions created.
+
+    :param docker_cmd: the executable providing Docker functionalities
+    :param program_name: the program name the containers' names start with
+    :return: the containers, in no particular order
+    :raise subprocess.CalledProcessError: if a Docker command failed
+    """
+    def list_names(*filters: str) -> list[str]:
+        args = [docker_cmd, 'ps', '--all', '--format', '{{.Names}}']
+        for value in filters:
+            args.extend(('--filter', value))
+        result = subprocess.run(args, check=True, stdin=subprocess.DEVNULL,
+                                capture_output=True, text=True)
+        return result.stdout.split()
+
+    name_pattern = _get_name_pattern(program_name)
+    names = set(list_names(f'label={LABEL_CREATED}'))
+    names.update(name for name in list_names()
+                 if name_pattern.match(name) is not None)
+    if not names:
+        return []
+    names = sorted(names)
+    result = subprocess.run([docker_cmd, 'container', 'inspect', *names],
+                            check=True, stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True)
+    containers = []
+    for name, container in zip(names, json.loads(result.stdout)):
+        labels = (container.get('Config') or {}).get('Labels') or {}
+        leftover = _get_leftover(name, labels, name_pattern)
+        if leftover is not None:
+            containers.append(leftover)
+    return containers
+
+
+def select_containers(containers: list[LeftoverContainer],
+                      max_age: typing.Optional[float] = None,
+                      keep: typing.Optional[int] = None,
+                      remove_all: bool = False,
+                      now: typing.Optional[float] = None) \
+        -> list[LeftoverContainer]:
+    """
+    Select the leftover containers to remove.  Containers whose creators are
+    still running are never selected.  Unless `remove_all` is true, neither
+    are containers that may have been kept on purpose, or whose creators
+    cannot be checked, and that are not older than `STALE_AGE`.
+
+    :param containers: the leftover containers
+    :param max_age: if specified, select the containers created more than
+        this many seconds ago
+    :param keep: if specified, select all containers except for this many
+        most recently created ones
+    :param remove_all: whether every container whose creator is not running
+        can be selected
+    :param now: the current time in seconds since the epoch (default: the
+        time this function is called)
+    :return: the selected containers, from the oldest to the newest; if
+        neither `max_age` nor `keep` is specified, all containers that can be
+        selected are
+    """
+    if now is None:
+        now = time.time()
+
+    def is_left_behind(container: LeftoverContainer) -> bool:
+        if container.in_use:
+            return False
+        if remove_all:
+            return True
+        return (container.exited and not container.kept) or \
+            now - container.created > STALE_AGE
+
+    unused = sorted(filter(is_left_behind, containers),
+                    key=lambda container: container.created, reverse=True)
+    if max_age is None and keep is None:
+        return unused[::-1]
+    selected = []
+    for i, container in enumerate(unused):
+        if (max_age is not None and now - container.created > max_age) or \
+                (keep is not None and i >= keep):
+            selected.append(container)
+    return selected[::-1]
+
+
+def remove_containers(program_name: str, docker_cmd: str,
+                      names: list[str]) -> int:
+    """
+    Remove containers, several of them at the same time.
+
+    :param program_name: the program name for messages
+    :param docker_cmd: the executable providing Docker functionalities
+    :param names: the containers' names
+    :return: the number of containers that cannot be removed
+    """
+    async def remove(name: str, semaphore: asyncio.Semaphore) -> bool:
+        async with semaphore:
+            process = await asyncio.create_subprocess_exec(
+                docker_cmd, 'rm', '-f', name, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            returncode = await process.wait()
+        if returncode == 0:
+            print(f"{info(program_name)}: Removed container {name}",
+                  file=sys.stderr)
+            return True
+        print(f"{warn(program_name)}: Cannot remove container {name}",
+              file=sys.stderr)
+        return False
+
+    async def remove_all() -> list[bool]:
+        semaphore = asyncio.Semaphore(_MAX_PARALLEL_REMOVALS)
+        return list(await asyncio.gather(
+            *(remove(name, semaphore) for name in names)))
+
+    if not names:
+        return 0
+    return asyncio.run(remove_all()).count(False)
+
+
+def gc_containers(program_name: str, docker_cmd: str,
+                  max_age: typing.Optional[float],
+                  keep: typing.Optional[int],
+                  remove_all: bool = False) -> int:
+    """
+    Remove the containers left behind by earlier runs of this program, e.g.
+    because the runs were killed.  Containers that may have been kept on
+    purpose are only removed if they are older than `STALE_AGE` or if
+    `remove_all` is true.
+
+    :param program_name: the program name for messages, which the containers'
+        names also start with
+    :param docker_cmd: the executable providing Docker functionalities
+    :param max_age: if specified, only remove the containers created more
+        than this many seconds ago, unless they exceed `keep`
+    :param keep: if specified, keep this many most recently created containers
+        unless they exceed `max_age`
+    :param remove_all: whether to also remove the recent containers that
+        may have been kept on purpose, and the ones whose creators cannot be
+        checked
+    :return: the exit status for the program
+    """
+    try:
+        containers = list_leftover_containers(docker_cmd, program_name)
+    except subprocess.CalledProcessError as err:
+        print(f"{error(program_name)}: Command {err.cmd} failed with "
+              f"exit status {err.returncode}", file=sys.stderr)
+        return 3
+    now = time.time()
+    in_use = sum(container.in_use for container in containers)
+    if in_use:
+        print(f"{info(program_name)}: Skipping {in_use} container(s) of "
+              f"running processes", file=sys.stderr)
+    if not remove_all:
+        recent = len(containers) - in_use - \
+            len(select_containers(containers, now=now))
+        if recent:
+            print(f"{info(program_name)}: Skipping {recent} recent "
+                  f"container(s) that may have been kept on purpose; use "
+                  f"--gc-all to remove them", file=sys.stderr)
+    selected = select_containers(containers, max_age, keep, remove_all, now)
+    print(f"{info(program_name)}: Removing {len(selected)} of "
+          f"{len(containers) - in_use} leftover container(s)...",
+          file=sys.stderr)
+    failures = remove_containers(program_name, docker_cmd,
+                                 [container.name for container in selected])
+    return 1 if failures else 0
+
+
+def _get_name_pattern(program_name: str) -> typing.Pattern:
+    # Names are followed by a timestamp, then optionally by the PID of the
+    # process that created the container and a number, or only by a number
+    return re.compile(rf'{re.escape(program_name)}-'
+                      rf'(?P<timestamp>\d{{8}}-\d{{6}})'
+                      rf'(?:-(?P<pid>\d+)-\d+|-\d+)?$')
+
+
+def _get_leftover(name: str, labels: dict[str, str],
+                  name_pattern: typing.Pattern) \
+        -> typing.Optional[LeftoverContainer]:
+    """
+    :return: the information about a container from its labels, or from its
+        name if it does not have the labels, or `None` if neither is usable
+    """
+    pid = None
+    kept = False
+    if LABEL_CREATED in labels:
+        try:
+            created = float(labels[LABEL_CREATED])
+        except ValueError:
+            return None
+        # A PID from another host does not identify a process on this host
+        if labels.get(LABEL_HOST) == socket.gethostname():
+            pid = labels.get(LABEL_PID)
+        kept = LABEL_KEPT in labels
+    else:
+        match = name_pattern.match(name)
+        if match is None:
+            return None
+        created = time.mktime(time.strptime(match.group('timestamp'),
+                                            '%Y%m%d-%H%M%S'))
+        pid = match.group('pid')
+    running = pid is not None and _is_running(pid)
+    return LeftoverContainer(name, created, running,
+                             pid is not None and not running, kept)
+
+
+def _is_running(pid: str) -> bool:
+    try:
+        pid = int(pid)
+        # Signals to PIDs that are not positive go to groups of processes
+        if pid <= 0:
+            return False
+        os.kill(pid, 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
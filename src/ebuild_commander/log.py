@@ -0,0 +1,130 @@
+#  ebuild-commander Command Log Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import collections
+import gzip
+import os
+import pathlib
+import threading
+import typing
+
+from ebuild_commander.timing import Origin
+
+# Default number of lines of a command's output kept in memory for showing
+# when the command fails
+DEFAULT_TAIL_LINES = 20
+
+# Longest incomplete line kept for the tail; the beginning of a longer line is
+# dropped
+_MAX_LINE_LENGTH = 65536
+
+
+class CommandLog:
+    """
+    A binary stream that compresses a command's output into a log file as it
+    is written, keeping only the last lines in memory.
+    """
+
+    def __init__(self, path: pathlib.Path, cmd: str, tail_lines: int):
+        """
+        :param path: the log file's path
+        :param cmd: the command, which is written to the log file first
+        :param tail_lines: the number of lines to keep in memory
+        :raise OSError: if the log file cannot be created
+        """
+        self._path = path
+        self._file = gzip.open(path, 'wb')
+        self._file.write(f'$ {cmd.rstrip()}\n'.encode())
+        self._tail = collections.deque(maxlen=tail_lines)
+        self._partial = b''
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def write(self, data: bytes) -> int:
+        self._file.write(data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()[-_MAX_LINE_LENGTH:]
+        self._tail.extend(line[-_MAX_LINE_LENGTH:] for line in lines)
+        return len(data)
+
+    def flush(self) -> None:
+        # Flushing a compressed stream often would hurt compression, and the
+        # log file is complete once it is closed
+        pass
+
+    def close(self) -> None:
+        self._file.close()
+
+    def get_tail(self) -> list[bytes]:
+        """
+        :return: the last lines written, without line terminators, including
+            any incomplete last line
+        """
+        tail = collections.deque(self._tail, maxlen=self._tail.maxlen)
+        if self._partial:
+            tail.append(self._partial)
+        return list(tail)
+
+
+class LogDir:
+    """
+    A directory on the host that holds a compressed log file for each command
+    run in each container, under a subdirectory named after the container.
+    """
+
+    def __init__(self, path: pathlib.Path,
+                 tail_lines: int = DEFAULT_TAIL_LINES):
+        """
+        :param path: the directory's path
+        :param tail_lines: the number of lines of each command's output to
+            keep in memory
+        """
+        self._path = path
+        self._tail_lines = max(0, tail_lines)
+        self._lock = threading.Lock()
+        self._counters: dict[str, int] = {}
+
+    def open(self, container_name: str, cmd: str,
+             origin: typing.Optional[Origin] = None) -> CommandLog:
+        """
+        Create the log file for a command.
+
+        :param container_name: the name of the container the command is run
+            in
+        :param cmd: the command
+        :param origin: the command's location in the scripts, which is
+            included in the log file's name (default: `None`)
+        :return: the stream for the command's output
+        :raise OSError: if the log file cannot be created
+        """
+        with self._lock:
+            index = self._counters.get(container_name, 0) + 1
+            self._counters[container_name] = index
+        name = f'{index:04d}'
+        if origin is not None:
+            script = 'stdin' if origin.script == '-' \
+                else os.path.basename(origin.script)
+            name += f'-{script}-{origin.line}'
+        container_dir = self._path / container_name
+        container_dir.mkdir(parents=True, exist_ok=True)
+        return CommandLog(container_dir / f'{name}.log.gz', cmd,
+                          self._tail_lines)
@@ -18,24 +18,80 @@
 #  along with ebuild-commander.  If not, see
 #  <https://www.gnu.org/licenses/>.
 
+import argparse
+import json
 import os
 import pathlib
 import shutil
+import sqlite3
 import sys
 import time
+import typing
 
 import ebuild_commander
 import ebuild_commander.cli
 
-from ebuild_commander.docker import Commandocker
-from ebuild_commander.out_fmt import info, error
+from ebuild_commander.async_docker import AsyncCommandocker
+from ebuild_commander.cache import hash_key
+from ebuild_commander.daemon import Daemon, run_client
+from ebuild_commander.endpoints import Endpoint, get_endpoint_docker_cmd
+from ebuild_commander.history import BuildHistory, \
+    get_default_history_path, print_trends
+from ebuild_commander.jobs import EXIT_SIGINT, create_job_container, \
+    get_build_history, get_job_cells, get_job_tmpfs_size, get_job_tuning, \
+    get_run_estimates, is_cleanup_needed
+from ebuild_commander.leftovers import gc_containers
+from ebuild_commander.matrix import Cell, MatrixRunner, get_threads_per_cell
+from ebuild_commander.out_fmt import info, warn, error
+from ebuild_commander.policy import PASSED, ExecutionPolicy
+from ebuild_commander.portage_config import PortageConfig
+from ebuild_commander.shard import ShardRunner, read_package_list
+from ebuild_commander.snapshot import print_snapshots, prune_snapshots
+from ebuild_commander.timing import TimingRecorder
 
-_EXIT_SIGINT = 130
+# Options that do not affect how containers are created and configured, which
+# are left out of the fingerprints of jobs in daemon mode
+_JOB_ONLY_OPTIONS = ('scripts', 'serve', 'pool_size', 'connect', 'matrix_jobs',
+                     'timing_report', 'timing_summary', 'list_snapshots',
+                     'prune_snapshots', 'shard_packages', 'shards',
+                     'fail_fast', 'background_cleanup', 'gc_containers',
+                     'gc_max_age', 'gc_keep', 'gc_all', 'show_history')
 
 
 def main(program_name: str, args) -> None:
     opts = ebuild_commander.cli.parse_args(args)
 
+    scripts = opts.scripts[0]
+    # In sharding mode, scripts are optional preparation steps
+    if len(scripts) == 0 and opts.shard_packages is None:
+        scripts.append(pathlib.Path('-'))
+
+    if opts.show_history is not None:
+        sys.exit(print_trends(program_name,
+                              BuildHistory(get_default_history_path()),
+                              opts.show_history or None))
+
+    # Scripts that cannot be read are reported before any container work
+    script_files = _read_script_files(program_name, scripts)
+    if script_files is None:
+        sys.exit(1)
+    if opts.endpoint:
+        status = _check_endpoints(program_name, opts)
+        if status != 0:
+            sys.exit(status)
+    elif opts.threads is None:
+        opts.threads = os.cpu_count() or 1
+
+    if opts.connect is not None:
+        if len(get_job_cells(opts)) > 1:
+            print(f"{error(program_name)}: Only one profile, image and "
+                  f"configuration set can be used with --connect",
+                  file=sys.stderr)
+            sys.exit(2)
+        script_lines = _read_scripts(program_name, scripts, script_files)
+        sys.exit(run_client(program_name, opts.connect, args, script_lines,
+                            EXIT_SIGINT))
+
     docker_cmd_var = ebuild_commander.__env_var_docker__
     docker_cmd_default = ebuild_commander.__env_default_docker__
     docker_cmd = os.getenv(docker_cmd_var, docker_cmd_default)
@@ -47,39 +103,118 @@ def main(program_name: str, args) -> None:
                   f"{docker_cmd_var} to specify an alternative executable")
         sys.exit(3)
 
-    scripts = opts.scripts[0]
-    if len(scripts) == 0:
-        scripts.append(pathlib.Path('-'))
-    portage_configs = opts.portage_config
-    if portage_configs is None:
-        portage_configs = [pathlib.Path('/etc/portage')]
-    custom_repos = opts.custom_repo
-    if custom_repos is None:
-        custom_repos = []
+    # The executable for each endpoint, by the endpoint's host
+    endpoint_cmds = {}
+    try:
+        for endpoint in opts.endpoint or []:
+            endpoint_cmds[endpoint.host] = \
+                get_endpoint_docker_cmd(docker_cmd, endpoint)
+    except OSError as err:
+        print(f"{error(program_name)}: Cannot create executable for "
+              f"endpoints: {err}", file=sys.stderr)
+        sys.exit(3)
+
+    if opts.list_snapshots:
+        sys.exit(print_snapshots(program_name, docker_cmd))
+    if opts.prune_snapshots:
+        sys.exit(prune_snapshots(program_name, docker_cmd))
+    if opts.gc_containers:
+        if not endpoint_cmds:
+            sys.exit(gc_containers(program_name, docker_cmd,
+                                   opts.gc_max_age, opts.gc_keep,
+                                   opts.gc_all))
+        sys.exit(max(gc_containers(f'{program_name}[{host}]', cmd,
+                                   opts.gc_max_age, opts.gc_keep,
+                                   opts.gc_all)
+                     for host, cmd in endpoint_cmds.items()))
+    if opts.serve is not None:
+        sys.exit(_serve(program_name, opts, docker_cmd))
+
+    cells = get_job_cells(opts)
+    recorder = None
+    if opts.timing_report is not None or opts.timing_summary is not None:
+        recorder = TimingRecorder()
 
     # Use a canonical container name for this instance to avoid the
     # container from being created twice
     container_name = f'{program_name}-{time.strftime("%Y%m%d-%H%M%S")}'
-    container = Commandocker(
-        program_name,
-        container_name,
-        portage_configs,
-        opts.profile,
-        opts.gentoo_repo,
-        custom_repos,
-        opts.threads,
-        opts.emerge_opts,
-        opts.docker_image,
-        opts.pull,
-        opts.storage_opt,
-        docker_cmd
-    )
 
+    def should_cleanup(status: int) -> bool:
+        return is_cleanup_needed(opts, status)
+
+    if opts.shard_packages is not None:
+        exit_status = _shard(program_name, opts, docker_cmd, cells,
+                             container_name, scripts, script_files, recorder)
+        _report_timing(program_name, opts, recorder)
+        sys.exit(exit_status)
+
+    if len(cells) > 1 or endpoint_cmds:
+        max_jobs = opts.matrix_jobs
+        if max_jobs is None or max_jobs < 1:
+            max_jobs = len(cells)
+        num_containers = min(len(cells), max_jobs)
+        tuning = get_job_tuning(program_name, opts, docker_cmd,
+                                num_containers)
+        if tuning is not None:
+            num_threads = tuning.make_jobs
+        else:
+            num_threads = get_threads_per_cell(opts.threads, len(cells),
+                                               max_jobs)
+        script_lines = _read_scripts(program_name, scripts, script_files)
+        tmpfs_size = get_job_tmpfs_size(program_name, opts, num_threads,
+                                        num_containers, tuning)
+
+        def create_container(cell: Cell, index: int, cell_program_name: str,
+                             output, endpoint: typing.Optional[Endpoint]
+                             ) -> AsyncCommandocker:
+            cell_docker_cmd = docker_cmd
+            cell_num_threads = num_threads
+            if endpoint is not None:
+                cell_docker_cmd = endpoint_cmds[endpoint.host]
+                # The threads of each endpoint are shared by its containers
+                cell_num_threads = max(1, opts.threads // endpoint.weight)
+            return create_job_container(cell_program_name,
+                                        f'{container_name}-{index}', opts,
+                                        cell_docker_cmd, cell,
+                                        cell_num_threads, tmpfs_size,
+                                        recorder, output, AsyncCommandocker,
+                                        tuning, endpoint)
+
+        runner = MatrixRunner(program_name, cells, max_jobs, create_container,
+                              should_cleanup, EXIT_SIGINT, opts.fail_fast,
+                              get_run_estimates(program_name, opts, cells,
+                                                script_lines),
+                              opts.endpoint, opts.endpoint_retries)
+        statuses = runner.run(script_lines)
+        if EXIT_SIGINT in statuses:
+            exit_status = EXIT_SIGINT
+        else:
+            exit_status = max(statuses)
+        _report_timing(program_name, opts, recorder)
+        sys.exit(exit_status)
+
+    tuning = get_job_tuning(program_name, opts, docker_cmd, 1)
+    num_threads = opts.threads if tuning is None else tuning.make_jobs
+    tmpfs_size = get_job_tmpfs_size(program_name, opts, num_threads, 1,
+                                    tuning)
+    container = create_job_container(program_name, container_name, opts,
+                                     docker_cmd, cells[0], num_threads,
+                                     tmpfs_size, recorder, tuning=tuning)
+
+    policy = ExecutionPolicy(program_name, opts.fail_fast)
     exit_status = 0
     try:
         print(f"{info(program_name)}: Creating Docker container...",
               file=sys.stderr)
-        if not container.start():
+        # The commands must be known before the container is created for
+        # the layer cache, and for estimating the run's duration, which is
+        # not done for commands from standard input
+        if opts.layer_cache or (opts.history and all(
+                script.name != '-' for script in scripts)):
+            script_lines = _read_scripts(program_name, scripts,
+                                         script_files)
+            exit_status = container.run_scripts(script_lines, policy)
+        elif not container.start():
             exit_status = 3
         else:
             for script in scripts:
@@ -89,26 +224,21 @@ def main(program_name: str, args) -> None:
                           f"Reading commands to run from standard input...",
                           file=sys.stderr)
                 else:
-                    try:
-                        in_stream = open(script)
-                        print(f"{info(program_name)}: "
-                              f"Running script {script}...", file=sys.stderr)
-                    except OSError as err:
-                        print(f"{error(program_name)}: {err.filename}:"
-                              f"{err.strerror}", file=sys.stderr)
-                        exit_status = 1
-                        continue
-                for line in in_stream:
-                    if not container.execute(line):
+                    in_stream = script_files[script]
+                    print(f"{info(program_name)}: "
+                          f"Running script {script}...", file=sys.stderr)
+                for line, origin in policy.select(str(script), in_stream):
+                    succeeded = container.execute(line, origin=origin)
+                    policy.record(succeeded)
+                    if not succeeded:
                         exit_status = 1
     except KeyboardInterrupt:
         print(f"{error(program_name)}: Exiting on SIGINT", file=sys.stderr)
-        exit_status = _EXIT_SIGINT
+        exit_status = EXIT_SIGINT
+
+    container.finish()
 
-    should_cleanup = opts.skip_cleanup == 'never' or \
-        (opts.skip_cleanup == 'on-fail' and
-            (exit_status == 0 or exit_status == _EXIT_SIGINT))
-    if should_cleanup:
+    if should_cleanup(exit_status):
         print(f"{info(program_name)}: Cleaning up the container...",
               file=sys.stderr)
         if not container.cleanup():
@@ -118,4 +248,211 @@ def main(program_name: str, args) -> None:
               f"Skipping clean-up of container {container_name}",
               file=sys.stderr)
 
+    _report_lines(program_name, policy)
+    _report_timing(program_name, opts, recorder)
     sys.exit(exit_status)
+
+
+def _check_endpoints(program_name: str, opts: argparse.Namespace) -> int:
+    """
+    Check whether the options can be used with endpoints.
+
+    :return: 0 if they can be used, otherwise the exit status for the program
+    """
+    hosts = [endpoint.host for endpoint in opts.endpoint]
+    if len(set(hosts)) < len(hosts):
+        print(f"{error(program_name)}: Each endpoint can only be specified "
+              f"once", file=sys.stderr)
+        return 2
+    # These options depend on the host this program runs on
+    conflicts = (('--serve', opts.serve is not None),
+                 ('--connect', opts.connect is not None),
+                 ('--shard-packages', opts.shard_packages is not None),
+                 ('--docker-socket', opts.docker_socket is not None),
+                 ('--auto-tune', opts.auto_tune))
+    for option, used in conflicts:
+        if used:
+            print(f"{error(program_name)}: {option} cannot be used with "
+                  f"--endpoint", file=sys.stderr)
+            return 2
+    # The number of CPU threads of this host says nothing about the
+    # endpoints
+    if opts.threads is None:
+        print(f"{error(program_name)}: --threads is required with "
+              f"--endpoint", file=sys.stderr)
+        return 2
+    if opts.tmpfs and opts.tmpfs_size is None:
+        print(f"{error(program_name)}: --tmpfs requires --tmpfs-size with "
+              f"--endpoint", file=sys.stderr)
+        return 2
+    return 0
+
+
+def _serve(program_name: str, opts: argparse.Namespace,
+           docker_cmd: str) -> int:
+    def create_container(job_opts: argparse.Namespace, container_name: str,
+                         output) -> AsyncCommandocker:
+        tuning = get_job_tuning(program_name, job_opts, docker_cmd, 1)
+        num_threads = job_opts.threads if tuning is None \
+            else tuning.make_jobs
+        tmpfs_size = get_job_tmpfs_size(program_name, job_opts,
+                                        num_threads, 1, tuning)
+        return create_job_container(program_name, container_name, job_opts,
+                                    docker_cmd, get_job_cells(job_opts)[0],
+                                    num_threads, tmpfs_size, None, output,
+                                    AsyncCommandocker, tuning)
+
+    def get_fingerprint(job_opts: argparse.Namespace) -> str:
+        cells = get_job_cells(job_opts)
+        if len(cells) > 1:
+            raise ValueError("more than one profile, image or configuration "
+                             "set")
+        values = {key: value for key, value in vars(job_opts).items()
+                  if key not in _JOB_ONLY_OPTIONS}
+        # The contents of the Portage configuration directories may change
+        # between jobs even if the options are the same
+        config_digest = PortageConfig(cells[0].portage_configs).get_digest()
+        return hash_key(json.dumps(values, sort_keys=True, default=str),
+                        config_digest)
+
+    pool_size = max(0, opts.pool_size)
+    daemon = Daemon(program_name, opts.serve, pool_size, create_container,
+                    get_fingerprint, is_cleanup_needed, EXIT_SIGINT)
+    return daemon.run()
+
+
+def _shard(program_name: str, opts: argparse.Namespace, docker_cmd: str,
+           cells: list[Cell], container_name: str,
+           scripts: list[pathlib.Path],
+           script_files: dict[pathlib.Path, list[str]],
+           recorder: typing.Optional[TimingRecorder]) -> int:
+    if len(cells) > 1:
+        print(f"{error(program_name)}: Only one profile, image and "
+              f"configuration set can be used with --shard-packages",
+              file=sys.stderr)
+        return 2
+    if opts.binpkg_cache is None:
+        print(f"{error(program_name)}: --shard-packages requires "
+              f"--binpkg-cache", file=sys.stderr)
+        return 2
+    try:
+        atoms = read_package_list(opts.shard_packages)
+    except OSError as err:
+        print(f"{error(program_name)}: {err.filename}: {err.strerror}",
+              file=sys.stderr)
+        return 1
+    if not atoms:
+        print(f"{error(program_name)}: No packages to merge in "
+              f"{opts.shard_packages}", file=sys.stderr)
+        return 1
+    num_shards = max(1, opts.shards)
+    tuning = get_job_tuning(program_name, opts, docker_cmd, num_shards)
+    if tuning is not None:
+        num_threads = tuning.make_jobs
+    else:
+        num_threads = get_threads_per_cell(opts.threads, num_shards,
+                                           num_shards)
+    script_lines = _read_scripts(program_name, scripts, script_files)
+    tmpfs_size = get_job_tmpfs_size(program_name, opts, num_threads,
+                                    num_shards, tuning)
+
+    def create_container(index: int, shard_program_name: str,
+                         output) -> AsyncCommandocker:
+        return create_job_container(shard_program_name,
+                                    f'{container_name}-{index}', opts,
+                                    docker_cmd, cells[0], num_threads,
+                                    tmpfs_size, recorder, output,
+                                    AsyncCommandocker, tuning)
+
+    def should_cleanup(status: int) -> bool:
+        return is_cleanup_needed(opts, status)
+
+    durations = None
+    history = get_build_history(opts)
+    if history is not None:
+        try:
+            durations = history.get_build_durations(cells[0].profile,
+                                                    cells[0].docker_image)
+        except (sqlite3.Error, OSError) as err:
+            print(f"{warn(program_name)}: Cannot read build history "
+                  f"{history.path}: {err}", file=sys.stderr)
+
+    runner = ShardRunner(program_name, num_shards, create_container,
+                         should_cleanup, EXIT_SIGINT, opts.fail_fast,
+                         durations)
+    return runner.run(script_lines, atoms)
+
+
+def _report_timing(program_name: str, opts: argparse.Namespace,
+                   recorder: typing.Optional[TimingRecorder]) -> None:
+    if recorder is None:
+        return
+    if opts.timing_summary is not None:
+        for line in recorder.format_summary(opts.timing_summary):
+            print(f"{info(program_name)}: {line}", file=sys.stderr)
+    if opts.timing_report is not None:
+        try:
+            recorder.write_report(opts.timing_report)
+        except OSError as err:
+            print(f"{error(program_name)}: {err.filename}: {err.strerror}",
+                  file=sys.stderr)
+
+
+def _report_lines(program_name: str, policy: ExecutionPolicy) -> None:
+    """
+    Report the lines of the scripts that failed or were skipped, if any.
+    """
+    if all(result.outcome == PASSED for result in policy.results):
+        return
+    for line in policy.format_report():
+        print(f"{info(program_name)}: {line}", file=sys.stderr)
+
+
+def _read_scripts(
+        program_name: str,
+        scripts: list[pathlib.Path],
+        script_files: dict[pathlib.Path, list[str]]
+) -> list[tuple[str, list[str]]]:
+    """
+    Read all lines of the scripts in advance, for running them more than once.
+
+    :param script_files: the lines of the scripts other than standard input,
+        from `_read_script_files`
+    :return: the name and the lines of each script
+    """
+    script_lines = []
+    for script in scripts:
+        if script.name == '-':
+            print(f"{info(program_name)}: "
+                  f"Reading commands to run from standard input...",
+                  file=sys.stderr)
+            script_lines.append((str(script), sys.stdin.readlines()))
+        else:
+            script_lines.append((str(script), script_files[script]))
+    return script_lines
+
+
+def _read_script_files(
+        program_name: str,
+        scripts: list[pathlib.Path]
+) -> typing.Optional[dict[pathlib.Path, list[str]]]:
+    """
+    Read the scripts other than standard input, which is only read when its
+    commands are needed.
+
+    :return: the lines of each script, by the script's path, or `None` if any
+        script cannot be read
+    """
+    script_files = {}
+    readable = True
+    for script in scripts:
+        if script.name == '-' or script in script_files:
+            continue
+        try:
+            with open(script) as in_stream:
+                script_files[script] = in_stream.readlines()
+        except OSError as err:
+            print(f"{error(program_name)}: {err.filename}:"
+                  f"{err.strerror}", file=sys.stderr)
+            readable = False
+    return script_files if readable else None
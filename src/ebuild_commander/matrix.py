@@ -0,0 +1,304 @@
+#  ebuild-commander Build Matrix Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import itertools
+import os
+import pathlib
+import signal
+import sys
+import typing
+
+from ebuild_commander.async_docker import AsyncCommandocker
+from ebuild_commander.endpoints import Endpoint, EndpointPool, \
+    run_on_endpoints
+from ebuild_commander.out_fmt import info, error, PrefixedWriter
+from ebuild_commander.policy import PASSED, ExecutionPolicy
+
+
+class Cell(typing.NamedTuple):
+    """
+    A combination of settings in a build matrix, with which the scripts are run
+    in a separate container.
+    """
+    profile: str
+    docker_image: str
+    portage_configs: list[pathlib.Path]
+
+    def describe_configs(self) -> str:
+        return os.pathsep.join(str(config) for config in self.portage_configs)
+
+
+def get_cells(profiles: list[str], docker_images: list[str],
+              config_sets: list[list[pathlib.Path]]) -> list[Cell]:
+    """
+    :return: every combination of the profiles, Docker images and
+        configuration sets
+    """
+    return [Cell(profile, image, configs) for image, profile, configs in
+            itertools.product(docker_images, profiles, config_sets)]
+
+
+def get_threads_per_cell(num_threads: int, num_cells: int,
+                         max_jobs: int) -> int:
+    """
+    Divide the number of threads available on the host among the cells that
+    run at the same time.
+
+    :param num_threads: the number of threads available on the host
+    :param num_cells: the number of cells
+    :param max_jobs: the maximum number of cells that run at the same time
+    :return: the number of threads for each cell, which is at least 1
+    """
+    return max(1, num_threads // max(1, min(num_cells, max_jobs)))
+
+
+def get_start_order(estimates: typing.Optional[list[typing.Optional[float]]],
+                    count: int) -> list[int]:
+    """
+    Order jobs from the longest to the shortest, so the shortest jobs run last
+    when not all jobs can run at the same time.  Jobs without an estimate come
+    first, in their original order, as they might be long.
+
+    :param estimates: the estimated duration of each job, or `None` if
+        nothing is known
+    :param count: the number of jobs
+    :return: the 0-based indexes of the jobs in the order they should start
+    """
+    if estimates is None:
+        return list(range(count))
+    return sorted(range(count),
+                  key=lambda i: (estimates[i] is not None,
+                                 -(estimates[i] or 0)))
+
+
+class MatrixRunner:
+    """
+    Run the same scripts with every cell of a build matrix, driving an
+    `AsyncCommandocker` for each cell from a single event loop.
+
+    Output from each cell is prefixed with the cell's number.  After all cells
+    finish, a table summarizing the result of each cell is printed.
+    """
+
+    def __init__(
+            self,
+            program_name: str,
+            cells: list[Cell],
+            max_jobs: int,
+            create_container: typing.Callable[
+                [Cell, int, str, typing.BinaryIO, typing.Optional[Endpoint]],
+                AsyncCommandocker],
+            should_cleanup: typing.Callable[[int], bool],
+            interrupt_status: int,
+            fail_fast: bool = False,
+            estimates: typing.Optional[list[typing.Optional[float]]] = None,
+            endpoints: typing.Optional[list[Endpoint]] = None,
+            endpoint_retries: int = 0
+    ):
+        """
+        :param program_name: the program name for messages
+        :param cells: the cells of the build matrix
+        :param max_jobs: the maximum number of cells that run at the same time
+        :param create_container: a function that creates the container for a
+            cell, given the cell, its 1-based index, the program name to use
+            for its messages, the stream for its output, and the endpoint to
+            create it on, which is `None` without `endpoints`
+        :param should_cleanup: a function that decides whether a cell's
+            container should be removed, given the cell's exit status
+        :param interrupt_status: the exit status of a cell that was stopped
+            because the program was interrupted
+        :param fail_fast: whether all commands of a cell after a failed one
+            should be skipped
+        :param estimates: the estimated duration of each cell, if known; when
+            not all cells can run at the same time, the cells are started
+            from the longest to the shortest, starting cells without an
+            estimate first, so the shorter ones fill in the gaps at the end
+        :param endpoints: if specified, the Docker daemons to place the cells
+            on, as an `EndpointPool` does
+        :param endpoint_retries: the number of other endpoints to try when a
+            cell's container cannot be started on an endpoint
+        """
+        self._program_name = program_name
+        self._cells = cells
+        self._max_jobs = max_jobs
+        self._create_container = create_container
+        self._should_cleanup = should_cleanup
+        self._interrupt_status = interrupt_status
+        self._fail_fast = fail_fast
+        self._estimates = estimates
+        self._endpoints = endpoints
+        self._endpoint_retries = endpoint_retries
+        self._pool = None
+        # The host of the endpoint each cell last ran on, by the cell's index
+        self._cell_hosts: dict[int, str] = {}
+        self._interrupted = False
+        # Tasks running the scripts with a started or starting container
+        self._running: set[asyncio.Task] = set()
+
+    def run(self, scripts: list[tuple[str, list[str]]]) -> list[int]:
+        """
+        Run the scripts with every cell.  If this program is interrupted, the
+        remaining commands are skipped, and the containers are cleaned up.
+
+        :param scripts: the name and the lines of each script
+        :return: the exit status of each cell
+        """
+        for i, cell in enumerate(self._cells, start=1):
+            print(f"{info(self._program_name)}: Cell {i}: profile "
+                  f"{cell.profile}, image {cell.docker_image}, configuration "
+                  f"{cell.describe_configs()}", file=sys.stderr)
+        statuses = asyncio.run(self._run_cells(scripts))
+        self._print_summary(statuses)
+        return statuses
+
+    async def _run_cells(
+            self, scripts: list[tuple[str, list[str]]]) -> list[int]:
+        loop = asyncio.get_running_loop()
+        # Ctrl-C stops the commands in every container instead of raising
+        # KeyboardInterrupt at an arbitrary point of the event loop
+        loop.add_signal_handler(signal.SIGINT, self._interrupt)
+        try:
+            if self._endpoints:
+                self._pool = EndpointPool(self._program_name, self._endpoints)
+            semaphore = asyncio.Semaphore(self._max_jobs)
+            # Cells acquire the semaphore in the order they are started
+            order = get_start_order(self._estimates, len(self._cells))
+            statuses = await asyncio.gather(
+                *(self._run_cell(i + 1, self._cells[i], scripts, semaphore)
+                  for i in order))
+            return [status for _, status in sorted(zip(order, statuses))]
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+
+    def _interrupt(self) -> None:
+        if not self._interrupted:
+            print(f"{error(self._program_name)}: Exiting on SIGINT",
+                  file=sys.stderr)
+            self._interrupted = True
+        for task in self._running:
+            task.cancel()
+
+    async def _run_cell(self, index: int, cell: Cell,
+                        scripts: list[tuple[str, list[str]]],
+                        semaphore: asyncio.Semaphore) -> int:
+        async with semaphore:
+            output = PrefixedWriter(sys.stdout.buffer, f'[{index}] ')
+            cell_program_name = f'{self._program_name}[{index}]'
+
+            async def attempt(endpoint: Endpoint, can_retry: bool) \
+                    -> typing.Optional[tuple[int, typing.Optional[bool]]]:
+                if self._interrupted:
+                    return self._interrupt_status, None
+                self._cell_hosts[index] = endpoint.host
+                status = await self._run_container(
+                    cell, index, cell_program_name, output, endpoint,
+                    scripts, can_retry)
+                if status is None:
+                    return None
+                # Only a container that cannot be started or removed results
+                # in this status
+                return status, status != 3
+
+            if self._interrupted:
+                exit_status = self._interrupt_status
+            elif self._pool is None:
+                exit_status = await self._run_container(
+                    cell, index, cell_program_name, output, None, scripts,
+                    False)
+            else:
+                exit_status = await run_on_endpoints(
+                    self._pool, cell_program_name, self._endpoint_retries,
+                    attempt)
+                if exit_status is None:
+                    exit_status = 3
+            output.close()
+            return exit_status
+
+    async def _run_container(self, cell: Cell, index: int,
+                             cell_program_name: str, output: PrefixedWriter,
+                             endpoint: typing.Optional[Endpoint],
+                             scripts: list[tuple[str, list[str]]],
+                             can_retry: bool) -> typing.Optional[int]:
+        """
+        Run the scripts with a container for a cell.
+
+        :param endpoint: the endpoint to create the container on, if any
+        :param can_retry: whether the cell can be run on another endpoint if
+            the container cannot be started
+        :return: the exit status of the cell, or `None` if the container
+            could not be started and the cell should be run on another
+            endpoint
+        """
+        container = self._create_container(cell, index, cell_program_name,
+                                           output, endpoint)
+        policy = ExecutionPolicy(cell_program_name, self._fail_fast)
+        task = asyncio.ensure_future(container.run_scripts(scripts, policy))
+        self._running.add(task)
+        try:
+            exit_status = await task
+        except asyncio.CancelledError:
+            exit_status = self._interrupt_status
+        finally:
+            self._running.discard(task)
+        # Only a container that cannot be started results in this status
+        # before it is cleaned up
+        if exit_status == 3 and endpoint is not None and can_retry:
+            await container.finish()
+            # Whatever has been created for the container is not useful
+            await container.cleanup()
+            return None
+        if any(result.outcome != PASSED for result in policy.results):
+            for line in policy.format_report():
+                print(f"{info(cell_program_name)}: {line}",
+                      file=sys.stderr)
+        await container.finish()
+        if self._should_cleanup(exit_status):
+            if not await container.cleanup():
+                exit_status = 3
+        return exit_status
+
+    def _print_summary(self, statuses: list[int]) -> None:
+        header = ('CELL', 'RESULT', 'PROFILE', 'IMAGE', 'CONFIGURATION')
+        if self._endpoints:
+            header += ('ENDPOINT',)
+        rows = [header]
+        for i, (cell, status) in enumerate(zip(self._cells, statuses),
+                                           start=1):
+            if status == 0:
+                result = 'PASS'
+            elif status == self._interrupt_status:
+                result = 'STOPPED'
+            elif status == 1:
+                result = 'FAIL'
+            else:
+                result = 'ERROR'
+            row = (str(i), result, cell.profile, cell.docker_image,
+                   cell.describe_configs())
+            if self._endpoints:
+                row += (self._cell_hosts.get(i, '-'),)
+            rows.append(row)
+        widths = [max(len(row[col]) for row in rows)
+                  for col in range(len(header))]
+        print(f"{info(self._program_name)}: Summary:", file=sys.stderr)
+        for row in rows:
+            print('  '.join(value.ljust(width)
+                            for value, width in zip(row, widths)).rstrip(),
+                  file=sys.stderr)
@@ -0,0 +1,94 @@
+#  ebuild-commander Metadata Cache Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import pathlib
+import typing
+
+# File in a metadata cache partition holding the digest of the repository
+# contents the cache was last generated for; being hidden, it is not taken as
+# a cache entry by Portage
+_DIGEST_FILE_NAME = '.ebuild-commander-digest'
+
+
+def get_repo_digest(repo: pathlib.Path,
+                    masters: typing.Iterable[pathlib.Path] = ()) -> str:
+    """
+    Compute a digest of the files in an ebuild repository that the metadata
+    cache depends on, namely the ebuilds and the eclasses, including the
+    eclasses of the repository's masters.  Files are compared by their paths,
+    sizes and modification times rather than their contents, like Portage
+    does for deciding whether a metadata cache entry is still valid.
+
+    :param repo: the path to the repository
+    :param masters: the paths to the repository's master repositories
+    :return: the digest
+    """
+    digest = hashlib.sha256()
+    for top_name, top in [('repo', repo)] + [('master', master)
+                                              for master in masters]:
+        digest.update(f'{top_name}\0'.encode())
+        for path in _list_metadata_sources(top, top_name == 'master'):
+            try:
+                st = path.stat()
+            except OSError:
+                # Removed during the scan
+                continue
+            digest.update(f'{path.relative_to(top)}\0{st.st_size}\0'
+                          f'{st.st_mtime_ns}\0'.encode())
+    return digest.hexdigest()[:32]
+
+
+def is_up_to_date(partition: pathlib.Path, repo_digest: str) -> bool:
+    """
+    :param partition: the metadata cache partition of a repository
+    :param repo_digest: the digest of the repository's current contents
+    :return: whether the cache in the partition was generated for the
+        repository's current contents
+    """
+    try:
+        return (partition / _DIGEST_FILE_NAME).read_text().strip() == \
+            repo_digest
+    except OSError:
+        return False
+
+
+def mark_up_to_date(partition: pathlib.Path, repo_digest: str) -> None:
+    """
+    Record that the cache in a metadata cache partition has been generated for
+    the repository's current contents.
+
+    :param partition: the metadata cache partition of a repository
+    :param repo_digest: the digest of the repository's current contents
+    :raise OSError: if the record cannot be written
+    """
+    tmp_path = partition / f'{_DIGEST_FILE_NAME}.{os.getpid()}'
+    tmp_path.write_text(f'{repo_digest}\n')
+    os.replace(tmp_path, partition / _DIGEST_FILE_NAME)
+
+
+def _list_metadata_sources(top: pathlib.Path,
+                           eclasses_only: bool) -> list[pathlib.Path]:
+    paths = sorted((top / 'eclass').glob('*.eclass'))
+    if not eclasses_only:
+        # Ebuilds are always at <category>/<package>/<ebuild>
+        paths += sorted(top.glob('*/*/*.ebuild'))
+    return paths
@@ -18,6 +18,9 @@
 #  along with ebuild-commander.  If not, see
 #  <https://www.gnu.org/licenses/>.
 
+import threading
+import typing
+
 
 def info(program_name: str) -> str:
     """
@@ -58,3 +61,90 @@ def error(program_name: str) -> str:
     :return: the program name wrapped in Bash color code for error
     """
     return f'\033[1;31m{program_name}\033[0m'
+
+
+def format_size(num_bytes: int) -> str:
+    """
+    Format a number of bytes for display, using the largest binary unit prefix
+    that keeps the number no less than 1.
+
+    :param num_bytes: the number of bytes
+    :return: the formatted size, like '1.5 MiB'
+    """
+    size = float(num_bytes)
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return f'{num_bytes} B'
+    return f'{size:.1f} {unit}'
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Format a number of seconds for display, using the two largest units among
+    hours, minutes and seconds.
+
+    :param seconds: the number of seconds
+    :return: the formatted duration, like '1h 05m' or '42s'
+    """
+    seconds = round(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f'{hours}h {minutes:02d}m'
+    if minutes:
+        return f'{minutes}m {seconds:02d}s'
+    return f'{seconds}s'
+
+
+class PrefixedWriter:
+    """
+    A binary stream that adds a prefix to each line written to it before
+    writing the line to an underlying stream.
+
+    Only complete lines are written to the underlying stream, so lines from
+    different instances of this class sharing the same underlying stream are
+    never mixed with each other.  An incomplete line is written when it grows
+    too long or when this stream is closed.
+    """
+
+    # Lines written by all instances are serialized with this lock
+    _lock = threading.Lock()
+
+    _MAX_PENDING = 65536
+
+    def __init__(self, stream: typing.BinaryIO, prefix: str):
+        self._stream = stream
+        self._prefix = prefix.encode()
+        self._pending = b''
+
+    def write(self, data: bytes) -> int:
+        self._pending += data
+        lines = self._pending.split(b'\n')
+        self._pending = lines.pop()
+        if len(self._pending) >= self._MAX_PENDING:
+            lines.append(self._pending)
+            self._pending = b''
+        self._write_lines(lines)
+        return len(data)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._stream.flush()
+
+    def close(self) -> None:
+        if self._pending:
+            self._write_lines([self._pending])
+            self._pending = b''
+
+    def _write_lines(self, lines: list[bytes]) -> None:
+        if not lines:
+            return
+        with self._lock:
+            for line in lines:
+                self._stream.write(self._prefix + line + b'\n')
+            self._stream.flush()
@@ -0,0 +1,93 @@
+#  ebuild-commander Task Graph Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import typing
+
+
+class TaskGraph:
+    """
+    A set of named tasks, each of which may have to run after some other
+    tasks.  When the graph is run, every task starts in a thread as soon as
+    the tasks it depends on have finished, so tasks that do not depend on
+    each other run at the same time.
+    """
+
+    def __init__(self):
+        self._tasks: dict[str, tuple[typing.Callable[[], typing.Any],
+                                     tuple[str, ...]]] = {}
+
+    def add(self, name: str, function: typing.Callable[[], typing.Any],
+            after: typing.Iterable[str] = ()) -> None:
+        """
+        Add a task to the graph.  Tasks can only depend on tasks that have
+        been added, so the graph never has a cycle.
+
+        :param name: the task's name, by which other tasks refer to it
+        :param function: the function to call for running the task
+        :param after: the names of the tasks that must finish before this
+            task starts
+        :raise ValueError: if a task with the same name has been added, or if
+            a task in `after` has not been added
+        """
+        if name in self._tasks:
+            raise ValueError(f"duplicate task '{name}'")
+        after = tuple(after)
+        for dependency in after:
+            if dependency not in self._tasks:
+                raise ValueError(f"unknown task '{dependency}'")
+        self._tasks[name] = (function, after)
+
+    def run(self) -> dict[str, typing.Any]:
+        """
+        Run all tasks in the graph.  If a task raises an exception, no more
+        tasks are started, and the exception is raised again after the tasks
+        that are already running have finished.
+
+        :return: the value returned by each task, by the task's name
+        """
+        results = {}
+        if not self._tasks:
+            return results
+        pending = dict(self._tasks)
+        running: dict[concurrent.futures.Future, str] = {}
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self._tasks)) as executor:
+            while pending or running:
+                if failure is None:
+                    for name, (function, after) in list(pending.items()):
+                        if all(dependency in results for dependency in after):
+                            running[executor.submit(function)] = name
+                            del pending[name]
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as err:
+                        if failure is None:
+                            failure = err
+        if failure is not None:
+            raise failure
+        return results
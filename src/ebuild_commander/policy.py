@@ -0,0 +1,261 @@
+#  ebuild-commander Execution Policy Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import re
+import sys
+import typing
+
+from ebuild_commander.out_fmt import info, warn
+from ebuild_commander.timing import Origin
+
+# Outcomes of a line of a script
+PASSED = 'passed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# An annotation is a comment that starts with '#@', either on a line of its
+# own or at the end of a command
+_ANNOTATION_PATTERN = re.compile(r'(?:^|\s)#@(.*)$')
+
+
+class Annotations(typing.NamedTuple):
+    """
+    The settings given by an annotation on a line of a script.
+    """
+    # The name other lines can refer to this line by
+    line_id: typing.Optional[str] = None
+    # The names of earlier lines this line depends on
+    after: tuple[str, ...] = ()
+    # Whether the rest of the script should be skipped after a line fails,
+    # or `None` to keep the script's current setting
+    stop_on_error: typing.Optional[bool] = None
+
+
+class LineResult(typing.NamedTuple):
+    """
+    The outcome of a line of a script.
+    """
+    origin: Origin
+    command: str
+    # One of PASSED, FAILED and SKIPPED
+    outcome: str
+    # Why the line was skipped
+    reason: typing.Optional[str] = None
+
+
+def parse_annotations(line: str) -> tuple[Annotations, bool]:
+    """
+    Parse the annotation on a line of a script, which consists of
+    space-separated settings:
+
+    - 'id=NAME' names the line.
+    - 'after=NAME[,NAME...]' makes the line depend on the named earlier lines,
+      so it is skipped if any of them fails or is skipped.
+    - 'stop-on-error' makes a failure of this or any later line of the script
+      skip the rest of the script; 'continue-on-error' reverts this.
+
+    :param line: the line
+    :return: the settings, and whether the line consists of the annotation
+        only, which does not need to be run
+    :raise ValueError: if the annotation contains an unknown setting
+    """
+    match = _ANNOTATION_PATTERN.search(line)
+    if match is None:
+        return Annotations(), False
+    line_id = None
+    after = ()
+    stop_on_error = None
+    for setting in match.group(1).split():
+        key, sep, value = setting.partition('=')
+        if key == 'id' and sep and value:
+            line_id = value
+        elif key == 'after' and sep and value:
+            after += tuple(name for name in value.split(',') if name)
+        elif setting == 'stop-on-error':
+            stop_on_error = True
+        elif setting == 'continue-on-error':
+            stop_on_error = False
+        else:
+            raise ValueError(f"unknown annotation setting '{setting}'")
+    only = not line[:match.start()].strip()
+    return Annotations(line_id, after, stop_on_error), only
+
+
+class ExecutionPolicy:
+    """
+    Decide which lines of the scripts are run based on the outcomes of the
+    lines run before them, and keep the outcome of every line for a report.
+
+    By default, every line is run regardless of earlier failures.  With
+    `fail_fast`, all lines after the first failure are skipped.  Annotations
+    parsed by `parse_annotations` can make a failure skip the rest of a script
+    or only the lines that depend on the failed line.
+
+    Lines are visited with `select` or `select_scripts`, and the outcome of
+    each line they yield must be given to `record` before the next line is
+    visited.
+    """
+
+    def __init__(self, program_name: str, fail_fast: bool = False):
+        """
+        :param program_name: the program name for messages
+        :param fail_fast: whether all lines after a failure should be skipped
+        """
+        self._program_name = program_name
+        self._fail_fast = fail_fast
+        self._results: list[LineResult] = []
+        # The outcome of the last line with each name
+        self._outcomes: dict[str, str] = {}
+        # The reason why all remaining lines are skipped, if any
+        self._stopped: typing.Optional[str] = None
+        self._current: typing.Optional[tuple[Origin, str,
+                                             typing.Optional[str]]] = None
+        self._stop_on_error = False
+
+    @property
+    def results(self) -> list[LineResult]:
+        """
+        The outcome of every line visited so far, except for lines with only
+        an annotation.
+        """
+        return list(self._results)
+
+    def select(self, script: str, lines: typing.Iterable[str]) \
+            -> typing.Iterator[tuple[str, Origin]]:
+        """
+        Visit the lines of a script, skipping the lines that should not be run.
+
+        :param script: the script's name
+        :param lines: the script's lines
+        :return: an iterator over each line that should be run and its origin
+        """
+        self._stop_on_error = False
+        script_stopped = None
+        for line_num, line in enumerate(lines, start=1):
+            origin = Origin(script, line_num)
+            command = line.rstrip('\n')
+            try:
+                annotations, only = parse_annotations(line)
+            except ValueError as err:
+                print(f"{warn(self._program_name)}: {script}:{line_num}: "
+                      f"{err} -- ignoring the annotation", file=sys.stderr)
+                annotations, only = Annotations(), False
+            if annotations.stop_on_error is not None:
+                self._stop_on_error = annotations.stop_on_error
+            if only:
+                continue
+            reason = self._stopped or script_stopped or \
+                self._get_dependency_failure(origin, annotations)
+            if reason is not None:
+                self._add(origin, command, annotations.line_id, SKIPPED,
+                          reason)
+                continue
+            self._current = (origin, command, annotations.line_id)
+            yield line, origin
+            if self._current is not None:
+                raise RuntimeError('the outcome of a line was not recorded')
+            if self._results[-1].outcome == FAILED and self._stop_on_error \
+                    and script_stopped is None:
+                script_stopped = f'{origin.script}:{origin.line} failed'
+                print(f"{info(self._program_name)}: Skipping the rest of "
+                      f"script {script} after a failure", file=sys.stderr)
+
+    def select_scripts(self, scripts: list[tuple[str, list[str]]],
+                       skipped: int = 0) \
+            -> typing.Iterator[tuple[str, Origin]]:
+        """
+        Visit the lines of scripts in order like `select`, except that any of
+        the leading lines known to have succeeded before, like those whose
+        results a container was created with, is recorded as passed instead
+        of being yielded.
+
+        :param scripts: the name and the lines of each script
+        :param skipped: the number of leading lines of all scripts combined
+            that have succeeded before (default: 0)
+        :return: an iterator over each line that should be run and its origin
+        """
+        offset = 0
+        for script, lines in scripts:
+            for line, origin in self.select(script, lines):
+                if offset + origin.line <= skipped:
+                    self.record(True)
+                    continue
+                yield line, origin
+            offset += len(lines)
+
+    def record(self, succeeded: bool) -> None:
+        """
+        Record the outcome of the line last yielded by `select` or
+        `select_scripts`.
+
+        :param succeeded: whether the line succeeded
+        """
+        origin, command, line_id = self._current
+        self._current = None
+        self._add(origin, command, line_id, PASSED if succeeded else FAILED)
+        if not succeeded and self._fail_fast and self._stopped is None:
+            self._stopped = f'{origin.script}:{origin.line} failed'
+            print(f"{info(self._program_name)}: Skipping all remaining "
+                  f"lines after a failure", file=sys.stderr)
+
+    def format_report(self) -> list[str]:
+        """
+        Summarize the outcomes of the lines in human-readable lines.
+
+        :return: the lines of the summary
+        """
+        counts = {outcome: 0 for outcome in (PASSED, FAILED, SKIPPED)}
+        for result in self._results:
+            counts[result.outcome] += 1
+        lines = [f"Lines: {counts[PASSED]} passed, {counts[FAILED]} failed, "
+                 f"{counts[SKIPPED]} skipped"]
+        for outcome in (FAILED, SKIPPED):
+            if counts[outcome] == 0:
+                continue
+            lines.append(f"{outcome.capitalize()} lines:")
+            for result in self._results:
+                if result.outcome != outcome:
+                    continue
+                line = f"  {result.origin.script}:{result.origin.line}: " \
+                       f"{result.command.strip()}"
+                if result.reason is not None:
+                    line += f" ({result.reason})"
+                lines.append(line)
+        return lines
+
+    def _get_dependency_failure(
+            self, origin: Origin,
+            annotations: Annotations) -> typing.Optional[str]:
+        for name in annotations.after:
+            outcome = self._outcomes.get(name)
+            if outcome is None:
+                print(f"{warn(self._program_name)}: {origin.script}:"
+                      f"{origin.line}: No earlier line with ID '{name}' -- "
+                      f"ignoring the dependency", file=sys.stderr)
+            elif outcome != PASSED:
+                return f"depends on '{name}', which {outcome}"
+        return None
+
+    def _add(self, origin: Origin, command: str,
+             line_id: typing.Optional[str], outcome: str,
+             reason: typing.Optional[str] = None) -> None:
+        self._results.append(LineResult(origin, command, outcome, reason))
+        if line_id is not None:
+            self._outcomes[line_id] = outcome
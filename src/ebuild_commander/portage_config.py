@@ -0,0 +1,261 @@
+#  ebuild-commander Portage Configuration Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import hashlib
+import io
+import os
+import pathlib
+import re
+import stat
+import tarfile
+import time
+import typing
+
+# Entries in a configuration directory that are always ignored because they
+# are controlled by ebuild-commander
+_IGNORED_TOP_LEVEL_ENTRIES = ('make.profile', 'repos.conf')
+
+# Name of the file added to a configuration file that is a directory, like a
+# make.conf directory, to hold the settings appended by ebuild-commander; the
+# prefix makes Portage read it after any other file in the directory
+_APPENDED_FILE_NAME = 'zz-ebuild-commander'
+
+# Matches a variable assignment in make.conf, whose value may be quoted and
+# span multiple lines
+_ASSIGNMENT_PATTERN = re.compile(
+    r'^[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)='
+    r'("(?:[^"\\]|\\.)*"|\'[^\']*\'|\S*)',
+    re.MULTILINE)
+
+
+def find_assignments(text: str, names: typing.Iterable[str]) -> list[str]:
+    """
+    Find assignments to the specified variables in the contents of a make.conf
+    file, in the order they appear.
+
+    :param text: the contents of the make.conf file
+    :param names: names of the variables
+    :return: each matching assignment in the form of NAME=VALUE, with VALUE
+        exactly as it appears in the file
+    """
+    names = set(names)
+    return [match.group(0).strip() for match in
+            _ASSIGNMENT_PATTERN.finditer(text) if match.group(1) in names]
+
+
+class _Entry(typing.NamedTuple):
+    # One of the stat.S_IFDIR, stat.S_IFREG and stat.S_IFLNK constants
+    kind: int
+    # Permission bits
+    mode: int
+    # The file's contents
+    data: typing.Optional[bytes] = None
+    # The target of a symbolic link
+    link_target: typing.Optional[str] = None
+
+
+class PortageConfig:
+    """
+    A Portage configuration tree for a container's /etc/portage prepared on
+    the host, which can be shipped to the container as a single tar archive.
+
+    The tree is formed by overlaying configuration directories on top of each
+    other, in the same way as copying each directory's contents into the same
+    destination in order would do.  Files can then be added to the tree, or
+    have contents appended to them.
+    """
+
+    def __init__(self, config_dirs: list[pathlib.Path]):
+        """
+        Create a tree from configuration directories.  The contents of the
+        files in the directories are read at once, so the tree does not
+        change even if the files are modified later.
+
+        :param config_dirs: the configuration directories, in the order they
+            are overlaid
+        :raise OSError: if a file in the directories cannot be read
+        """
+        # Maps each path relative to /etc/portage to its entry; insertion
+        # order guarantees that a directory precedes its contents
+        self._entries: dict[str, _Entry] = {}
+        for config_dir in config_dirs:
+            self._overlay(config_dir)
+
+    def get_file_contents(self, path: str) -> typing.Optional[bytes]:
+        """
+        Get the contents of a regular file in the tree.  If the path refers to
+        a directory, like a make.conf directory, the contents of the regular
+        files directly under it are concatenated in the order Portage reads
+        them.
+
+        :param path: the path relative to /etc/portage
+        :return: the file's contents, or `None` if the path does not exist
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if entry.kind == stat.S_IFDIR:
+            prefix = f'{path}/'
+            children = sorted(p for p in self._entries
+                              if p.startswith(prefix) and
+                              '/' not in p[len(prefix):])
+            contents = b''
+            for child in children:
+                child_contents = self.get_file_contents(child)
+                if self._entries[child].kind == stat.S_IFREG and \
+                        child_contents is not None:
+                    contents += child_contents
+            return contents
+        if entry.kind == stat.S_IFREG:
+            return entry.data
+        return None
+
+    def add_file(self, path: str, contents: str, mode: int = 0o644) -> None:
+        """
+        Add a regular file to the tree, replacing anything at the same path.
+        Any missing parent directories are created.
+
+        :param path: the path relative to /etc/portage
+        :param contents: the file's contents
+        :param mode: the file's permission bits (default: 0o644)
+        """
+        self._make_parent_dirs(path)
+        self._replace(path, _Entry(stat.S_IFREG, mode, data=contents.encode()))
+
+    def append_to_file(self, path: str, contents: str) -> None:
+        """
+        Append contents to a file in the tree.  The file is created if it does
+        not exist.  If the path refers to a directory, like a make.conf
+        directory, then the contents are put into a new file in the directory
+        that Portage will read last.
+
+        :param path: the path relative to /etc/portage
+        :param contents: the contents to append
+        """
+        entry = self._entries.get(path)
+        if entry is not None and entry.kind == stat.S_IFDIR:
+            path = f'{path}/{_APPENDED_FILE_NAME}'
+            entry = self._entries.get(path)
+        if entry is None or entry.kind != stat.S_IFREG:
+            self.add_file(path, contents)
+            return
+        existing = self.get_file_contents(path)
+        self._entries[path] = _Entry(stat.S_IFREG, entry.mode,
+                                     data=existing + contents.encode())
+
+    def get_digest(self) -> str:
+        """
+        Compute a digest of the tree that changes whenever the path, type,
+        permission bits or contents of any entry change.  Unlike the tar
+        archive, the digest does not depend on time stamps.
+
+        :return: the hexadecimal digest
+        """
+        digest = hashlib.sha256()
+        for path, entry in self._entries.items():
+            if entry.kind == stat.S_IFREG:
+                contents = self.get_file_contents(path)
+            elif entry.kind == stat.S_IFLNK:
+                contents = entry.link_target.encode()
+            else:
+                contents = b''
+            for part in (path.encode(), b'%d %o' % (entry.kind, entry.mode),
+                         contents):
+                digest.update(len(part).to_bytes(8, 'big'))
+                digest.update(part)
+        return digest.hexdigest()
+
+    def to_tar(self) -> bytes:
+        """
+        Create an uncompressed tar archive of the tree, with every member
+        owned by root.
+
+        :return: the archive's contents
+        """
+        buf = io.BytesIO()
+        now = time.time()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for path, entry in self._entries.items():
+                info = tarfile.TarInfo(path)
+                info.mode = entry.mode
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                info.mtime = now
+                fileobj = None
+                if entry.kind == stat.S_IFDIR:
+                    info.type = tarfile.DIRTYPE
+                elif entry.kind == stat.S_IFLNK:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = entry.link_target
+                else:
+                    data = self.get_file_contents(path)
+                    info.size = len(data)
+                    fileobj = io.BytesIO(data)
+                tar.addfile(info, fileobj)
+        return buf.getvalue()
+
+    def _overlay(self, config_dir: pathlib.Path) -> None:
+        for top, dirs, files in os.walk(config_dir):
+            rel_top = os.path.relpath(top, config_dir)
+            names = dirs + files
+            if rel_top == os.curdir:
+                # Mimic 'cp -r "$dir"/*', which skips hidden files
+                names = [name for name in names
+                         if not name.startswith('.') and
+                         name not in _IGNORED_TOP_LEVEL_ENTRIES]
+                dirs[:] = [name for name in dirs if name in names]
+            for name in sorted(names):
+                source = pathlib.Path(top, name)
+                path = name if rel_top == os.curdir else f'{rel_top}/{name}'
+                self._add_from_host(path, source)
+
+    def _add_from_host(self, path: str, source: pathlib.Path) -> None:
+        st = os.lstat(source)
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISLNK(st.st_mode):
+            entry = _Entry(stat.S_IFLNK, mode,
+                           link_target=os.readlink(source))
+        elif stat.S_ISDIR(st.st_mode):
+            existing = self._entries.get(path)
+            if existing is not None and existing.kind == stat.S_IFDIR:
+                # Directories are merged rather than replaced
+                return
+            entry = _Entry(stat.S_IFDIR, mode)
+        elif stat.S_ISREG(st.st_mode):
+            entry = _Entry(stat.S_IFREG, mode, data=source.read_bytes())
+        else:
+            return
+        self._replace(path, entry)
+
+    def _make_parent_dirs(self, path: str) -> None:
+        parent = os.path.dirname(path)
+        if not parent:
+            return
+        self._make_parent_dirs(parent)
+        existing = self._entries.get(parent)
+        if existing is None or existing.kind != stat.S_IFDIR:
+            self._replace(parent, _Entry(stat.S_IFDIR, 0o755))
+
+    def _replace(self, path: str, entry: _Entry) -> None:
+        prefix = f'{path}/'
+        for existing in [p for p in self._entries
+                         if p == path or p.startswith(prefix)]:
+            del self._entries[existing]
+        self._entries[path] = entry
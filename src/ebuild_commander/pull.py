@@ -0,0 +1,162 @@
+#  ebuild-commander Image Pull Policy Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import fcntl
+import json
+import os
+import pathlib
+import tempfile
+import typing
+
+from ebuild_commander.cache import get_user_cache_dir, hash_key
+
+# Always pull the image
+PULL_ALWAYS = 'always'
+
+# Pull the image only if it is not available locally
+PULL_IF_MISSING = 'if-missing'
+
+# Pull the image if it has not been pulled for a while
+PULL_IF_OLDER_THAN = 'if-older-than'
+
+
+class PullPolicy(typing.NamedTuple):
+    # One of the PULL_* constants
+    kind: str
+    # For PULL_IF_OLDER_THAN, the number of seconds after which an image
+    # needs to be pulled again
+    max_age: typing.Optional[float] = None
+
+
+class PullRecord(typing.NamedTuple):
+    # The time of the image's last successful pull, in seconds since the epoch
+    time: float
+    # The image's ID right after the pull
+    digest: str
+
+
+def should_pull(policy: PullPolicy, record: typing.Optional[PullRecord],
+                local_image_id: typing.Optional[str], now: float) -> bool:
+    """
+    Decide whether an image should be pulled.
+
+    :param policy: the pull policy
+    :param record: the record of the image's last pull, if any
+    :param local_image_id: the ID of the local copy of the image, or `None` if
+        the image is not available locally
+    :param now: the current time in seconds since the epoch
+    :return: whether or not the image should be pulled
+    """
+    if policy.kind == PULL_ALWAYS or local_image_id is None:
+        return True
+    if policy.kind == PULL_IF_MISSING:
+        return False
+    # The local copy might have been replaced since the last pull, e.g. by
+    # 'docker pull' or 'docker tag' outside of ebuild-commander
+    if record is None or record.digest != local_image_id:
+        return True
+    return now - record.time >= policy.max_age
+
+
+def get_default_records_path(
+        host: typing.Optional[str] = None) -> pathlib.Path:
+    """
+    :param host: the host of the endpoint the images are pulled on, or `None`
+        for the local Docker daemon
+    :return: the default directory for `PullRecords`, which follows the XDG
+        Base Directory Specification
+    """
+    path = get_user_cache_dir() / 'pulls'
+    if host is not None:
+        # Every Docker daemon has its own images
+        path = path / 'endpoints' / hash_key(host)
+    return path
+
+
+class PullRecords:
+    """
+    Records of the last pull of images that persist across runs, stored in a
+    directory with a file for each image.
+
+    Checking and updating an image's record should be done while holding a
+    lock on the image via `lock`, so when many containers are created from the
+    same image at once, only one of them pulls the image, and the others find
+    a fresh record once they get the lock.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._path = path
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    @contextlib.contextmanager
+    def lock(self, image: str) -> typing.Iterator[None]:
+        """
+        Hold an exclusive lock on an image's record in the body of a `with`
+        statement, waiting for any other holder to release it.
+
+        :param image: the image's name
+        :raise OSError: if the lock cannot be acquired
+        """
+        self._path.mkdir(parents=True, exist_ok=True)
+        with open(self._get_file(image, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def get(self, image: str) -> typing.Optional[PullRecord]:
+        """
+        :param image: the image's name
+        :return: the record of the image's last pull, or `None` if there is no
+            valid record
+        """
+        try:
+            with open(self._get_file(image, '.json')) as f:
+                data = json.load(f)
+            if data.get('image') != image:
+                return None
+            return PullRecord(float(data['time']), str(data['digest']))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def put(self, image: str, record: PullRecord) -> None:
+        """
+        Replace the record of an image's last pull.
+
+        :param image: the image's name
+        :param record: the new record
+        :raise OSError: if the record cannot be written
+        """
+        self._path.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'image': image, 'time': record.time,
+                           'digest': record.digest}, f)
+            os.replace(tmp_path, self._get_file(image, '.json'))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _get_file(self, image: str, suffix: str) -> pathlib.Path:
+        # Image names contain characters like '/' and ':'
+        return self._path / f'{hash_key(image)}{suffix}'
@@ -0,0 +1,443 @@
+#  ebuild-commander Sharded Build Module
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import math
+import re
+import shlex
+import signal
+import statistics
+import sys
+import typing
+
+from ebuild_commander.async_docker import AsyncCommandocker
+from ebuild_commander.history import split_cpv
+from ebuild_commander.out_fmt import info, error, format_duration, \
+    PrefixedWriter
+from ebuild_commander.policy import ExecutionPolicy
+
+# A line of 'emerge --pretend --tree' output for a package, where the number
+# of spaces after the brackets is one more than the package's depth in the
+# dependency tree
+_TREE_LINE = re.compile(r'\[(?P<kind>ebuild|binary|nomerge)\b[^]]*\]'
+                        r'(?P<indent> +)(?P<cpv>[^\s\[]+)')
+
+
+class TreeNode:
+    """
+    A package in the dependency tree printed by 'emerge --pretend --tree',
+    whose children are the packages it depends on that are shown under it.
+    """
+
+    def __init__(self, cpv: str, merge: bool):
+        """
+        :param cpv: the package's category, name and version, possibly with
+            its slot and repository, as shown by emerge
+        :param merge: whether the package will be merged, as opposed to a
+            package that is already installed and shown only because its
+            dependencies will be merged
+        """
+        self.cpv = cpv
+        self.merge = merge
+        self.children: list[TreeNode] = []
+
+    @property
+    def atom(self) -> str:
+        """
+        The atom matching exactly this package.
+        """
+        return f'={self.cpv}'
+
+    def get_weight(
+            self,
+            cost: typing.Optional[typing.Callable[['TreeNode'], float]] = None
+    ) -> float:
+        """
+        :param cost: a function that estimates the cost of merging a package
+            (default: 1 for every package)
+        :return: the total cost of the packages to be merged in the subtree
+            rooted at this package, which is their number by default
+        """
+        own = 0
+        if self.merge:
+            own = 1 if cost is None else cost(self)
+        return own + sum(child.get_weight(cost) for child in self.children)
+
+
+def parse_tree(output: str) -> list[TreeNode]:
+    """
+    Parse the output of 'emerge --pretend --tree' without colors.
+
+    :param output: the output
+    :return: the packages at the top of the dependency tree
+    """
+    roots = []
+    parents: list[tuple[int, TreeNode]] = []
+    for line in output.splitlines():
+        match = _TREE_LINE.match(line)
+        if match is None:
+            continue
+        depth = len(match.group('indent')) - 1
+        node = TreeNode(match.group('cpv'), match.group('kind') != 'nomerge')
+        while parents and parents[-1][0] >= depth:
+            parents.pop()
+        if parents:
+            parents[-1][1].children.append(node)
+        else:
+            roots.append(node)
+        parents.append((depth, node))
+    return roots
+
+
+def plan_shards(
+        roots: list[TreeNode], num_shards: int,
+        durations: typing.Optional[dict[str, float]] = None
+) -> list[list[TreeNode]]:
+    """
+    Divide the packages to be merged among shards.  Each shard gets whole
+    subtrees of the dependency tree, whose roots are merged with their
+    dependencies by one emerge command.  Subtrees heavier than an even share
+    are split into the subtrees of their children, leaving their roots to be
+    merged after all shards finish.
+
+    :param roots: the packages at the top of the dependency tree
+    :param num_shards: the number of shards
+    :param durations: the estimated build duration of packages, by category
+        and name, by which subtrees are weighed instead of by the number of
+        packages in them; packages without an estimate are assumed to take
+        the median of the estimates
+    :return: the roots of the subtrees for each shard
+    """
+    cost = _get_cost(durations)
+
+    def get_weight(node: TreeNode) -> float:
+        return node.get_weight(cost)
+
+    units = _get_units(roots)
+    total_weight = sum(get_weight(unit) for unit in units)
+    target_weight = math.ceil(total_weight / num_shards)
+    while units:
+        heaviest = max(units, key=get_weight)
+        if get_weight(heaviest) <= target_weight or not heaviest.children:
+            break
+        units.remove(heaviest)
+        units.extend(_get_units(heaviest.children))
+
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for unit in sorted(units, key=get_weight, reverse=True):
+        i = loads.index(min(loads))
+        shards[i].append(unit)
+        loads[i] += get_weight(unit)
+    return shards
+
+
+def _get_cost(durations: typing.Optional[dict[str, float]]) \
+        -> typing.Optional[typing.Callable[[TreeNode], float]]:
+    """
+    :return: a function that estimates the cost of merging a package from
+        the estimated build durations, or `None` if there is no estimate
+    """
+    if not durations:
+        return None
+    default_duration = statistics.median(durations.values())
+
+    def cost(node: TreeNode) -> float:
+        cpv = split_cpv(node.cpv)
+        if cpv is None:
+            return default_duration
+        return durations.get(cpv[0], default_duration)
+    return cost
+
+
+def _get_units(nodes: list[TreeNode]) -> list[TreeNode]:
+    """
+    :return: the subtrees with something to merge under the nodes, where a
+        node that will not be merged is replaced by its children
+    """
+    units = []
+    for node in nodes:
+        if not node.merge:
+            units.extend(_get_units(node.children))
+        elif node.get_weight() > 0:
+            units.append(node)
+    return units
+
+
+def find_shared_packages(merge_lists: list[list[TreeNode]]) -> list[str]:
+    """
+    Find the packages that more than one shard would merge.  The dependency
+    tree shows a package only once, under one of the packages that depend on
+    it, so the subtrees given to different shards may still need the same
+    packages.
+
+    :param merge_lists: the packages each shard would merge, as parsed from
+        the output of 'emerge --pretend' for the shard's subtrees
+    :return: the atoms matching exactly each package to be merged by more
+        than one shard, in the order they are first found
+    """
+    counts: dict[str, int] = {}
+    for roots in merge_lists:
+        for atom in dict.fromkeys(node.atom for node in _walk(roots)):
+            counts[atom] = counts.get(atom, 0) + 1
+    return [atom for atom, count in counts.items() if count > 1]
+
+
+def _walk(nodes: list[TreeNode]) -> typing.Iterator[TreeNode]:
+    """
+    :return: an iterator over the packages to be merged in the subtrees,
+        in the order they are shown
+    """
+    for node in nodes:
+        if node.merge:
+            yield node
+        yield from _walk(node.children)
+
+
+def read_package_list(path: str) -> list[str]:
+    """
+    Read atoms separated by whitespace from a file, ignoring comments that
+    start with '#'.
+
+    :param path: the file's path
+    :return: the atoms
+    :raise OSError: if the file cannot be read
+    """
+    atoms = []
+    with open(path) as f:
+        for line in f:
+            atoms.extend(line.partition('#')[0].split())
+    return atoms
+
+
+class ShardRunner:
+    """
+    Merge a list of packages with several containers that share a binary
+    package directory, driving an `AsyncCommandocker` for each shard from a
+    single event loop.
+
+    After the dependency tree is computed once in the first container, the
+    packages are divided among the shards by `plan_shards`.  Packages that
+    more than one shard would merge, as found by `find_shared_packages`, are
+    merged by the first container, and then each shard merges its part at
+    the same time.  Then, the first container merges the whole list, which
+    installs the packages built by the other shards from their binary
+    packages and builds the remaining packages.
+    """
+
+    def __init__(
+            self,
+            program_name: str,
+            num_shards: int,
+            create_container: typing.Callable[
+                [int, str, typing.BinaryIO], AsyncCommandocker],
+            should_cleanup: typing.Callable[[int], bool],
+            interrupt_status: int,
+            fail_fast: bool = False,
+            durations: typing.Optional[dict[str, float]] = None
+    ):
+        """
+        :param program_name: the program name for messages
+        :param num_shards: the number of shards, each of which has a container
+        :param create_container: a function that creates the container for a
+            shard, given the shard's 1-based index, the program name to use
+            for its messages, and the stream for its output
+        :param should_cleanup: a function that decides whether the containers
+            should be removed, given the exit status
+        :param interrupt_status: the exit status when the program was
+            interrupted
+        :param fail_fast: whether all commands of the scripts in a container
+            after a failed one should be skipped
+        :param durations: the estimated build duration of packages, by
+            category and name, for balancing the shards
+        """
+        self._program_name = program_name
+        self._num_shards = num_shards
+        self._create_container = create_container
+        self._should_cleanup = should_cleanup
+        self._interrupt_status = interrupt_status
+        self._fail_fast = fail_fast
+        self._durations = durations
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def run(self, scripts: list[tuple[str, list[str]]],
+            atoms: list[str]) -> int:
+        """
+        Run the scripts in every container to prepare it, then merge the
+        packages.  If this program is interrupted, the remaining commands are
+        skipped, and the containers are cleaned up.
+
+        :param scripts: the name and the lines of each script
+        :param atoms: the atoms of the packages to merge
+        :return: the exit status
+        """
+        return asyncio.run(self._run(scripts, atoms))
+
+    async def _run(self, scripts: list[tuple[str, list[str]]],
+                   atoms: list[str]) -> int:
+        outputs = []
+        containers = []
+        for i in range(1, self._num_shards + 1):
+            outputs.append(PrefixedWriter(sys.stdout.buffer, f'[{i}] '))
+            containers.append(self._create_container(
+                i, f'{self._program_name}[{i}]', outputs[-1]))
+        loop = asyncio.get_running_loop()
+        # Ctrl-C stops the commands in every container instead of raising
+        # KeyboardInterrupt at an arbitrary point of the event loop
+        loop.add_signal_handler(signal.SIGINT, self._interrupt)
+        try:
+            self._task = asyncio.ensure_future(
+                self._build(containers, outputs[0], scripts, atoms))
+            try:
+                exit_status = await self._task
+            except asyncio.CancelledError:
+                exit_status = self._interrupt_status
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+        await asyncio.gather(*(container.finish()
+                               for container in containers))
+        if self._should_cleanup(exit_status):
+            cleaned = await asyncio.gather(*(container.cleanup()
+                                             for container in containers))
+            if not all(cleaned):
+                exit_status = 3
+        for output in outputs:
+            output.close()
+        return exit_status
+
+    def _interrupt(self) -> None:
+        if self._task is not None and not self._task.done():
+            print(f"{error(self._program_name)}: Exiting on SIGINT",
+                  file=sys.stderr)
+            self._task.cancel()
+
+    async def _build(self, containers: list[AsyncCommandocker],
+                     first_output: typing.BinaryIO,
+                     scripts: list[tuple[str, list[str]]],
+                     atoms: list[str]) -> int:
+        statuses = await asyncio.gather(
+            *(self._prepare(container, scripts,
+                            ExecutionPolicy(f'{self._program_name}[{i}]',
+                                            self._fail_fast))
+              for i, container in enumerate(containers, start=1)))
+        if max(statuses) != 0:
+            return max(statuses)
+
+        shards = await self._plan(containers[0], first_output, atoms)
+        if shards is None:
+            return 1
+        shard_atoms = [(container, [unit.atom for unit in shard])
+                       for container, shard in zip(containers, shards)
+                       if shard]
+        shared = await self._find_shared(shard_atoms)
+        if shared is None:
+            return 1
+        if shared:
+            # Otherwise, the shards would build these packages at the same
+            # time; once they are built, the shards install them from the
+            # binary packages
+            print(f"{info(self._program_name)}: Merging {len(shared)} "
+                  f"package(s) needed by more than one shard in container "
+                  f"{containers[0].name} first", file=sys.stderr)
+            if not await self._merge(containers[0], shared, oneshot=True):
+                return 1
+        results = await asyncio.gather(
+            *(self._merge(container, atoms, oneshot=True)
+              for container, atoms in shard_atoms))
+        if not all(results):
+            return 1
+
+        print(f"{info(self._program_name)}: Merging all packages in "
+              f"container {containers[0].name}", file=sys.stderr)
+        if not await self._merge(containers[0], atoms):
+            return 1
+        return 0
+
+    @staticmethod
+    async def _prepare(container: AsyncCommandocker,
+                       scripts: list[tuple[str, list[str]]],
+                       policy: ExecutionPolicy) -> int:
+        if not await container.start():
+            return 3
+        return await container.run_scripts(scripts, policy, start=False)
+
+    async def _plan(
+            self, container: AsyncCommandocker, output: typing.BinaryIO,
+            atoms: list[str]) -> typing.Optional[list[list[TreeNode]]]:
+        cmd = (f'emerge --pretend --tree --color n --nospinner '
+               f'{shlex.join(atoms)}')
+        returncode, result = await container.capture(cmd)
+        if returncode != 0:
+            output.write(result)
+            output.flush()
+            print(f"{error(self._program_name)}: Exit status {returncode} "
+                  f"encountered while computing the dependency tree in "
+                  f"container {container.name}", file=sys.stderr)
+            return None
+        shards = plan_shards(parse_tree(result.decode(errors='replace')),
+                             self._num_shards, self._durations)
+        cost = _get_cost(self._durations)
+        for i, shard in enumerate(shards, start=1):
+            weight = sum(unit.get_weight() for unit in shard)
+            estimate = ''
+            if cost is not None:
+                duration = sum(unit.get_weight(cost) for unit in shard)
+                estimate = f" (about {format_duration(duration)})"
+            print(f"{info(self._program_name)}: Shard {i}: {weight} "
+                  f"package(s){estimate} under "
+                  f"{' '.join(unit.atom for unit in shard) or '(none)'}",
+                  file=sys.stderr)
+        return shards
+
+    async def _find_shared(
+            self, shard_atoms: list[tuple[AsyncCommandocker, list[str]]]
+    ) -> typing.Optional[list[str]]:
+        """
+        Compute in each shard's container the packages the shard would merge,
+        and find those needed by more than one shard.
+
+        :param shard_atoms: the container of each shard and the atoms of the
+            shard's subtrees
+        :return: the atoms of the packages needed by more than one shard, or
+            `None` if a computation fails
+        """
+        if len(shard_atoms) < 2:
+            return []
+        results = await asyncio.gather(
+            *(container.capture(f'emerge --pretend --oneshot --color n '
+                                f'--nospinner {shlex.join(atoms)}')
+              for container, atoms in shard_atoms))
+        merge_lists = []
+        for (container, _), (returncode, result) in zip(shard_atoms,
+                                                        results):
+            if returncode != 0:
+                print(f"{error(self._program_name)}: Exit status "
+                      f"{returncode} encountered while computing the "
+                      f"packages to merge in container {container.name}",
+                      file=sys.stderr)
+                return None
+            merge_lists.append(parse_tree(result.decode(errors='replace')))
+        return find_shared_packages(merge_lists)
+
+    @staticmethod
+    async def _merge(container: AsyncCommandocker, atoms: list[str],
+                     oneshot: bool = False) -> bool:
+        cmd = 'emerge --oneshot ' if oneshot else 'emerge '
+        return await container.execute(cmd + shlex.join(atoms))
@@ -0,0 +1,190 @@
+#  ebuild-commander Container Snapshot Management
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import json
+import subprocess
+import sys
+import typing
+
+from ebuild_commander.out_fmt import info, warn, error
+
+# Repository name of the images that store snapshots
+SNAPSHOT_REPOSITORY = 'ebuild-commander-snapshot'
+
+# Label storing the name of the image a snapshot was created from
+_LABEL_SOURCE_IMAGE = 'io.github.leo3418.ebuild-commander.source-image'
+
+# Label storing the ID of the image a snapshot was created from
+_LABEL_SOURCE_IMAGE_ID = 'io.github.leo3418.ebuild-commander.source-image-id'
+
+
+class Snapshot(typing.NamedTuple):
+    # The snapshot's image name, including the tag
+    name: str
+    # The snapshot's creation time as reported by Docker
+    created: str
+    # The name of the image the snapshot was created from
+    source_image: str
+    # The ID of the image the snapshot was created from
+    source_image_id: str
+
+
+def get_snapshot_name(key: str) -> str:
+    """
+    :param key: the key identifying all inputs used to configure the container
+        the snapshot is created from
+    :return: the image name of the snapshot for the key
+    """
+    return f'{SNAPSHOT_REPOSITORY}:{key}'
+
+
+def get_image_id(docker_cmd: str, image: str) -> typing.Optional[str]:
+    """
+    :param docker_cmd: the executable providing Docker functionalities
+    :param image: the image's name
+    :return: the image's ID, or `None` if the image is not available locally
+    """
+    result = subprocess.run([docker_cmd, 'image', 'inspect',
+                             '--format', '{{.Id}}', image],
+                            stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+
+def create_snapshot(docker_cmd: str, container_name: str, key: str,
+                    source_image: str, source_image_id: str) -> bool:
+    """
+    Commit a container to a snapshot image.
+
+    :param docker_cmd: the executable providing Docker functionalities
+    :param container_name: the container's name
+    :param key: the key identifying all inputs used to configure the container
+    :param source_image: the name of the image the container was created from
+    :param source_image_id: the ID of the image the container was created from
+    :return: whether or not the snapshot is successfully created
+    """
+    args = [docker_cmd, 'commit',
+            '--change', f'LABEL {_LABEL_SOURCE_IMAGE}={source_image}',
+            '--change', f'LABEL {_LABEL_SOURCE_IMAGE_ID}={source_image_id}',
+            container_name, get_snapshot_name(key)]
+    return subprocess.run(args, stdin=subprocess.DEVNULL,
+                          stdout=subprocess.DEVNULL).returncode == 0
+
+
+def list_snapshots(docker_cmd: str) -> list[Snapshot]:
+    """
+    :param docker_cmd: the executable providing Docker functionalities
+    :return: all snapshots available locally
+    :raise subprocess.CalledProcessError: if a Docker command failed
+    """
+    result = subprocess.run([docker_cmd, 'image', 'ls', '--format',
+                             '{{.Repository}}:{{.Tag}}', SNAPSHOT_REPOSITORY],
+                            check=True, stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True)
+    names = [name for name in result.stdout.split()
+             if name.startswith(f'{SNAPSHOT_REPOSITORY}:')]
+    if not names:
+        return []
+    result = subprocess.run([docker_cmd, 'image', 'inspect', *names],
+                            check=True, stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True)
+    snapshots = []
+    for name, image in zip(names, json.loads(result.stdout)):
+        labels = (image.get('Config') or {}).get('Labels') or {}
+        snapshots.append(Snapshot(name, image.get('Created', ''),
+                                  labels.get(_LABEL_SOURCE_IMAGE, ''),
+                                  labels.get(_LABEL_SOURCE_IMAGE_ID, '')))
+    return snapshots
+
+
+def is_stale(docker_cmd: str, snapshot: Snapshot,
+             image_ids: dict[str, typing.Optional[str]]) -> bool:
+    """
+    Check if a snapshot is stale, which means the image it was created from is
+    no longer the image with the same name available locally, e.g. because a
+    newer version of the image has been pulled.
+
+    :param docker_cmd: the executable providing Docker functionalities
+    :param snapshot: the snapshot
+    :param image_ids: a cache of the current IDs of images by name, which is
+        updated by this function
+    :return: whether or not the snapshot is stale
+    """
+    if snapshot.source_image not in image_ids:
+        image_ids[snapshot.source_image] = \
+            get_image_id(docker_cmd, snapshot.source_image)
+    return image_ids[snapshot.source_image] != snapshot.source_image_id
+
+
+def print_snapshots(program_name: str, docker_cmd: str) -> int:
+    """
+    Print the snapshots available locally to standard output.
+
+    :param program_name: the program name for messages
+    :param docker_cmd: the executable providing Docker functionalities
+    :return: the exit status for the program
+    """
+    try:
+        snapshots = list_snapshots(docker_cmd)
+    except subprocess.CalledProcessError as err:
+        print(f"{error(program_name)}: Command {err.cmd} failed with "
+              f"exit status {err.returncode}", file=sys.stderr)
+        return 3
+    image_ids = {}
+    for snapshot in snapshots:
+        status = 'stale' if is_stale(docker_cmd, snapshot, image_ids) \
+            else 'current'
+        print(f'{snapshot.name}\t{snapshot.created}\t'
+              f'{snapshot.source_image}\t{status}')
+    return 0
+
+
+def prune_snapshots(program_name: str, docker_cmd: str) -> int:
+    """
+    Remove the stale snapshots available locally.
+
+    :param program_name: the program name for messages
+    :param docker_cmd: the executable providing Docker functionalities
+    :return: the exit status for the program
+    """
+    try:
+        snapshots = list_snapshots(docker_cmd)
+    except subprocess.CalledProcessError as err:
+        print(f"{error(program_name)}: Command {err.cmd} failed with "
+              f"exit status {err.returncode}", file=sys.stderr)
+        return 3
+    image_ids = {}
+    exit_status = 0
+    for snapshot in snapshots:
+        if not is_stale(docker_cmd, snapshot, image_ids):
+            continue
+        result = subprocess.run([docker_cmd, 'image', 'rm', snapshot.name],
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL)
+        if result.returncode == 0:
+            print(f"{info(program_name)}: Removed stale snapshot "
+                  f"{snapshot.name}", file=sys.stderr)
+        else:
+            print(f"{warn(program_name)}: Cannot remove stale snapshot "
+                  f"{snapshot.name}", file=sys.stderr)
+            exit_status = 1
+    return exit_status
@@ -0,0 +1,157 @@
+#  ebuild-commander Timing Instrumentation
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+import threading
+import time
+import typing
+
+# Version of the format of the JSON report; please increase it when making
+# incompatible changes to the format
+REPORT_VERSION = 1
+
+
+class Origin(typing.NamedTuple):
+    """
+    The location of a command in the scripts.
+    """
+    # The script's path, or '-' for standard input
+    script: str
+    # The 1-based line number
+    line: int
+
+
+class TimingRecorder:
+    """
+    A thread-safe collection of wall-clock time spans, each of which covers
+    either a phase of a container's life cycle, like creating the container,
+    or the execution of a command in the container.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._spans = []
+
+    @contextlib.contextmanager
+    def phase(self, container: str, name: str) -> typing.Iterator[None]:
+        """
+        Record a span for a phase covering the body of a `with` statement.
+
+        :param container: the name of the container the phase is for
+        :param name: the phase's name
+        """
+        start = time.time()
+        start_counter = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add({
+                'kind': 'phase',
+                'container': container,
+                'name': name,
+                'start': start,
+                'duration': time.perf_counter() - start_counter,
+            })
+
+    def record_command(self, container: str, cmd: str, start: float,
+                       duration: float, status: int,
+                       origin: typing.Optional[Origin] = None) -> None:
+        """
+        Record a span for the execution of a command.
+
+        :param container: the name of the container the command was run in
+        :param cmd: the command
+        :param start: the time the command started, in seconds since the epoch
+        :param duration: the command's duration in seconds
+        :param status: the command's exit status
+        :param origin: the command's location in the scripts, if any
+        """
+        span = {
+            'kind': 'command',
+            'container': container,
+            'command': cmd.rstrip('\n'),
+            'start': start,
+            'duration': duration,
+            'status': status,
+        }
+        if origin is not None:
+            span['script'] = origin.script
+            span['line'] = origin.line
+        self._add(span)
+
+    def get_report(self) -> dict:
+        """
+        :return: a JSON-serializable report of all spans recorded so far
+        """
+        with self._lock:
+            spans = list(self._spans)
+        return {
+            'version': REPORT_VERSION,
+            'started': self._started,
+            'duration': time.time() - self._started,
+            'spans': spans,
+        }
+
+    def write_report(self, path: str) -> None:
+        """
+        Write the JSON report to a file.
+
+        :param path: the file's path
+        :raise OSError: if the file cannot be written
+        """
+        with open(path, 'w') as f:
+            json.dump(self.get_report(), f, indent=2)
+            f.write('\n')
+
+    def format_summary(self, num_commands: int) -> list[str]:
+        """
+        Summarize the total duration of each phase and the slowest commands in
+        human-readable lines.
+
+        :param num_commands: the maximum number of commands to include
+        :return: the lines of the summary
+        """
+        with self._lock:
+            spans = list(self._spans)
+        phase_totals = {}
+        for span in spans:
+            if span['kind'] == 'phase':
+                phase_totals[span['name']] = \
+                    phase_totals.get(span['name'], 0) + span['duration']
+        commands = sorted((span for span in spans
+                           if span['kind'] == 'command'),
+                          key=lambda span: span['duration'], reverse=True)
+        lines = ['Time spent in each phase:']
+        for name, duration in phase_totals.items():
+            lines.append(f'  {duration:10.3f}s  {name}')
+        lines.append('Slowest commands:')
+        for span in commands[:num_commands]:
+            location = ''
+            if 'script' in span:
+                location = f"{span['script']}:{span['line']}: "
+            lines.append(f"  {span['duration']:10.3f}s  "
+                         f"[{span['status']}] {location}{span['command']}")
+        return lines
+
+    def _add(self, span: dict) -> None:
+        with self._lock:
+            self._spans.append(span)
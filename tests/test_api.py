@@ -0,0 +1,194 @@
+#  Unit tests for api.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import io
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+import unittest.mock
+from ebuild_commander.api import *
+
+from ebuild_commander.endpoints import Endpoint
+from ebuild_commander.timing import Origin
+
+# Stands in for Docker without running any command it is given except for
+# 'echo', 'exit' and 'sleep', and logs the Docker commands it receives; no
+# container can be run on the daemon at tcp://down:2375
+_FAKE_DOCKER = '''#!/bin/bash
+cmd="${@: -1}"
+echo "$1 ${cmd}" >> "${0%/*}/calls"
+[[ "$1 ${DOCKER_HOST}" == "run tcp://down:2375" ]] && exit 125
+[[ "$1" == exec ]] || exit 0
+cat > /dev/null
+case "${@: -2:1}" in
+    TERM|KILL) kill -s "${@: -2:1}" "$(< "${0%/*}/pid")"; exit ;;
+esac
+case "${cmd}" in
+    echo\\ *) echo "${cmd#* }" ;;
+    exit\\ *) exit "${cmd#* }" ;;
+    sleep\\ *) echo $$ > "${0%/*}/pid"; exec sleep "${cmd#* }" ;;
+esac
+'''
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._docker_cmd = os.path.join(self._tmp.name, 'docker')
+        with open(self._docker_cmd, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(self._docker_cmd, 0o755)
+        self._output = io.BytesIO()
+        # Keep records like the build history away from the user's cache
+        environ = unittest.mock.patch.dict(
+            os.environ, {'XDG_CACHE_HOME': os.path.join(self._tmp.name,
+                                                        'cache')})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def _get_calls(self, kind: str) -> list[str]:
+        with open(os.path.join(self._tmp.name, 'calls')) as f:
+            return [line.split(' ', 1)[1].rstrip('\n') for line in f
+                    if line.startswith(f'{kind} ')]
+
+    def _runner(self, **kwargs) -> JobRunner:
+        return JobRunner('test', docker_cmd=self._docker_cmd,
+                         output=self._output, **kwargs)
+
+    def test_to_options(self):
+        opts = JobSpec([], profile='default/linux/amd64/17.1/desktop',
+                       threads=4, persistent_shell=True).to_options()
+        self.assertEqual(['default/linux/amd64/17.1/desktop'], opts.profile)
+        self.assertIsNone(opts.docker_image)
+        self.assertEqual(4, opts.threads)
+        self.assertTrue(opts.persistent_shell)
+        self.assertEqual('on-fail', opts.skip_cleanup)
+
+    def test_run(self):
+        specs = [JobSpec([('a.sh', ['echo foo', 'exit 2', 'echo bar'])],
+                         threads=1),
+                 JobSpec([('b.sh', ['echo baz'])], threads=1,
+                         skip_cleanup='never')]
+        with self._runner(max_jobs=1) as runner:
+            first, second = runner.run(specs)
+        self.assertEqual(1, first.exit_status)
+        self.assertFalse(first.succeeded)
+        self.assertFalse(first.cleaned_up)
+        self.assertEqual([('echo foo', Origin('a.sh', 1), 0),
+                          ('exit 2', Origin('a.sh', 2), 2),
+                          ('echo bar', Origin('a.sh', 3), 0)],
+                         [(result.command, result.origin, result.status)
+                          for result in first.commands])
+        self.assertIn('config_portage', first.phases)
+        # Steps run at the same time are recorded as separate phases
+        self.assertIn('prepare_config', first.phases)
+        self.assertIn('setup_caches', first.phases)
+        self.assertTrue(second.succeeded)
+        self.assertTrue(second.cleaned_up)
+        self.assertNotEqual(first.container_name, second.container_name)
+        self.assertEqual([second.container_name], self._get_calls('rm'))
+        self.assertEqual(b'[1] foo\n[1] bar\n[2] baz\n',
+                         self._output.getvalue())
+
+    def test_fail_fast(self):
+        spec = JobSpec([('a.sh', ['echo foo', 'exit 2', 'echo bar'])],
+                       threads=1, fail_fast=True)
+        with self._runner() as runner:
+            result, = runner.run([spec])
+        self.assertEqual(['echo foo', 'exit 2'],
+                         [command.command for command in result.commands])
+        self.assertEqual(['passed', 'failed', 'skipped'],
+                         [line.outcome for line in result.lines])
+
+    def test_history(self):
+        spec = JobSpec([('a.sh', ['echo foo'])], threads=1)
+        with self._runner() as runner:
+            runner.run([spec, spec._replace(history=True)])
+        # emerge's log is only read for the job using the build history
+        self.assertEqual(1, self._get_calls('exec').count(
+            '/var/log/emerge.log'))
+
+    def test_background_cleanup(self):
+        spec = JobSpec([('a.sh', ['echo foo'])], threads=1,
+                       background_cleanup=True)
+        with self._runner() as runner:
+            result, = runner.run([spec])
+        self.assertTrue(result.cleaned_up)
+        deadline = time.monotonic() + 10
+        while not self._get_calls('rm') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([result.container_name], self._get_calls('rm'))
+
+    def test_endpoints(self):
+        endpoints = [Endpoint('tcp://down:2375'), Endpoint('tcp://up:2375', 2)]
+        specs = [JobSpec([('a.sh', ['echo foo'])], threads=1),
+                 JobSpec([('b.sh', ['echo bar'])], threads=1)]
+        with self._runner(endpoints=endpoints) as runner:
+            first, second = runner.run(specs)
+        # The first job is retried on the other endpoint
+        self.assertTrue(first.succeeded)
+        self.assertEqual('tcp://up:2375', first.endpoint)
+        self.assertTrue(second.succeeded)
+        self.assertEqual('tcp://up:2375', second.endpoint)
+        self.assertEqual(3, len(self._get_calls('rm')))
+        with self._runner(endpoints=endpoints[:1]) as runner:
+            result, = runner.run(specs[:1])
+        self.assertEqual(EXIT_CONTAINER_ERROR, result.exit_status)
+        with self.assertRaises(ValueError):
+            self._runner(endpoints=endpoints[:1] * 2)
+        # The local machine's threads say nothing about the endpoints'
+        with self._runner(endpoints=endpoints) as runner:
+            with self.assertRaises(ValueError):
+                runner.run([JobSpec([('a.sh', ['echo foo'])])])
+
+    def test_invalid_spec(self):
+        with self._runner() as runner:
+            with self.assertRaises(ValueError):
+                runner.run([JobSpec([('a.sh', ['echo foo'])],
+                                    skip_cleanup='sometimes')])
+        # No container is created for any job
+        self.assertFalse(os.path.exists(os.path.join(self._tmp.name,
+                                                     'calls')))
+
+    def test_cancel(self):
+        async def run():
+            async with self._runner() as runner:
+                task = asyncio.ensure_future(runner.run_async(
+                    [JobSpec([('a.sh', ['sleep 30'])], threads=1,
+                             skip_cleanup='always')]))
+                await asyncio.sleep(1)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+        asyncio.run(run())
+        # The container is removed even though clean-up would be skipped
+        self.assertEqual(1, len(self._get_calls('rm')))
+
+    def test_missing_docker(self):
+        with self.assertRaises(FileNotFoundError):
+            JobRunner(docker_cmd=os.path.join(self._tmp.name, 'missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
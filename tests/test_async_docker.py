@@ -0,0 +1,122 @@
+#  Unit tests for async_docker.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import unittest
+from ebuild_commander.async_docker import *
+
+# Stands in for Docker by running 'docker exec' commands on the host, which is
+# enough for testing how commands are run and killed
+_FAKE_DOCKER = '''#!/bin/bash
+[[ "$1" == exec ]] || exit 0
+shift
+while [[ "$1" == -* ]]; do shift; done
+shift
+exec "$@"
+'''
+
+
+@unittest.skipIf(shutil.which('setsid') is None, 'setsid is not available')
+class TestAsyncCommandocker(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._docker_cmd = os.path.join(self._tmp.name, 'docker')
+        with open(self._docker_cmd, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(self._docker_cmd, 0o755)
+        self._output = io.BytesIO()
+
+    def _create(self, use_session: bool = False) -> AsyncCommandocker:
+        return AsyncCommandocker(
+            'ebuild-cmder', 'test', [], 'default/linux/amd64/17.1',
+            pathlib.Path('/var/db/repos/gentoo'), [], 1, '', 'gentoo/stage3',
+            False, None, self._docker_cmd, use_session=use_session,
+            output=self._output)
+
+    def test_execute(self):
+        async def run():
+            container = self._create()
+            self.assertTrue(await container.execute('echo foo; echo bar >&2'))
+            self.assertFalse(await container.execute('exit 2', False))
+        asyncio.run(run())
+        self.assertEqual(b'foo\nbar\n', self._output.getvalue())
+
+    def test_capture(self):
+        async def run():
+            container = self._create(use_session=True)
+            self.assertEqual((0, b'foo\nbar\n'),
+                             await container.capture('echo foo; echo bar >&2'))
+            self.assertEqual((2, b''), await container.capture('exit 2'))
+        asyncio.run(run())
+        self.assertEqual(b'', self._output.getvalue())
+
+    def test_session(self):
+        async def run():
+            container = self._create(use_session=True)
+            self.assertTrue(await container.execute('cd /; FOO=foo'))
+            self.assertTrue(await container.execute('echo "${PWD}${FOO}"'))
+            self.assertFalse(await container.execute('exit 3', False))
+            self.assertTrue(await container.execute('echo "${FOO}bar"'))
+            self.assertTrue(await container.cleanup())
+        asyncio.run(run())
+        self.assertEqual(b'/foo\nbar\n', self._output.getvalue())
+
+    def test_timeout(self):
+        marker = os.path.join(self._tmp.name, 'marker')
+
+        async def run():
+            container = self._create()
+            start = time.monotonic()
+            self.assertFalse(await container.execute(
+                f'sleep 2 && touch {marker} & sleep 30', timeout=0.5))
+            self.assertLess(time.monotonic() - start, 10)
+        asyncio.run(run())
+        # The background process must be killed along with the command
+        time.sleep(2)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_cancel(self):
+        marker = os.path.join(self._tmp.name, 'marker')
+
+        async def run():
+            container = self._create(use_session=True)
+            task = asyncio.ensure_future(container.execute(
+                f'sleep 2; touch {marker}'))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertTrue(await container.execute('echo alive'))
+            self.assertTrue(await container.cleanup())
+        asyncio.run(run())
+        time.sleep(2)
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(b'alive\n', self._output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#  Unit tests for cache.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+from ebuild_commander.cache import *
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._root = pathlib.Path(self._tmp.name) / 'cache'
+
+    @staticmethod
+    def _fill_partition(cache: CacheDir, key: str, size: int) -> None:
+        partition = cache.get_partition(key)
+        (partition / 'data').write_bytes(b'\0' * size)
+
+    def test_hash_key(self):
+        self.assertEqual(hash_key('a', 'b'), hash_key('a', b'b'))
+        self.assertNotEqual(hash_key('ab', 'c'), hash_key('a', 'bc'))
+
+    def test_no_eviction_without_limit(self):
+        cache = CacheDir(self._root)
+        cache.acquire()
+        self._fill_partition(cache, 'a', 100)
+        self.assertEqual([], cache.release())
+        self.assertEqual(100, cache.get_size())
+
+    def test_eviction(self):
+        cache = CacheDir(self._root, 250)
+        cache.acquire()
+        self._fill_partition(cache, 'old', 100)
+        self._fill_partition(cache, 'current', 100)
+        self._fill_partition(cache, 'new', 100)
+        self.assertEqual(['old'], cache.release(keep=['current']))
+        self.assertEqual(200, cache.get_size())
+
+    def test_eviction_keeps_entries(self):
+        cache = CacheDir(self._root, 50)
+        cache.acquire()
+        self._fill_partition(cache, 'current', 100)
+        self._fill_partition(cache, 'new', 100)
+        self.assertEqual(['new'], cache.release(keep=['current']))
+
+    def test_no_eviction_while_shared(self):
+        cache = CacheDir(self._root, 0)
+        other = CacheDir(self._root, 0)
+        cache.acquire()
+        other.acquire()
+        self._fill_partition(cache, 'a', 100)
+        self.assertEqual([], cache.release())
+        self.assertEqual(['a'], other.release())
+
+    def test_usage(self):
+        cache = CacheDir(self._root)
+        self._root.mkdir()
+        (self._root / 'used').write_bytes(b'\0' * 10)
+        (self._root / 'unused').write_bytes(b'\0' * 10)
+        os.utime(self._root / 'used', (0, 0))
+        os.utime(self._root / 'unused', (0, 0))
+        cache.acquire()
+        os.utime(self._root / 'used')
+        (self._root / 'added').write_bytes(b'\0' * 20)
+        self.assertEqual(CacheUsage(hits=1, misses=1, miss_size=20),
+                         cache.get_usage())
+        cache.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
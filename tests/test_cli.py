@@ -23,6 +23,8 @@ from ebuild_commander.cli import *
 
 import argparse
 
+from ebuild_commander.endpoints import Endpoint
+
 
 class TestCli(unittest.TestCase):
     def test_no_arguments(self):
@@ -54,6 +56,11 @@ class TestCli(unittest.TestCase):
         self.assertEqual(pathlib.Path('~/.config/portage'),
                          opts.portage_config[1])
 
+    def test_threads(self):
+        # The default depends on where the containers run
+        self.assertIsNone(parse_args(['emerge.sh'], False).threads)
+        self.assertEqual(4, parse_args(['--threads', '4'], False).threads)
+
     def test_threads_non_int(self):
         with self.assertRaises(argparse.ArgumentError):
             parse_args(['--threads', 'I'], False)
@@ -86,6 +93,212 @@ class TestCli(unittest.TestCase):
         opts = parse_args(['--emerge-opts', '\'--autounmask y\''])
         self.assertEqual('\'--autounmask y\'', opts.emerge_opts)
 
+    def test_persistent_shell(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertFalse(opts.persistent_shell)
+        opts = parse_args(['--persistent-shell', 'emerge.sh'], False)
+        self.assertTrue(opts.persistent_shell)
+
+    def test_size(self):
+        self.assertEqual(512, size('512'))
+        self.assertEqual(2 * 1024, size('2K'))
+        self.assertEqual(3 * 1024 ** 3, size('3GiB'))
+        self.assertEqual(4 * 1024 ** 2, size('4m'))
+        with self.assertRaises(ValueError):
+            size('-1G')
+        with self.assertRaises(ValueError):
+            size('1X')
+
+    def test_duration(self):
+        self.assertEqual(30, duration('30'))
+        self.assertEqual(90, duration('90s'))
+        self.assertEqual(2 * 3600, duration('2h'))
+        self.assertEqual(7 * 86400, duration('1w'))
+        with self.assertRaises(ValueError):
+            duration('1y')
+        with self.assertRaises(ValueError):
+            duration('')
+
+    def test_pull_policy(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertFalse(opts.pull)
+        self.assertIsNone(opts.pull_policy)
+        opts = parse_args(['--pull-policy', 'if-older-than=12h',
+                           'emerge.sh'], False)
+        self.assertEqual(PullPolicy('if-older-than', 12 * 3600),
+                         opts.pull_policy)
+        self.assertEqual(PullPolicy('always'), pull_policy('always'))
+        self.assertEqual(PullPolicy('if-missing'), pull_policy('if-missing'))
+        with self.assertRaises(ValueError):
+            pull_policy('if-older-than')
+        with self.assertRaises(ValueError):
+            pull_policy('if-missing=1d')
+        with self.assertRaises(ValueError):
+            pull_policy('never')
+
+    def test_binpkg_cache(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.binpkg_cache)
+        self.assertIsNone(opts.binpkg_cache_size)
+        opts = parse_args(['--binpkg-cache', '/var/cache/ebuild-cmder',
+                           '--binpkg-cache-size', '10G'], False)
+        self.assertEqual(pathlib.Path('/var/cache/ebuild-cmder'),
+                         opts.binpkg_cache)
+        self.assertEqual(10 * 1024 ** 3, opts.binpkg_cache_size)
+
+    def test_snapshot(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertFalse(opts.snapshot)
+        self.assertFalse(opts.list_snapshots)
+        self.assertFalse(opts.prune_snapshots)
+        opts = parse_args(['--snapshot', 'emerge.sh'], False)
+        self.assertTrue(opts.snapshot)
+
+    def test_no_profiles(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.profile)
+
+    def test_multiple_profiles(self):
+        opts = parse_args(['--profile', 'default/linux/amd64/17.1',
+                           '--profile', 'default/linux/amd64/17.1/systemd'],
+                          False)
+        self.assertEqual(['default/linux/amd64/17.1',
+                          'default/linux/amd64/17.1/systemd'], opts.profile)
+
+    def test_config_sets(self):
+        opts = parse_args(['--config-set', f'/etc/portage{os.pathsep}test',
+                           '--config-set', 'musl'], False)
+        self.assertEqual([[pathlib.Path('/etc/portage'),
+                           pathlib.Path('test')],
+                          [pathlib.Path('musl')]], opts.config_set)
+        with self.assertRaises(argparse.ArgumentError):
+            parse_args(['--config-set', f'/etc/portage{os.pathsep}'], False)
+
+    def test_ccache(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.ccache)
+        opts = parse_args(['--ccache', '/var/cache/ccache',
+                           '--ccache-size', '5G', 'emerge.sh'], False)
+        self.assertEqual(pathlib.Path('/var/cache/ccache'), opts.ccache)
+        self.assertEqual(5 * 1024 ** 3, opts.ccache_size)
+
+    def test_auto_tune(self):
+        self.assertFalse(parse_args(['emerge.sh'], False).auto_tune)
+        self.assertTrue(parse_args(['--auto-tune', 'emerge.sh'],
+                                   False).auto_tune)
+
+    def test_metadata_cache(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.metadata_cache)
+        self.assertIsNone(opts.metadata_cache_size)
+        opts = parse_args(['--metadata-cache', '/var/cache/ebuild-cmder-md',
+                           '--metadata-cache-size', '1G', 'emerge.sh'],
+                          False)
+        self.assertEqual(pathlib.Path('/var/cache/ebuild-cmder-md'),
+                         opts.metadata_cache)
+        self.assertEqual(1024 ** 3, opts.metadata_cache_size)
+
+    def test_tmpfs(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertFalse(opts.tmpfs)
+        self.assertIsNone(opts.tmpfs_size)
+        self.assertIsNone(opts.tmpfs_exclude)
+        opts = parse_args(['--tmpfs', '--tmpfs-size', '8G',
+                           '--tmpfs-exclude', 'www-client/chromium',
+                           '--tmpfs-exclude', 'dev-lang/rust', 'emerge.sh'],
+                          False)
+        self.assertTrue(opts.tmpfs)
+        self.assertEqual(8 * 1024 ** 3, opts.tmpfs_size)
+        self.assertEqual(['www-client/chromium', 'dev-lang/rust'],
+                         opts.tmpfs_exclude)
+
+    def test_shard(self):
+        opts = parse_args([], False)
+        self.assertIsNone(opts.shard_packages)
+        self.assertEqual(2, opts.shards)
+        opts = parse_args(['--shard-packages', 'packages.txt', '--shards',
+                           '4'], False)
+        self.assertEqual('packages.txt', opts.shard_packages)
+        self.assertEqual(4, opts.shards)
+        self.assertEqual(0, len(opts.scripts[0]))
+
+    def test_daemon(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.serve)
+        self.assertIsNone(opts.connect)
+        self.assertEqual(1, opts.pool_size)
+        opts = parse_args(['--serve', '/run/ebuild-cmder.sock',
+                           '--pool-size', '3'], False)
+        self.assertEqual(pathlib.Path('/run/ebuild-cmder.sock'), opts.serve)
+        self.assertEqual(3, opts.pool_size)
+
+    def test_timing(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.timing_report)
+        self.assertIsNone(opts.timing_summary)
+        opts = parse_args(['--timing-report', 'timing.json',
+                           '--timing-summary', '5', 'emerge.sh'], False)
+        self.assertEqual('timing.json', opts.timing_report)
+        self.assertEqual(5, opts.timing_summary)
+
+
+    def test_log_dir(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.log_dir)
+        self.assertEqual(20, opts.log_tail)
+        opts = parse_args(['--log-dir', 'logs', '--log-tail', '50',
+                           'emerge.sh'], False)
+        self.assertEqual(pathlib.Path('logs'), opts.log_dir)
+        self.assertEqual(50, opts.log_tail)
+
+    def test_fail_fast(self):
+        self.assertFalse(parse_args(['emerge.sh'], False).fail_fast)
+        self.assertTrue(parse_args(['--fail-fast', 'emerge.sh'],
+                                   False).fail_fast)
+
+
+    def test_gc_containers(self):
+        opts = parse_args(['--gc-containers'], False)
+        self.assertTrue(opts.gc_containers)
+        self.assertIsNone(opts.gc_max_age)
+        self.assertIsNone(opts.gc_keep)
+        self.assertFalse(opts.gc_all)
+        opts = parse_args(['--gc-containers', '--gc-max-age', '2d',
+                           '--gc-keep', '5', '--gc-all'], False)
+        self.assertEqual(172800, opts.gc_max_age)
+        self.assertEqual(5, opts.gc_keep)
+        self.assertTrue(opts.gc_all)
+        self.assertFalse(opts.background_cleanup)
+        self.assertTrue(parse_args(['--background-cleanup'],
+                                   False).background_cleanup)
+
+    def test_history(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.show_history)
+        self.assertFalse(opts.history)
+        self.assertEqual('', parse_args(['--show-history'],
+                                        False).show_history)
+        opts = parse_args(['--show-history', 'sys-libs/zlib'], False)
+        self.assertEqual('sys-libs/zlib', opts.show_history)
+        self.assertTrue(parse_args(['--history', 'emerge.sh'],
+                                   False).history)
+
+    def test_endpoint(self):
+        opts = parse_args(['emerge.sh'], False)
+        self.assertIsNone(opts.endpoint)
+        self.assertEqual(2, opts.endpoint_retries)
+        opts = parse_args(['--endpoint', 'ssh://user@build1=4',
+                           '--endpoint', 'build2', '--endpoint-retries', '1',
+                           'emerge.sh'], False)
+        self.assertEqual([Endpoint('ssh://user@build1', 4),
+                          Endpoint('build2', 1)], opts.endpoint)
+        self.assertEqual(1, opts.endpoint_retries)
+        self.assertEqual(Endpoint('tcp://build3:2376', 1),
+                         endpoint('tcp://build3:2376'))
+        for value in ('', '=2', 'build4=0'):
+            with self.assertRaises(ValueError):
+                endpoint(value)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,140 @@
+#  Unit tests for daemon.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import contextlib
+import io
+import json
+import socket
+import unittest
+from ebuild_commander.daemon import *
+from ebuild_commander.daemon import _parse_job_options
+
+
+class _FakeContainer:
+    """
+    Stands in for a container in a pool, recording how it is removed.
+    """
+
+    def __init__(self, opts: argparse.Namespace, name: str, output):
+        self.name = name
+        self.background_cleanup = opts.background_cleanup
+        self.removed_in_background = None
+
+    async def start(self) -> bool:
+        return True
+
+    async def run_scripts(self, scripts, policy, start=True,
+                          after_line=None) -> int:
+        return 0
+
+    async def finish(self) -> None:
+        pass
+
+    async def cleanup(self) -> bool:
+        self.removed_in_background = self.background_cleanup
+        return True
+
+
+class TestDaemon(unittest.TestCase):
+    def test_parse_job_options(self):
+        cwd = pathlib.Path('/home/user/project')
+        opts = _parse_job_options(
+            ['--connect', '/run/ebuild-cmder.sock',
+             '--portage-config', 'portage',
+             '--portage-config', '/etc/portage',
+             '--config-set', f'a{os.pathsep}/b',
+             '--custom-repo', '../repo',
+             '--profile', 'default/linux/amd64/17.1',
+             'emerge.sh'], cwd)
+        self.assertEqual([cwd / 'portage', pathlib.Path('/etc/portage')],
+                         opts.portage_config)
+        self.assertEqual([[cwd / 'a', pathlib.Path('/b')]], opts.config_set)
+        self.assertEqual([cwd / '../repo'], opts.custom_repo)
+        self.assertEqual(['default/linux/amd64/17.1'], opts.profile)
+
+    def test_parse_invalid_job_options(self):
+        with self.assertRaises(ValueError):
+            _parse_job_options(['--threads', 'many'], pathlib.Path('/'))
+        # Nothing is printed to the daemon's own output
+        with self.assertRaises(ValueError), \
+                contextlib.redirect_stdout(io.StringIO()) as stdout, \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            _parse_job_options(['--no-such-option'], pathlib.Path('/'))
+        with self.assertRaises(ValueError), \
+                contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            _parse_job_options(['--help'], pathlib.Path('/'))
+        with self.assertRaises(ValueError), \
+                contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            _parse_job_options(['--version'], pathlib.Path('/'))
+        self.assertEqual('', stdout.getvalue() + stderr.getvalue())
+        # The daemon cannot report timing to its clients
+        with self.assertRaises(ValueError):
+            _parse_job_options(['--timing-report', 'timing.json'],
+                               pathlib.Path('/'))
+        with self.assertRaises(ValueError):
+            _parse_job_options(['--timing-summary', '5'], pathlib.Path('/'))
+
+
+    def test_job_options(self):
+        containers = []
+
+        def create_container(opts, name, output):
+            containers.append(_FakeContainer(opts, name, output))
+            return containers[-1]
+
+        async def submit(daemon, args):
+            server_sock, client_sock = socket.socketpair()
+            reader, writer = await asyncio.open_connection(sock=server_sock)
+            client_reader, client_writer = \
+                await asyncio.open_connection(sock=client_sock)
+            client_writer.write(json.dumps({
+                'version': PROTOCOL_VERSION, 'cwd': '/', 'args': args,
+                'scripts': [('a.sh', ['true'])]}).encode() + b'\n')
+            await daemon._serve_client(reader, writer)
+            writer.close()
+            messages = [json.loads(line) for line in
+                        (await client_reader.read()).splitlines()]
+            client_writer.close()
+            return messages[-1]
+
+        async def run():
+            daemon = Daemon('test', pathlib.Path('/nonexistent'), 1,
+                            create_container, lambda opts: 'same',
+                            lambda opts, status: True, 130)
+            first = await submit(daemon, ['--background-cleanup'])
+            # The second job takes the container started for the pool with
+            # the first job's options
+            second = await submit(daemon, [])
+            await asyncio.gather(*daemon._warming, *daemon._retiring)
+            return first, second
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            first, second = asyncio.run(run())
+        self.assertEqual(containers[0].name, first['container'])
+        self.assertEqual(containers[1].name, second['container'])
+        self.assertEqual([True, False], [container.removed_in_background
+                                         for container in containers[:2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
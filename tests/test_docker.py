@@ -0,0 +1,121 @@
+#  Unit tests for docker.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import tempfile
+import unittest
+from ebuild_commander.docker import _SessionProtocol, _ShellSession
+
+# Stands in for Docker by running 'docker exec' commands on the host, which is
+# enough for testing how a persistent shell is driven
+_FAKE_DOCKER = '''#!/bin/bash
+[[ "$1" == exec ]] || exit 0
+shift
+while [[ "$1" == -* ]]; do shift; done
+shift
+exec "$@"
+'''
+
+
+def _parse_chunks(protocol: _SessionProtocol,
+                  chunks: list[bytes]) -> tuple[bytes, int]:
+    """
+    Feed data to the protocol in chunks like `_ShellSession.run` does.
+
+    :return: the command's output and its exit status
+    """
+    output = b''
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        data, buf, returncode = protocol.parse(buf)
+        output += data
+        if returncode is not None:
+            return output, returncode
+    raise AssertionError('no exit status found')
+
+
+class TestSessionProtocol(unittest.TestCase):
+    def setUp(self):
+        self._protocol = _SessionProtocol()
+        self._marker = self._protocol._marker
+
+    def test_no_trailing_newline(self):
+        self.assertEqual((b'foo', 0), _parse_chunks(
+            self._protocol, [b'foo' + self._marker + b':0\n']))
+
+    def test_split_marker(self):
+        chunks = [b'foo\nbar', self._marker[:5], self._marker[5:] + b':',
+                  b'3', b'\n']
+        self.assertEqual((b'foo\nbar', 3),
+                         _parse_chunks(self._protocol, chunks))
+
+    def test_partial_marker_in_output(self):
+        # What looks like the start of the marker is output once it turns
+        # out to be something else
+        prefix = self._marker[:10]
+        chunks = [b'foo' + prefix, b'bar\n', self._marker + b':1\n']
+        self.assertEqual((b'foo' + prefix + b'bar\n', 1),
+                         _parse_chunks(self._protocol, chunks))
+
+    def test_following_data_kept(self):
+        data, buf, returncode = self._protocol.parse(
+            b'foo' + self._marker + b':2\nbar')
+        self.assertEqual((b'foo', b'bar', 2), (data, buf, returncode))
+
+
+class TestShellSession(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._docker_cmd = os.path.join(self._tmp.name, 'docker')
+        with open(self._docker_cmd, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(self._docker_cmd, 0o755)
+        self._session = _ShellSession(self._docker_cmd, 'test')
+        self.addCleanup(self._session.close)
+
+    def _run(self, cmd: str) -> tuple[int, bytes]:
+        output = io.BytesIO()
+        return self._session.run(cmd, output), output.getvalue()
+
+    def test_output_without_newline(self):
+        self.assertEqual((0, b'foo'), self._run('printf foo'))
+        self.assertEqual((0, b'bar\n'), self._run('echo bar'))
+
+    def test_state_kept(self):
+        self.assertEqual((0, b''), self._run('cd /; FOO=foo'))
+        self.assertEqual((0, b'/foo\n'), self._run('echo "${PWD}${FOO}"'))
+
+    def test_non_zero_status(self):
+        self.assertEqual((4, b'foo\n'), self._run('echo foo; (exit 4)'))
+        self.assertEqual((2, b''), self._run('if'))
+        self.assertTrue(self._session.is_alive())
+        self.assertEqual((0, b'bar\n'), self._run('echo bar'))
+
+    def test_exit(self):
+        self.assertEqual((5, b'foo\n'), self._run('echo foo; exit 5'))
+        self.assertFalse(self._session.is_alive())
+        self.assertEqual(5, self._run('echo bar')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#  Unit tests for endpoints.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import asyncio
+import contextlib
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+from ebuild_commander.endpoints import *
+
+# Stands in for Docker by printing the endpoint it would use and its
+# arguments
+_FAKE_DOCKER = '''#!/bin/sh
+echo "${DOCKER_HOST}|${DOCKER_CONTEXT}|$*"
+'''
+
+
+class TestEndpoints(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._docker_cmd = os.path.join(self._tmp.name, 'docker')
+        with open(self._docker_cmd, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(self._docker_cmd, 0o755)
+        environ = unittest.mock.patch.dict(
+            os.environ, {'XDG_CACHE_HOME': os.path.join(self._tmp.name,
+                                                        'cache'),
+                         'DOCKER_HOST': 'unix:///run/docker.sock',
+                         'DOCKER_CONTEXT': 'default'})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def _run(self, docker_cmd: str) -> str:
+        return subprocess.run([docker_cmd, 'ps', '-a'], check=True,
+                              capture_output=True, text=True).stdout
+
+    def test_docker_cmd(self):
+        docker_cmd = get_endpoint_docker_cmd(self._docker_cmd,
+                                             Endpoint('ssh://user@build1'))
+        self.assertEqual('ssh://user@build1||ps -a\n', self._run(docker_cmd))
+        self.assertEqual(docker_cmd, get_endpoint_docker_cmd(
+            self._docker_cmd, Endpoint('ssh://user@build1', 4)))
+        docker_cmd = get_endpoint_docker_cmd(self._docker_cmd,
+                                             Endpoint("build 2's"))
+        self.assertEqual("|build 2's|ps -a\n", self._run(docker_cmd))
+        with self.assertRaises(FileNotFoundError):
+            get_endpoint_docker_cmd(os.path.join(self._tmp.name, 'missing'),
+                                    Endpoint('build1'))
+
+    def test_least_loaded(self):
+        first, second = Endpoint('build1', 2), Endpoint('build2')
+
+        async def run():
+            pool = EndpointPool('test', [first, second])
+            placed = [await pool.acquire() for _ in range(3)]
+            # Every endpoint is running as many jobs as its weight
+            waiting = asyncio.ensure_future(pool.acquire())
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiting.done())
+            await pool.release(second, True)
+            placed.append(await asyncio.wait_for(waiting, 10))
+            return placed
+
+        self.assertEqual([first, second, first, second], asyncio.run(run()))
+
+    def test_failures(self):
+        first, second = Endpoint('build1'), Endpoint('build2')
+
+        async def run():
+            pool = EndpointPool('test', [first, second])
+            self.assertIsNone(await pool.acquire([first, second]))
+            for _ in range(3):
+                endpoint = await pool.acquire([second])
+                await pool.release(endpoint, False)
+            # The first endpoint is no longer used
+            self.assertIsNone(await pool.acquire([second]))
+            return await pool.acquire()
+
+        self.assertEqual(second, asyncio.run(run()))
+
+    def test_run_on_endpoints(self):
+        first, second = Endpoint('build1'), Endpoint('build2')
+        attempts = []
+
+        async def attempt(endpoint, can_retry):
+            attempts.append((endpoint.host, can_retry))
+            if can_retry:
+                return None
+            return endpoint.host, False
+
+        async def run(retries):
+            pool = EndpointPool('test', [first, second])
+            result = await run_on_endpoints(pool, 'test', retries, attempt)
+            # Every endpoint has been released
+            self.assertEqual([first, second],
+                             [await pool.acquire() for _ in range(2)])
+            return result
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual('build2', asyncio.run(run(1)))
+            self.assertEqual([('build1', True), ('build2', False)], attempts)
+            attempts.clear()
+            self.assertEqual('build1', asyncio.run(run(0)))
+            self.assertEqual([('build1', False)], attempts)
+            attempts.clear()
+            self.assertIsNone(asyncio.run(run(2)))
+        self.assertEqual([('build1', True), ('build2', True)], attempts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,350 @@
+#  Unit tests for engine.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import http.server
+import io
+import json
+import os
+import pathlib
+import socketserver
+import struct
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import urllib.parse
+from ebuild_commander.engine import *
+
+from ebuild_commander.docker import Commandocker
+from ebuild_commander.history import BuildHistory, get_run_key
+from ebuild_commander.layer import LayerCache
+from ebuild_commander.leftovers import LABEL_PID
+from ebuild_commander.pull import PULL_ALWAYS, PullPolicy, PullRecords
+
+
+# Stands in for a Docker executable that uses the same daemon as the fake API,
+# which gives containers their names as IDs, unless $OTHER_DAEMON is set; it
+# is otherwise only used for getting images' IDs
+_FAKE_DOCKER = '''#!/bin/sh
+if [ "$1" = container ]; then
+    [ -z "${OTHER_DAEMON}" ] || exit 1
+    echo "$5"
+else
+    echo sha256:a
+fi
+'''
+
+
+class _FakeEngine(socketserver.ThreadingUnixStreamServer):
+    """
+    Stands in for the Docker Engine API without running any command it is
+    given.  A command's output is the command followed by its input, and its
+    exit status is the number after 'exit ' in the command, if any.
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, _FakeEngineHandler)
+        self.connections = 0
+        self.containers = {}
+        self.images = {'gentoo/stage3'}
+        self.pulls = []
+        self.execs = {}
+
+
+class _FakeEngineHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = self._get_parts()
+        if parts[0] == 'exec' and parts[2] == 'json':
+            self._reply(200, {'Running': False,
+                              'ExitCode': self.server.execs[parts[1]][1]})
+        else:
+            self._reply(404, {'message': 'page not found'})
+
+    def do_DELETE(self):
+        parts = self._get_parts()
+        if self.server.containers.pop(parts[1], None) is None:
+            self._reply(404, {'message': f'No such container: {parts[1]}'})
+        else:
+            self._reply(204)
+
+    def do_POST(self):
+        parts = self._get_parts()
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        if parts == ['containers', 'create']:
+            if body['Image'] not in self.server.images:
+                self._reply(404, {'message': 'No such image'})
+                return
+            self.server.containers[query['name'][0]] = body
+            self._reply(201, {'Id': query['name'][0]})
+        elif parts[0] == 'containers' and parts[2] == 'start':
+            if parts[1] not in self.server.containers:
+                self._reply(404, {'message': f'No such container: '
+                                             f'{parts[1]}'})
+            else:
+                self._reply(204)
+        elif parts[0] == 'containers' and parts[2] == 'exec':
+            exec_id = f'exec{len(self.server.execs)}'
+            self.server.execs[exec_id] = (body, None)
+            self._reply(201, {'Id': exec_id})
+        elif parts[0] == 'exec' and parts[2] == 'start':
+            self._start_exec(parts[1])
+        elif parts == ['images', 'create']:
+            image = f"{query['fromImage'][0]}:{query['tag'][0]}"
+            self.server.pulls.append(image)
+            if query['fromImage'][0] == 'nonexistent':
+                lines = [{'status': 'Pulling'}, {'error': 'manifest unknown'}]
+            else:
+                self.server.images.add(image)
+                lines = [{'status': 'Pulling'}, {'status': 'Done'}]
+            self._reply(200, b''.join(json.dumps(line).encode() + b'\r\n'
+                                      for line in lines))
+        else:
+            self._reply(404, {'message': 'page not found'})
+
+    def _start_exec(self, exec_id: str):
+        config, _ = self.server.execs[exec_id]
+        self.send_response(101)
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Upgrade', 'tcp')
+        self.end_headers()
+        self.wfile.flush()
+        data = self.rfile.read() if config['AttachStdin'] else b''
+        cmd = config['Cmd'][-1]
+        stdout = f'{cmd}\n'.encode() + data
+        # Split a frame across writes
+        header = struct.pack('>BxxxL', STREAM_STDOUT, len(stdout))
+        self.wfile.write(header[:3])
+        self.wfile.flush()
+        self.wfile.write(header[3:] + stdout[:2])
+        self.wfile.flush()
+        self.wfile.write(stdout[2:])
+        self.wfile.write(struct.pack('>BxxxL', STREAM_STDERR, 4) + b'err\n')
+        self.wfile.flush()
+        exit_code = int(cmd[5:]) if cmd.startswith('exit ') else 0
+        self.server.execs[exec_id] = (config, exit_code)
+        self.close_connection = True
+
+    def _get_parts(self) -> list[str]:
+        path = urllib.parse.urlsplit(self.path).path
+        return [urllib.parse.unquote(part) for part in path.split('/')[1:]]
+
+    def _reply(self, status: int, body=None):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body or b'')))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+
+class TestEngine(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        socket_path = os.path.join(self._tmp.name, 'docker.sock')
+        self.server = _FakeEngine(socket_path)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = EngineClient(socket_path)
+        self.addCleanup(self.client.close)
+        self._docker_cmd = os.path.join(self._tmp.name, 'docker')
+        with open(self._docker_cmd, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(self._docker_cmd, 0o755)
+
+    def test_split_image_name(self):
+        self.assertEqual(('gentoo/stage3', 'latest'),
+                         split_image_name('gentoo/stage3'))
+        self.assertEqual(('gentoo/stage3', 'amd64-openrc'),
+                         split_image_name('gentoo/stage3:amd64-openrc'))
+        self.assertEqual(('localhost:5000/stage3', 'latest'),
+                         split_image_name('localhost:5000/stage3'))
+        self.assertEqual(('localhost:5000/stage3', 'musl'),
+                         split_image_name('localhost:5000/stage3:musl'))
+        self.assertEqual(('gentoo/stage3', 'sha256:0123'),
+                         split_image_name('gentoo/stage3@sha256:0123'))
+
+    def test_read_frames(self):
+        stream = io.BytesIO(struct.pack('>BxxxL', 1, 4) + b'foo\n' +
+                            struct.pack('>BxxxL', 2, 0) +
+                            struct.pack('>BxxxL', 2, 4) + b'bar\n')
+        self.assertEqual([(1, b'foo\n'), (2, b''), (2, b'bar\n')],
+                         list(read_frames(stream)))
+        with self.assertRaises(EOFError):
+            list(read_frames(io.BytesIO(struct.pack('>BxxxL', 1, 4) +
+                                        b'fo')))
+        with self.assertRaises(EOFError):
+            list(read_frames(io.BytesIO(b'\x01\x00')))
+
+    def test_containers(self):
+        self.assertEqual('test', self.client.create_container(
+            'test', {'Image': 'gentoo/stage3'}))
+        self.client.start_container('test')
+        self.client.remove_container('test')
+        self.assertEqual({}, self.server.containers)
+        with self.assertRaises(EngineError) as cm:
+            self.client.remove_container('test')
+        self.assertEqual(404, cm.exception.status)
+        self.assertEqual('No such container: test', cm.exception.message)
+        # All requests are sent on the same connection
+        self.assertEqual(1, self.server.connections)
+
+    def test_pull(self):
+        self.client.pull_image('gentoo/stage3:amd64-openrc')
+        with self.assertRaises(EngineError) as cm:
+            self.client.pull_image('nonexistent')
+        self.assertEqual('manifest unknown', cm.exception.message)
+        self.assertEqual(['gentoo/stage3:amd64-openrc', 'nonexistent:latest'],
+                         self.server.pulls)
+
+    def test_exec(self):
+        self.client.create_container('test', {'Image': 'gentoo/stage3'})
+        output = io.BytesIO()
+        self.assertEqual(3, self.client.exec('test',
+                                             ['/bin/bash', '-c', 'exit 3'],
+                                             b'input\n', output))
+        self.assertEqual(b'exit 3\ninput\nerr\n', output.getvalue())
+        output = io.BytesIO()
+        self.assertEqual(0, self.client.exec('test', ['true'],
+                                             output=output))
+        self.assertEqual(b'true\nerr\n', output.getvalue())
+
+    def test_commandocker(self):
+        output = io.BytesIO()
+        container = Commandocker(
+            'ebuild-cmder', 'test', [], 'default/linux/amd64/17.1',
+            pathlib.Path(self._tmp.name), [], 1, '', 'gentoo/stage3:musl',
+            False, 'size=10G', self._docker_cmd, engine=self.client,
+            output=output)
+        self.assertTrue(container.start())
+        config = self.server.containers['test']
+        self.assertEqual('gentoo/stage3:musl', config['Image'])
+        self.assertEqual([f'{self._tmp.name}:/var/db/repos/gentoo:ro'],
+                         config['HostConfig']['Binds'])
+        self.assertEqual({'size': '10G'}, config['HostConfig']['StorageOpt'])
+        self.assertEqual(str(os.getpid()), config['Labels'][LABEL_PID])
+        # The missing image is pulled before the container is created
+        self.assertEqual(['gentoo/stage3:musl'], self.server.pulls)
+        self.assertTrue(container.execute('echo foo'))
+        self.assertFalse(container.execute('exit 2', False))
+        container.finish()
+        self.assertTrue(container.cleanup())
+        self.assertEqual({}, self.server.containers)
+        self.assertIn(b'echo foo\nerr\nexit 2\nerr\n', output.getvalue())
+
+    def test_history(self):
+        history = BuildHistory(pathlib.Path(self._tmp.name, 'history.db'))
+        commands = ['echo foo', 'echo bar']
+        layer_cache = unittest.mock.Mock(spec=LayerCache)
+        layer_cache.list_keys.return_value = set()
+        layer_cache.evict.return_value = []
+        for layer in (None, 'foo'):
+            container = Commandocker(
+                'ebuild-cmder', f'test-{layer}', [],
+                'default/linux/amd64/17.1',
+                pathlib.Path(self._tmp.name), [], 1, '', 'gentoo/stage3',
+                False, None, self._docker_cmd, layer_cache=layer_cache,
+                engine=self.client, build_history=history,
+                output=io.BytesIO())
+            with unittest.mock.patch(
+                    'ebuild_commander.docker.find_deepest_layer',
+                    return_value=(int(layer is not None), layer)), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                self.assertTrue(container.start(commands))
+                for cmd in commands[container.skipped_commands:]:
+                    self.assertTrue(container.execute(cmd))
+                container.finish()
+            self.assertTrue(container.cleanup())
+            # Only the full run is recorded
+            self.assertEqual(1, history.estimate_run(
+                get_run_key(commands), 'default/linux/amd64/17.1',
+                'gentoo/stage3')[1])
+
+    def test_unwritable_pull_record(self):
+        records = PullRecords(pathlib.Path(self._tmp.name, 'pulls'))
+        container = Commandocker(
+            'ebuild-cmder', 'test', [], 'default/linux/amd64/17.1',
+            pathlib.Path(self._tmp.name), [], 1, '', 'gentoo/stage3:musl',
+            False, None, self._docker_cmd,
+            pull_policy=PullPolicy(PULL_ALWAYS),
+            pull_records=records, engine=self.client, output=io.BytesIO())
+        denied = PermissionError(13, 'Permission denied', 'pulls')
+        with unittest.mock.patch.object(PullRecords, 'put',
+                                        side_effect=denied):
+            self.assertTrue(container.start())
+        # The image is not pulled again because the record is not written
+        self.assertEqual(['gentoo/stage3:musl'], self.server.pulls)
+        container.finish()
+        self.assertTrue(container.cleanup())
+
+    def test_other_daemon(self):
+        container = Commandocker(
+            'ebuild-cmder', 'test', [], 'default/linux/amd64/17.1',
+            pathlib.Path(self._tmp.name), [], 1, '', 'gentoo/stage3',
+            False, None, self._docker_cmd, engine=self.client,
+            output=io.BytesIO())
+        with unittest.mock.patch.dict(os.environ, {'OTHER_DAEMON': '1'}), \
+                contextlib.redirect_stderr(io.StringIO()) as messages:
+            # Commands run with the Docker executable would not find the
+            # container
+            self.assertFalse(container.start())
+        self.assertIn('must use the same daemon', messages.getvalue())
+        container.finish()
+        self.assertTrue(container.cleanup())
+        self.assertEqual({}, self.server.containers)
+
+    def test_unreadable_config(self):
+        config_dir = pathlib.Path(self._tmp.name, 'config')
+        config_dir.mkdir()
+        (config_dir / 'make.conf').write_text('USE="a"\n')
+        container = Commandocker(
+            'ebuild-cmder', 'test', [config_dir], 'default/linux/amd64/17.1',
+            pathlib.Path(self._tmp.name), [], 1, '', 'gentoo/stage3:musl',
+            False, None, os.path.join(self._tmp.name, 'missing'),
+            engine=self.client, output=io.BytesIO())
+        denied = PermissionError(13, 'Permission denied',
+                                 str(config_dir / 'make.conf'))
+        with unittest.mock.patch.object(pathlib.Path, 'read_bytes',
+                                        side_effect=denied):
+            self.assertFalse(container.start())
+        self.assertEqual({}, self.server.containers)
+
+
+if __name__ == '__main__':
+    unittest.main()
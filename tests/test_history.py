@@ -0,0 +1,114 @@
+#  Unit tests for history.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import pathlib
+import tempfile
+import unittest
+from ebuild_commander.history import *
+
+_EMERGE_LOG = '''\
+1650000000: Started emerge on: Apr 15, 2022 05:20:00
+1650000000:  *** emerge --oneshot sys-libs/zlib dev-libs/expat app-misc/foo
+1650000010:  >>> emerge (1 of 3) sys-libs/zlib-1.2.11-r4 to /
+1650000011:  === (1 of 3) Cleaning (sys-libs/zlib-1.2.11-r4::/var/db/repos/\
+gentoo/sys-libs/zlib/zlib-1.2.11-r4.ebuild)
+1650000100:  ::: completed emerge (1 of 3) sys-libs/zlib-1.2.11-r4 to /
+1650000110:  >>> emerge (2 of 3) dev-libs/expat-2.4.8 to /
+1650000111:  === (2 of 3) Merging Binary (dev-libs/expat-2.4.8::/var/cache/\
+binpkgs/dev-libs/expat-2.4.8.tbz2)
+1650000120:  ::: completed emerge (2 of 3) dev-libs/expat-2.4.8 to /
+1650000130:  >>> emerge (3 of 3) app-misc/foo-1.0 to /
+1650000140:  *** exiting unsuccessfully with status '1'.
+'''
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._history = BuildHistory(
+            pathlib.Path(self._tmp.name) / 'cache' / 'history.sqlite')
+
+    def test_split_cpv(self):
+        self.assertEqual(('sys-libs/zlib', '1.2.11-r4'),
+                         split_cpv('sys-libs/zlib-1.2.11-r4::gentoo'))
+        self.assertEqual(('dev-libs/b', '2'), split_cpv('dev-libs/b-2:0/2'))
+        self.assertEqual(('dev-lang/python', '3.10.4_p1'),
+                         split_cpv('dev-lang/python-3.10.4_p1'))
+        self.assertIsNone(split_cpv('virtual/foo'))
+
+    def test_parse_emerge_log(self):
+        self.assertEqual(
+            [Build('sys-libs/zlib', '1.2.11-r4', 1650000010, 90, False),
+             Build('dev-libs/expat', '2.4.8', 1650000110, 10, True)],
+            parse_emerge_log(_EMERGE_LOG))
+        self.assertEqual(['dev-libs/expat'],
+                         [build.package for build in
+                          parse_emerge_log(_EMERGE_LOG, 1650000100)])
+        self.assertEqual([], parse_emerge_log(''))
+
+    def test_estimate_run(self):
+        key = get_run_key(['emerge sys-libs/zlib'])
+        self.assertIsNone(self._history.estimate_run(key, 'p', 'i'))
+        for i, duration in enumerate((100, 300, 200)):
+            self._history.add_run(key, 'p', 'i', i, duration, f'c{i}')
+        # A container is only recorded once
+        self._history.add_run(key, 'p', 'i', 3, 1000, 'c0')
+        self._history.add_run(key, 'q', 'i', 4, 1000, 'c4')
+        self.assertEqual((200, 3), self._history.estimate_run(key, 'p', 'i'))
+        self.assertIsNone(self._history.estimate_run(
+            get_run_key(['emerge dev-libs/expat']), 'p', 'i'))
+
+    def test_build_durations(self):
+        builds = parse_emerge_log(_EMERGE_LOG)
+        self._history.add_builds(builds, 'p', 'i', 'c0')
+        self._history.add_builds(builds, 'p', 'i', 'c0')
+        self._history.add_builds(
+            [Build('sys-libs/zlib', '1.2.12', 1650001000, 110, False)],
+            'p', 'i', 'c1')
+        # Binary packages do not count
+        self.assertEqual({'sys-libs/zlib': 100},
+                         self._history.get_build_durations('p', 'i'))
+        self.assertEqual({}, self._history.get_build_durations('p', 'j'))
+        trend, = self._history.get_trends()
+        self.assertEqual(
+            Trend('sys-libs/zlib', 'p', 'i', 2, 110, 100, 90, 110, 90), trend)
+        self.assertEqual([], self._history.get_trends('dev-libs/expat'))
+
+    def test_print_trends(self):
+        self._history.add_builds(
+            [Build('sys-libs/zlib', '1.2.11', 0, 100, False),
+             Build('sys-libs/zlib', '1.2.12', 200, 3725, False)],
+            'p', 'i', 'c0')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(0, print_trends('test', self._history))
+        header, row = output.getvalue().splitlines()
+        self.assertEqual(['PACKAGE', 'PROFILE', 'IMAGE', 'BUILDS', 'LAST',
+                          'MEDIAN', 'MIN', 'MAX', 'TREND'], header.split())
+        self.assertEqual(['sys-libs/zlib', 'p', 'i', '2', '1h', '02m',
+                          '31m', '52s', '1m', '40s', '1h', '02m', '+3625%'],
+                         row.split())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#  Unit tests for host.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import os
+import pathlib
+import tempfile
+import unittest
+from ebuild_commander.host import *
+
+
+class TestHost(unittest.TestCase):
+    def test_available_memory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            meminfo = os.path.join(tmp, 'meminfo')
+            with open(meminfo, 'w') as f:
+                f.write('MemTotal:       32768000 kB\n'
+                        'MemFree:         1024000 kB\n'
+                        'MemAvailable:   16384000 kB\n')
+            self.assertEqual(16384000 * 1024, get_available_memory(meminfo))
+            with open(meminfo, 'w') as f:
+                f.write('MemTotal:       32768000 kB\n')
+            self.assertIsNone(get_available_memory(meminfo))
+            self.assertIsNone(
+                get_available_memory(os.path.join(tmp, 'nonexistent')))
+
+    def test_tmpfs_size(self):
+        gib = 1024 ** 3
+        self.assertEqual(16 * gib - 8 * MEMORY_PER_JOB,
+                         get_tmpfs_size(16 * gib, 8))
+        self.assertEqual(0, get_tmpfs_size(8 * gib, 8))
+        self.assertEqual(0, get_tmpfs_size(MIN_TMPFS_SIZE - 1, 0))
+
+
+    def test_cgroup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            proc_cgroup = os.path.join(tmp, 'cgroup')
+            with open(proc_cgroup, 'w') as f:
+                f.write('0::/user.slice/session-1.scope\n')
+            cgroup_dir = get_cgroup_dir(tmp, proc_cgroup)
+            self.assertEqual(
+                pathlib.Path(tmp, 'user.slice', 'session-1.scope'),
+                cgroup_dir)
+            self.assertIsNone(get_cgroup_cpu_limit(cgroup_dir, tmp))
+            self.assertIsNone(get_cgroup_memory_limit(cgroup_dir, tmp))
+
+            cgroup_dir.mkdir(parents=True)
+            (cgroup_dir / 'cpu.max').write_text('max 100000\n')
+            (cgroup_dir / 'memory.max').write_text('8589934592\n')
+            (cgroup_dir.parent / 'cpu.max').write_text('400000 100000\n')
+            (cgroup_dir.parent / 'memory.max').write_text('max\n')
+            pathlib.Path(tmp, 'cpu.max').write_text('800000 100000\n')
+            self.assertEqual(4.0, get_cgroup_cpu_limit(cgroup_dir, tmp))
+            self.assertEqual(8 * 1024 ** 3,
+                             get_cgroup_memory_limit(cgroup_dir, tmp))
+
+            with open(proc_cgroup, 'w') as f:
+                f.write('1:name=systemd:/user.slice\n')
+            self.assertIsNone(get_cgroup_dir(tmp, proc_cgroup))
+
+    def test_tuning(self):
+        gib = 1024 ** 3
+        # Plenty of memory: 16 jobs split into 4 emerge jobs of 4 each
+        self.assertEqual(Tuning(4, 4, 16.0, 16.0, 64 * gib),
+                         get_tuning(16, 64 * gib, 0.0, 0, 1))
+        # Memory bounds the number of jobs
+        self.assertEqual(Tuning(3, 2, 16.0, 16.0, 6 * gib),
+                         get_tuning(16, 6 * gib, 0.0, 0, 1))
+        # Running containers and the load reduce each container's share
+        self.assertEqual(Tuning(2, 2, 16.0, 4.0, 32 * gib),
+                         get_tuning(16, 64 * gib, 8.0, 2, 2))
+        self.assertEqual(Tuning(1, 1, 16.0, 1.0, gib // 2),
+                         get_tuning(16, gib, 20.0, 0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#  Unit tests for layer.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+from ebuild_commander.layer import *
+
+# Stands in for Docker by keeping an image for each file in the directory
+# given by $IMAGES, whose contents are the image's size
+_FAKE_DOCKER = '''#!/bin/bash
+case "$1 $2" in
+    'image ls') cd "${IMAGES}" && for f in *; do echo "${f/@/:}"; done ;;
+    'image inspect') cat "${IMAGES}/${!#/:/@}" ;;
+    'image rm') rm "${IMAGES}/${3/:/@}" ;;
+    commit*) echo $(( $(cat "${IMAGES}/base") + 10 )) > "${IMAGES}/${3/:/@}" ;;
+esac
+'''
+
+
+class TestLayer(unittest.TestCase):
+    def test_noop(self):
+        self.assertTrue(is_noop('\n'))
+        self.assertTrue(is_noop('  # emerge sys-apps/portage\n'))
+        self.assertFalse(is_noop('emerge sys-apps/portage # update\n'))
+
+    def test_layer_key(self):
+        key = get_layer_key('base', 'emerge foo\n')
+        self.assertEqual(key, get_layer_key('base', 'emerge foo'))
+        self.assertNotEqual(key, get_layer_key('base2', 'emerge foo'))
+        self.assertNotEqual(key, get_layer_key('base', 'emerge bar'))
+
+    def test_find_deepest_layer(self):
+        cmds = ['emerge foo\n', '# comment\n', 'emerge bar\n', 'emerge baz\n']
+        key1 = get_layer_key('base', cmds[0])
+        key3 = get_layer_key(key1, cmds[2])
+        key4 = get_layer_key(key3, cmds[3])
+        self.assertEqual((0, None), find_deepest_layer('base', cmds, set()))
+        self.assertEqual((2, key1),
+                         find_deepest_layer('base', cmds, {key1}))
+        self.assertEqual((3, key3),
+                         find_deepest_layer('base', cmds, {key1, key3}))
+        # Layers for shorter prefixes may have been evicted
+        self.assertEqual((4, key4),
+                         find_deepest_layer('base', cmds, {key4}))
+        self.assertEqual((0, None),
+                         find_deepest_layer('other', cmds, {key1, key4}))
+        self.assertEqual((2, key1), find_deepest_layer(
+            'base', cmds[:2] + ['emerge qux\n'], {key1, key3}))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            docker_cmd = os.path.join(tmp, 'docker')
+            with open(docker_cmd, 'w') as f:
+                f.write(_FAKE_DOCKER)
+            os.chmod(docker_cmd, 0o755)
+            images = pathlib.Path(tmp, 'images')
+            images.mkdir()
+            (images / 'base').write_text('100\n')
+            os.environ['IMAGES'] = str(images)
+            self.addCleanup(os.environ.pop, 'IMAGES')
+
+            cache = LayerCache(docker_cmd, pathlib.Path(tmp, 'index'), 2, 25)
+            self.assertEqual(set(), cache.list_keys())
+            for key in ('a', 'b', 'c'):
+                self.assertTrue(cache.add('test', key, 'base'))
+                # Make the order of last use unambiguous
+                time.sleep(0.01)
+            self.assertEqual({'a', 'b', 'c'}, cache.list_keys())
+            cache.use('a')
+            self.assertEqual(['b'], cache.evict())
+            self.assertEqual({'a', 'c'}, cache.list_keys())
+
+            # 10 bytes more than the size limit
+            self.assertTrue(cache.add('test', 'd', 'base'))
+            self.assertEqual(['c'], cache.evict(keep=['a']))
+            self.assertEqual({'a', 'd'}, cache.list_keys())
+            self.assertEqual([], cache.evict())
+
+
+if __name__ == '__main__':
+    unittest.main()
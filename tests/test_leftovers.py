@@ -0,0 +1,177 @@
+#  Unit tests for leftovers.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import json
+import os
+import socket
+import tempfile
+import time
+import unittest
+from ebuild_commander.leftovers import *
+
+# Stands in for Docker without creating or removing any container; 'ps' and
+# 'container inspect' print the contents of files next to this script, and
+# every other command is logged
+_FAKE_DOCKER = '''#!/bin/sh
+dir="${0%/*}"
+case "$1" in
+    ps)
+        case "$*" in
+            *label=*) cat "${dir}/labelled" ;;
+            *) cat "${dir}/all" ;;
+        esac ;;
+    container) cat "${dir}/inspect" ;;
+    *)
+        echo "$*" >> "${dir}/calls"
+        [ "$3" != fail ] ;;
+esac
+'''
+
+
+def _inspect(labels: dict) -> dict:
+    return {'Config': {'Labels': labels}}
+
+
+class TestLeftovers(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._docker_cmd = os.path.join(self._tmp.name, 'docker')
+        with open(self._docker_cmd, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(self._docker_cmd, 0o755)
+
+    def _write(self, name: str, content: str):
+        with open(os.path.join(self._tmp.name, name), 'w') as f:
+            f.write(content)
+
+    def _get_calls(self) -> list[str]:
+        try:
+            with open(os.path.join(self._tmp.name, 'calls')) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def test_get_labels(self):
+        labels = get_labels()
+        self.assertAlmostEqual(time.time(), int(labels[LABEL_CREATED]),
+                               delta=5)
+        self.assertEqual(str(os.getpid()), labels[LABEL_PID])
+        self.assertNotIn(LABEL_KEPT, labels)
+        self.assertEqual('true', get_labels(True)[LABEL_KEPT])
+
+    def test_list_leftover_containers(self):
+        host = socket.gethostname()
+        self._write('labelled', 'renamed\nother-host\nrunning\nkept\n')
+        self._write('all', 'kept\nrenamed\nother-host\nrunning\n'
+                           'unrelated\n'
+                           'ebuild-cmder-20220301-120000\n'
+                           'ebuild-cmder-20220301-120000-2\n'
+                           'ebuild-cmder-20220301-120000-1-1\n')
+        # 'docker container inspect' reports the containers in the order
+        # they are given, which is sorted
+        self._write('inspect', json.dumps([
+            _inspect({}),
+            _inspect({}),
+            _inspect({}),
+            _inspect({LABEL_CREATED: '50', LABEL_HOST: host,
+                      LABEL_PID: '0', LABEL_KEPT: 'true'}),
+            _inspect({LABEL_CREATED: '100', LABEL_HOST: 'elsewhere',
+                      LABEL_PID: str(os.getpid())}),
+            _inspect({LABEL_CREATED: '200', LABEL_HOST: host,
+                      LABEL_PID: '0'}),
+            _inspect({LABEL_CREATED: '300', LABEL_HOST: host,
+                      LABEL_PID: str(os.getpid())}),
+        ]))
+        created = time.mktime((2022, 3, 1, 12, 0, 0, 0, 0, -1))
+        self.assertEqual(
+            [LeftoverContainer('ebuild-cmder-20220301-120000', created,
+                               False),
+             # Created by PID 1, which is always running
+             LeftoverContainer('ebuild-cmder-20220301-120000-1-1', created,
+                               True),
+             LeftoverContainer('ebuild-cmder-20220301-120000-2', created,
+                               False),
+             LeftoverContainer('kept', 50, False, True, True),
+             LeftoverContainer('other-host', 100, False),
+             LeftoverContainer('renamed', 200, False, True),
+             LeftoverContainer('running', 300, True)],
+            list_leftover_containers(self._docker_cmd, 'ebuild-cmder'))
+
+    def test_select_containers(self):
+        containers = [LeftoverContainer('a', 100, False, True),
+                      LeftoverContainer('b', 400, False, True),
+                      LeftoverContainer('c', 300, True),
+                      LeftoverContainer('d', 200, False, True)]
+        self.assertEqual(['a', 'd', 'b'],
+                         [container.name for container in
+                          select_containers(containers)])
+        self.assertEqual(['a', 'd'],
+                         [container.name for container in
+                          select_containers(containers, max_age=150,
+                                            now=400)])
+        self.assertEqual(['a'],
+                         [container.name for container in
+                          select_containers(containers, keep=2)])
+        self.assertEqual(['a', 'd'],
+                         [container.name for container in
+                          select_containers(containers, max_age=250, keep=1,
+                                            now=400)])
+
+    def test_select_kept_containers(self):
+        now = 1000 + STALE_AGE
+        containers = [LeftoverContainer('exited', 950, False, True),
+                      LeftoverContainer('kept', 1500, False, True, True),
+                      LeftoverContainer('old-kept', 500, False, True, True),
+                      LeftoverContainer('unchecked', 1600, False),
+                      LeftoverContainer('old-unchecked', 900, False),
+                      LeftoverContainer('running', 100, True)]
+        self.assertEqual(['old-kept', 'old-unchecked', 'exited'],
+                         [container.name for container in
+                          select_containers(containers, now=now)])
+        self.assertEqual(['old-kept', 'old-unchecked', 'exited', 'kept',
+                          'unchecked'],
+                         [container.name for container in
+                          select_containers(containers, remove_all=True,
+                                            now=now)])
+        self.assertEqual(['old-kept', 'old-unchecked', 'exited', 'kept'],
+                         [container.name for container in
+                          select_containers(containers, keep=1,
+                                            remove_all=True, now=now)])
+
+    def test_remove_containers(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(1, remove_containers(
+                'ebuild-cmder', self._docker_cmd, ['a', 'fail', 'b']))
+        self.assertEqual({'rm -f a', 'rm -f fail', 'rm -f b'},
+                         set(self._get_calls()))
+
+    def test_remove_in_background(self):
+        self.assertTrue(remove_in_background(self._docker_cmd, ['a', 'b']))
+        deadline = time.monotonic() + 10
+        while not self._get_calls() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['rm -f a b'], self._get_calls())
+
+
+if __name__ == '__main__':
+    unittest.main()
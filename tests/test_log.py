@@ -0,0 +1,80 @@
+#  Unit tests for log.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import gzip
+import pathlib
+import tempfile
+import unittest
+from ebuild_commander.log import *
+
+from ebuild_commander.timing import Origin
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.path = pathlib.Path(self._tmp.name)
+
+    def test_command_log(self):
+        log = CommandLog(self.path / 'test.log.gz', 'emerge foo\n', 2)
+        for data in (b'line 1\nline', b' 2\n', b'line 3\n', b'line 4'):
+            self.assertEqual(len(data), log.write(data))
+        log.flush()
+        self.assertEqual([b'line 3', b'line 4'], log.get_tail())
+        log.write(b'\n')
+        self.assertEqual([b'line 3', b'line 4'], log.get_tail())
+        log.close()
+        with gzip.open(self.path / 'test.log.gz') as f:
+            self.assertEqual(b'$ emerge foo\nline 1\nline 2\nline 3\n'
+                             b'line 4\n', f.read())
+
+    def test_empty_tail(self):
+        log = CommandLog(self.path / 'test.log.gz', 'true', 0)
+        log.write(b'line 1\nline 2')
+        self.assertEqual([], log.get_tail())
+        log.close()
+
+    def test_long_line(self):
+        log = CommandLog(self.path / 'test.log.gz', 'yes', 1)
+        for _ in range(10):
+            log.write(b'y' * 65536)
+        self.assertEqual([b'y' * 65536], log.get_tail())
+        log.close()
+
+    def test_log_dir(self):
+        log_dir = LogDir(self.path / 'logs', 5)
+        logs = [log_dir.open('cmder-1', 'emerge foo',
+                             Origin('/tmp/emerge.sh', 3)),
+                log_dir.open('cmder-1', 'emerge bar', Origin('-', 1)),
+                log_dir.open('cmder-2', 'emerge baz')]
+        for log in logs:
+            log.close()
+        self.assertEqual(
+            [self.path / 'logs' / 'cmder-1' / '0001-emerge.sh-3.log.gz',
+             self.path / 'logs' / 'cmder-1' / '0002-stdin-1.log.gz',
+             self.path / 'logs' / 'cmder-2' / '0001.log.gz'],
+            [log.path for log in logs])
+        for log in logs:
+            self.assertTrue(log.path.is_file())
+
+
+if __name__ == '__main__':
+    unittest.main()
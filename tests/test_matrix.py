@@ -0,0 +1,55 @@
+#  Unit tests for matrix.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import unittest
+from ebuild_commander.matrix import *
+
+
+class TestMatrix(unittest.TestCase):
+    def test_single_cell(self):
+        cells = get_cells(['default/linux/amd64/17.1'], ['gentoo/stage3'],
+                          [[pathlib.Path('/etc/portage')]])
+        self.assertEqual(1, len(cells))
+
+    def test_cells(self):
+        configs = [[pathlib.Path('/etc/portage')],
+                   [pathlib.Path('/etc/portage'), pathlib.Path('test')]]
+        cells = get_cells(['default/linux/amd64/17.1',
+                           'default/linux/amd64/17.1/systemd'],
+                          ['gentoo/stage3', 'gentoo/stage3:musl'], configs)
+        self.assertEqual(8, len(cells))
+        self.assertEqual(8, len(set(
+            (cell.profile, cell.docker_image, cell.describe_configs())
+            for cell in cells)))
+
+    def test_threads_per_cell(self):
+        self.assertEqual(16, get_threads_per_cell(16, 1, 1))
+        self.assertEqual(4, get_threads_per_cell(16, 4, 8))
+        self.assertEqual(8, get_threads_per_cell(16, 4, 2))
+        self.assertEqual(1, get_threads_per_cell(2, 4, 4))
+
+    def test_start_order(self):
+        self.assertEqual([0, 1, 2], get_start_order(None, 3))
+        self.assertEqual([1, 3, 2, 0],
+                         get_start_order([10, None, 60, None], 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#  Unit tests for metadata.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+
+import os
+import pathlib
+import tempfile
+import unittest
+from ebuild_commander.metadata import *
+
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.repo = pathlib.Path(self._tmp.name, 'repo')
+        self.master = pathlib.Path(self._tmp.name, 'gentoo')
+        for path in (self.repo / 'app-misc' / 'foo' / 'foo-1.ebuild',
+                     self.repo / 'eclass' / 'foo.eclass',
+                     self.repo / 'metadata' / 'layout.conf',
+                     self.master / 'eclass' / 'bar.eclass',
+                     self.master / 'app-misc' / 'bar' / 'bar-1.ebuild'):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text('EAPI=8\n')
+
+    def test_repo_digest(self):
+        digest = get_repo_digest(self.repo, [self.master])
+        self.assertEqual(digest, get_repo_digest(self.repo, [self.master]))
+        self.assertNotEqual(digest, get_repo_digest(self.repo))
+
+        # Files that do not affect the metadata cache
+        (self.repo / 'app-misc' / 'foo' / 'Manifest').write_text('DIST\n')
+        (self.repo / 'metadata' / 'layout.conf').write_text('masters =\n')
+        (self.master / 'app-misc' / 'bar' / 'bar-2.ebuild').write_text('')
+        self.assertEqual(digest, get_repo_digest(self.repo, [self.master]))
+
+        ebuild = self.repo / 'app-misc' / 'foo' / 'foo-1.ebuild'
+        ebuild.write_text('EAPI=8\nSLOT=0\n')
+        new_digest = get_repo_digest(self.repo, [self.master])
+        self.assertNotEqual(digest, new_digest)
+
+        st = ebuild.stat()
+        eclass = self.master / 'eclass' / 'bar.eclass'
+        os.utime(eclass, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertNotEqual(new_digest,
+                            get_repo_digest(self.repo, [self.master]))
+
+    def test_up_to_date(self):
+        partition = pathlib.Path(self._tmp.name, 'partition')
+        partition.mkdir()
+        digest = get_repo_digest(self.repo)
+        self.assertFalse(is_up_to_date(partition, digest))
+        mark_up_to_date(partition, digest)
+        self.assertTrue(is_up_to_date(partition, digest))
+        self.assertFalse(is_up_to_date(partition, 'f' * 32))
+        self.assertEqual([], [path for path in partition.iterdir()
+                              if not path.name.startswith('.')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#  Unit tests for pipeline.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+from ebuild_commander.pipeline import *
+
+
+class TestTaskGraph(unittest.TestCase):
+    def test_order(self):
+        finished = []
+
+        def task(name: str):
+            def run() -> str:
+                finished.append(name)
+                return name.upper()
+            return run
+
+        graph = TaskGraph()
+        graph.add('a', task('a'))
+        graph.add('b', task('b'), ['a'])
+        graph.add('c', task('c'), ['a', 'b'])
+        self.assertEqual({'a': 'A', 'b': 'B', 'c': 'C'}, graph.run())
+        self.assertEqual(['a', 'b', 'c'], finished)
+        self.assertEqual({}, TaskGraph().run())
+
+    def test_concurrency(self):
+        # Neither task can finish unless both run at the same time
+        barrier = threading.Barrier(2, timeout=10)
+        graph = TaskGraph()
+        graph.add('a', barrier.wait)
+        graph.add('b', barrier.wait)
+        self.assertEqual({0, 1}, set(graph.run().values()))
+
+    def test_failure(self):
+        finished = []
+
+        def fail() -> None:
+            raise OSError('failed')
+
+        graph = TaskGraph()
+        graph.add('a', fail)
+        graph.add('b', lambda: finished.append('b'), ['a'])
+        graph.add('c', lambda: finished.append('c'))
+        with self.assertRaises(OSError):
+            graph.run()
+        self.assertNotIn('b', finished)
+
+    def test_invalid_task(self):
+        graph = TaskGraph()
+        graph.add('a', lambda: None)
+        with self.assertRaises(ValueError):
+            graph.add('a', lambda: None)
+        with self.assertRaises(ValueError):
+            graph.add('b', lambda: None, ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
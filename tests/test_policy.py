@@ -0,0 +1,142 @@
+#  Unit tests for policy.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import unittest
+from ebuild_commander.policy import *
+
+from ebuild_commander.timing import Origin
+
+
+def _run(policy: ExecutionPolicy, script: str, lines: list[str],
+         failing: set[str]) -> list[str]:
+    """
+    Run a script with the policy, where the lines in `failing` fail.
+
+    :return: the lines that were run
+    """
+    run = []
+    with contextlib.redirect_stderr(io.StringIO()):
+        for line, origin in policy.select(script, lines):
+            run.append(line)
+            policy.record(line not in failing)
+    return run
+
+
+class TestPolicy(unittest.TestCase):
+    def test_parse_annotations(self):
+        self.assertEqual((Annotations(), False),
+                         parse_annotations('emerge foo # comment\n'))
+        self.assertEqual((Annotations('foo'), False),
+                         parse_annotations('emerge foo #@ id=foo\n'))
+        self.assertEqual(
+            (Annotations('bar', ('foo', 'baz')), False),
+            parse_annotations('emerge bar #@ id=bar after=foo,baz\n'))
+        self.assertEqual((Annotations(stop_on_error=True), True),
+                         parse_annotations('#@ stop-on-error\n'))
+        self.assertEqual((Annotations(stop_on_error=False), True),
+                         parse_annotations('  #@ continue-on-error\n'))
+        with self.assertRaises(ValueError):
+            parse_annotations('emerge foo #@ id\n')
+        with self.assertRaises(ValueError):
+            parse_annotations('#@ retry=3\n')
+
+    def test_continue_by_default(self):
+        policy = ExecutionPolicy('ebuild-cmder')
+        lines = ['a\n', 'b\n', 'c\n']
+        self.assertEqual(lines, _run(policy, 'test.sh', lines, {'a\n'}))
+        self.assertEqual([FAILED, PASSED, PASSED],
+                         [result.outcome for result in policy.results])
+
+    def test_fail_fast(self):
+        policy = ExecutionPolicy('ebuild-cmder', fail_fast=True)
+        self.assertEqual(['a\n', 'b\n'],
+                         _run(policy, '1.sh', ['a\n', 'b\n', 'c\n'], {'b\n'}))
+        self.assertEqual([], _run(policy, '2.sh', ['d\n'], set()))
+        self.assertEqual(
+            [LineResult(Origin('1.sh', 1), 'a', PASSED),
+             LineResult(Origin('1.sh', 2), 'b', FAILED),
+             LineResult(Origin('1.sh', 3), 'c', SKIPPED, '1.sh:2 failed'),
+             LineResult(Origin('2.sh', 1), 'd', SKIPPED, '1.sh:2 failed')],
+            policy.results)
+
+    def test_select_scripts(self):
+        policy = ExecutionPolicy('ebuild-cmder')
+        scripts = [('1.sh', ['a\n', '#@ id=b\n', 'b\n']),
+                   ('2.sh', ['c\n', 'd\n'])]
+        # The first three lines of all scripts have succeeded before
+        run = []
+        for line, origin in policy.select_scripts(scripts, 3):
+            run.append((line, origin))
+            policy.record(True)
+        self.assertEqual([('c\n', Origin('2.sh', 1)),
+                          ('d\n', Origin('2.sh', 2))], run)
+        self.assertEqual([PASSED] * 4,
+                         [result.outcome for result in policy.results])
+
+    def test_stop_on_error(self):
+        policy = ExecutionPolicy('ebuild-cmder')
+        lines = ['a\n', '#@ stop-on-error\n', 'b\n', 'c\n']
+        self.assertEqual(['a\n', 'b\n'],
+                         _run(policy, '1.sh', lines, {'a\n', 'b\n'}))
+        # The setting only applies to the rest of the script
+        self.assertEqual(['d\n', 'e\n'],
+                         _run(policy, '2.sh', ['d\n', 'e\n'], {'d\n'}))
+        self.assertEqual([FAILED, FAILED, SKIPPED, FAILED, PASSED],
+                         [result.outcome for result in policy.results])
+        # Lines with only an annotation are not counted
+        self.assertEqual(Origin('1.sh', 3), policy.results[1].origin)
+
+    def test_dependencies(self):
+        policy = ExecutionPolicy('ebuild-cmder')
+        lines = ['a #@ id=a\n', 'b #@ id=b after=a\n', 'c #@ after=b\n',
+                 'd #@ after=missing\n', 'e\n']
+        self.assertEqual(['a #@ id=a\n', 'd #@ after=missing\n', 'e\n'],
+                         _run(policy, 'test.sh', lines, {'a #@ id=a\n'}))
+        results = policy.results
+        self.assertEqual([FAILED, SKIPPED, SKIPPED, PASSED, PASSED],
+                         [result.outcome for result in results])
+        self.assertEqual("depends on 'a', which failed", results[1].reason)
+        # Skipping a line skips the lines depending on it
+        self.assertEqual("depends on 'b', which skipped", results[2].reason)
+
+    def test_format_report(self):
+        policy = ExecutionPolicy('ebuild-cmder')
+        _run(policy, 'test.sh', ['a #@ id=a\n', 'b #@ after=a\n', 'c\n'],
+             {'a #@ id=a\n'})
+        self.assertEqual(
+            ['Lines: 1 passed, 1 failed, 1 skipped',
+             'Failed lines:',
+             '  test.sh:1: a #@ id=a',
+             'Skipped lines:',
+             "  test.sh:2: b #@ after=a (depends on 'a', which failed)"],
+            policy.format_report())
+
+    def test_record_required(self):
+        policy = ExecutionPolicy('ebuild-cmder')
+        lines = policy.select('test.sh', ['a\n', 'b\n'])
+        next(lines)
+        with self.assertRaises(RuntimeError):
+            next(lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#  Unit tests for portage_config.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from ebuild_commander.portage_config import *
+
+
+class TestPortageConfig(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._root = pathlib.Path(self._tmp.name)
+
+    def _make_config_dir(self, name: str, files: dict) -> pathlib.Path:
+        config_dir = self._root / name
+        for path, contents in files.items():
+            file = config_dir / path
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(contents)
+        return config_dir
+
+    def test_overlay(self):
+        base = self._make_config_dir('base', {
+            'make.conf': 'USE="a"\n',
+            'package.use/foo': 'dev-libs/foo bar\n',
+        })
+        top = self._make_config_dir('top', {
+            'make.conf': 'USE="b"\n',
+            'package.use/baz': 'dev-libs/baz qux\n',
+        })
+        config = PortageConfig([base, top])
+        self.assertEqual(b'USE="b"\n', config.get_file_contents('make.conf'))
+        self.assertEqual(b'dev-libs/foo bar\n',
+                         config.get_file_contents('package.use/foo'))
+        self.assertEqual(b'dev-libs/baz qux\n',
+                         config.get_file_contents('package.use/baz'))
+
+    def test_file_replaces_directory(self):
+        base = self._make_config_dir('base', {
+            'package.use/foo': 'dev-libs/foo bar\n',
+        })
+        top = self._make_config_dir('top', {
+            'package.use': 'dev-libs/baz qux\n',
+        })
+        config = PortageConfig([base, top])
+        self.assertEqual(b'dev-libs/baz qux\n',
+                         config.get_file_contents('package.use'))
+        self.assertIsNone(config.get_file_contents('package.use/foo'))
+
+    def test_ignored_entries(self):
+        config_dir = self._make_config_dir('config', {
+            'repos.conf/gentoo.conf': '[gentoo]\n',
+            '.hidden': '',
+        })
+        os.symlink('/var/db/repos/gentoo/profiles/default',
+                   config_dir / 'make.profile')
+        config = PortageConfig([config_dir])
+        self.assertIsNone(config.get_file_contents('repos.conf/gentoo.conf'))
+        self.assertIsNone(config.get_file_contents('.hidden'))
+        with tarfile.open(fileobj=io.BytesIO(config.to_tar())) as tar:
+            self.assertEqual([], tar.getnames())
+
+    def test_append_to_file(self):
+        config_dir = self._make_config_dir('config', {
+            'make.conf': 'USE="a"\n',
+        })
+        config = PortageConfig([config_dir])
+        config.append_to_file('make.conf', 'USE="${USE} b"\n')
+        self.assertEqual(b'USE="a"\nUSE="${USE} b"\n',
+                         config.get_file_contents('make.conf'))
+        config.append_to_file('package.env', 'dev-libs/foo foo.conf\n')
+        self.assertEqual(b'dev-libs/foo foo.conf\n',
+                         config.get_file_contents('package.env'))
+        # The source file on the host must be left alone
+        self.assertEqual('USE="a"\n',
+                         (config_dir / 'make.conf').read_text())
+
+    def test_read_at_once(self):
+        config_dir = self._make_config_dir('config', {
+            'make.conf': 'USE="a"\n',
+        })
+        config = PortageConfig([config_dir])
+        (config_dir / 'make.conf').write_text('USE="b"\n')
+        self.assertEqual(b'USE="a"\n', config.get_file_contents('make.conf'))
+
+    def test_append_to_directory(self):
+        config_dir = self._make_config_dir('config', {
+            'make.conf/00-base': 'USE="a"\n',
+        })
+        config = PortageConfig([config_dir])
+        config.append_to_file('make.conf', 'USE="${USE} b"\n')
+        self.assertEqual(b'USE="a"\nUSE="${USE} b"\n',
+                         config.get_file_contents('make.conf'))
+
+    def test_to_tar(self):
+        config_dir = self._make_config_dir('config', {
+            'make.conf': 'USE="a"\n',
+        })
+        config = PortageConfig([config_dir])
+        config.add_file('repos.conf/local.conf', '[local]\n')
+        with tarfile.open(fileobj=io.BytesIO(config.to_tar())) as tar:
+            self.assertEqual(['make.conf', 'repos.conf',
+                              'repos.conf/local.conf'], tar.getnames())
+            self.assertTrue(tar.getmember('repos.conf').isdir())
+            self.assertEqual(0, tar.getmember('make.conf').uid)
+            self.assertEqual(b'[local]\n',
+                             tar.extractfile('repos.conf/local.conf').read())
+
+    def test_digest(self):
+        config_dir = self._make_config_dir('config', {
+            'make.conf': 'USE="a"\n',
+        })
+        digest = PortageConfig([config_dir]).get_digest()
+        os.utime(config_dir / 'make.conf', (0, 0))
+        self.assertEqual(digest, PortageConfig([config_dir]).get_digest())
+        config = PortageConfig([config_dir])
+        config.append_to_file('make.conf', 'USE="${USE} b"\n')
+        self.assertNotEqual(digest, config.get_digest())
+
+    def test_find_assignments(self):
+        make_conf = ('COMMON_FLAGS="-O2 -pipe"\n'
+                     'CFLAGS="${COMMON_FLAGS}"\n'
+                     'export CXXFLAGS=\'-O3\'\n'
+                     'USE="a\n'
+                     '    b"\n'
+                     'MAKEOPTS="-j4"\n'
+                     '# USE="c"\n')
+        self.assertEqual(['CFLAGS="${COMMON_FLAGS}"',
+                          'export CXXFLAGS=\'-O3\'',
+                          'USE="a\n    b"'],
+                         find_assignments(make_conf,
+                                          ['CFLAGS', 'CXXFLAGS', 'USE']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#  Unit tests for pull.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+
+import os
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+from ebuild_commander.pull import *
+
+
+class TestPull(unittest.TestCase):
+    def test_should_pull(self):
+        always = PullPolicy(PULL_ALWAYS)
+        if_missing = PullPolicy(PULL_IF_MISSING)
+        if_older = PullPolicy(PULL_IF_OLDER_THAN, 3600)
+        record = PullRecord(1000, 'sha256:a')
+        self.assertTrue(should_pull(always, record, 'sha256:a', 1001))
+        self.assertFalse(should_pull(if_missing, None, 'sha256:a', 1001))
+        self.assertTrue(should_pull(if_missing, None, None, 1001))
+        self.assertFalse(should_pull(if_older, record, 'sha256:a', 4599))
+        self.assertTrue(should_pull(if_older, record, 'sha256:a', 4600))
+        self.assertTrue(should_pull(if_older, record, 'sha256:b', 1001))
+        self.assertTrue(should_pull(if_older, None, 'sha256:a', 1001))
+        self.assertTrue(should_pull(if_older, record, None, 1001))
+
+    def test_records(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            records = PullRecords(pathlib.Path(tmp, 'pulls'))
+            self.assertIsNone(records.get('gentoo/stage3'))
+            with records.lock('gentoo/stage3'):
+                records.put('gentoo/stage3', PullRecord(1000, 'sha256:a'))
+            records.put('gentoo/stage3:latest', PullRecord(2000, 'sha256:b'))
+            self.assertEqual(PullRecord(1000, 'sha256:a'),
+                             records.get('gentoo/stage3'))
+            self.assertEqual(PullRecord(2000, 'sha256:b'),
+                             records.get('gentoo/stage3:latest'))
+            records.put('gentoo/stage3', PullRecord(3000, 'sha256:c'))
+            self.assertEqual(PullRecord(3000, 'sha256:c'),
+                             records.get('gentoo/stage3'))
+            self.assertEqual([], list(records.path.glob('*.tmp')))
+
+    def test_records_path(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with unittest.mock.patch.dict(os.environ,
+                                          {'XDG_CACHE_HOME': tmp}):
+                local = PullRecords(get_default_records_path())
+                remote = PullRecords(get_default_records_path('build1'))
+                local.put('gentoo/stage3', PullRecord(1000, 'sha256:a'))
+                # A pull on one Docker daemon is not one on another
+                self.assertIsNone(remote.get('gentoo/stage3'))
+                self.assertNotEqual(
+                    get_default_records_path('build1'),
+                    get_default_records_path('build2'))
+
+    def test_corrupt_record(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            records = PullRecords(pathlib.Path(tmp))
+            records.put('gentoo/stage3', PullRecord(1000, 'sha256:a'))
+            for path in records.path.glob('*.json'):
+                path.write_text('{"image": "gentoo/stage3"')
+            self.assertIsNone(records.get('gentoo/stage3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+#  Unit tests for shard.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+
+import contextlib
+import io
+import os
+import tempfile
+import typing
+import unittest
+from ebuild_commander.shard import *
+
+from ebuild_commander.async_docker import AsyncCommandocker
+
+_TREE_CMD = 'emerge --pretend --tree --color n --nospinner'
+
+_PRETEND_CMD = 'emerge --pretend --oneshot --color n --nospinner'
+
+_TREE_OUTPUT = '''\
+These are the packages that would be merged, in reverse order:
+
+Calculating dependencies... done!
+[ebuild  N     ] app-misc/a-1::gentoo  USE="-test"
+[ebuild  N     ]  dev-libs/b-2:0/2::gentoo
+[ebuild  N     ]   dev-libs/c-3::gentoo
+[ebuild  N     ]  dev-libs/d-4::gentoo
+[nomerge       ] app-misc/e-5::gentoo
+[binary   R    ]  dev-libs/f-6::gentoo
+[ebuild     U  ]  dev-libs/g-7::gentoo [6::gentoo]
+[ebuild  N     ] app-misc/h-8::gentoo
+[blocks B      ] <dev-libs/c-2 ("<dev-libs/c-2" is blocking dev-libs/b-2)
+
+Total: 7 packages (1 upgrade, 5 new, 1 reinstall, 1 binary), Size of \
+downloads: 0 KiB
+'''
+
+
+# A dependency tree where two packages depend on the same package
+_DIAMOND_TREE_OUTPUT = '''\
+[ebuild  N     ] app-misc/x-1::gentoo
+[ebuild  N     ]  dev-libs/y-1::gentoo
+[ebuild  N     ] app-misc/z-1::gentoo
+[ebuild  N     ]  dev-libs/shared-1::gentoo
+'''
+
+
+class _FakeContainer:
+    # Commands are run by the real implementation, through the methods below
+    run_scripts = AsyncCommandocker.run_scripts
+    skipped_commands = 0
+
+    def __init__(self, name: str, outputs: dict[str, str],
+                 log: typing.Optional[list[str]] = None):
+        self.name = name
+        self.commands = []
+        # Commands of every container, in the order they are run
+        self._log = log if log is not None else []
+        self.cleaned_up = False
+        # The output of each command captured by the container
+        self._outputs = outputs
+
+    async def start(self) -> bool:
+        return True
+
+    async def execute(self, cmd: str, origin=None) -> bool:
+        self.commands.append(cmd)
+        self._log.append(cmd)
+        return True
+
+    async def capture(self, cmd: str) -> tuple[int, bytes]:
+        self.commands.append(cmd)
+        self._log.append(cmd)
+        return 0, self._outputs.get(cmd, '').encode()
+
+    async def finish(self) -> None:
+        pass
+
+    async def cleanup(self) -> bool:
+        self.cleaned_up = True
+        return True
+
+
+def _describe(nodes: list[TreeNode]) -> list[str]:
+    return [node.cpv for node in nodes]
+
+
+class TestShard(unittest.TestCase):
+    def test_parse_tree(self):
+        roots = parse_tree(_TREE_OUTPUT)
+        self.assertEqual(['app-misc/a-1::gentoo', 'app-misc/e-5::gentoo',
+                          'app-misc/h-8::gentoo'], _describe(roots))
+        a, e, h = roots
+        self.assertEqual(['dev-libs/b-2:0/2::gentoo', 'dev-libs/d-4::gentoo'],
+                         _describe(a.children))
+        self.assertEqual(['dev-libs/c-3::gentoo'],
+                         _describe(a.children[0].children))
+        self.assertEqual('=dev-libs/b-2:0/2::gentoo', a.children[0].atom)
+        self.assertFalse(e.merge)
+        self.assertEqual(['dev-libs/f-6::gentoo', 'dev-libs/g-7::gentoo'],
+                         _describe(e.children))
+        self.assertEqual([4, 2, 1],
+                         [node.get_weight() for node in roots])
+        self.assertEqual([], parse_tree('Nothing to merge; quitting.\n'))
+
+    def test_plan_shards(self):
+        roots = parse_tree(_TREE_OUTPUT)
+        # 'app-misc/e' is installed, so its children are merged separately
+        self.assertEqual(
+            [['app-misc/a-1::gentoo'],
+             ['dev-libs/f-6::gentoo', 'dev-libs/g-7::gentoo',
+              'app-misc/h-8::gentoo']],
+            [_describe(shard) for shard in plan_shards(roots, 2)])
+        # 'app-misc/a' is heavier than an even share, so it is merged after
+        # its dependencies are merged by different shards
+        self.assertEqual(
+            [['dev-libs/b-2:0/2::gentoo'],
+             ['dev-libs/f-6::gentoo', 'app-misc/h-8::gentoo'],
+             ['dev-libs/g-7::gentoo', 'dev-libs/d-4::gentoo']],
+            [_describe(shard) for shard in plan_shards(roots, 3)])
+        self.assertEqual([['app-misc/a-1::gentoo', 'dev-libs/f-6::gentoo',
+                           'dev-libs/g-7::gentoo', 'app-misc/h-8::gentoo']],
+                         [_describe(shard) for shard in plan_shards(roots, 1)])
+        self.assertEqual([[], []], plan_shards([], 2))
+
+    def test_plan_shards_with_durations(self):
+        roots = parse_tree(_TREE_OUTPUT)
+        durations = {'app-misc/h': 600, 'dev-libs/c': 300, 'app-misc/a': 10,
+                     'dev-libs/b': 10, 'dev-libs/d': 10}
+        # 'app-misc/h' takes the longest to build despite having no
+        # dependency, so it gets a shard on its own
+        self.assertEqual(
+            [['app-misc/h-8::gentoo'],
+             ['app-misc/a-1::gentoo', 'dev-libs/f-6::gentoo',
+              'dev-libs/g-7::gentoo']],
+            [_describe(shard)
+             for shard in plan_shards(roots, 2, durations)])
+        # Packages without an estimate are weighed as long as the median
+        self.assertEqual(40, roots[1].get_weight(lambda node: 20))
+
+    def test_runner(self):
+        containers = []
+
+        def create_container(index, program_name, output):
+            containers.append(_FakeContainer(
+                f'test-{index}',
+                {f'{_TREE_CMD} app-misc/a app-misc/h': _TREE_OUTPUT}))
+            return containers[-1]
+
+        runner = ShardRunner('ebuild-cmder', 2, create_container,
+                             lambda status: True, 130)
+        self.assertEqual(0, runner.run([('setup.sh', ['echo setup\n'])],
+                                       ['app-misc/a', 'app-misc/h']))
+        # The shards need no package in common
+        self.assertEqual(
+            ['echo setup\n',
+             f'{_TREE_CMD} app-misc/a app-misc/h',
+             f'{_PRETEND_CMD} =app-misc/a-1::gentoo',
+             'emerge --oneshot =app-misc/a-1::gentoo',
+             'emerge app-misc/a app-misc/h'],
+            containers[0].commands)
+        self.assertEqual(
+            ['echo setup\n',
+             f'{_PRETEND_CMD} =dev-libs/f-6::gentoo =dev-libs/g-7::gentoo '
+             f'=app-misc/h-8::gentoo',
+             'emerge --oneshot =dev-libs/f-6::gentoo =dev-libs/g-7::gentoo '
+             '=app-misc/h-8::gentoo'],
+            containers[1].commands)
+        self.assertTrue(all(container.cleaned_up
+                            for container in containers))
+
+    def test_shared_dependency(self):
+        # Both 'app-misc/x' and 'app-misc/z' depend on 'dev-libs/shared',
+        # which the tree shows only under 'app-misc/z'
+        outputs = {
+            f'{_TREE_CMD} app-misc/x app-misc/z': _DIAMOND_TREE_OUTPUT,
+            f'{_PRETEND_CMD} =app-misc/x-1::gentoo':
+                '[ebuild  N     ] dev-libs/shared-1::gentoo\n'
+                '[ebuild  N     ] dev-libs/y-1::gentoo\n'
+                '[ebuild  N     ] app-misc/x-1::gentoo\n',
+            f'{_PRETEND_CMD} =app-misc/z-1::gentoo':
+                '[ebuild  N     ] dev-libs/shared-1::gentoo\n'
+                '[ebuild  N     ] app-misc/z-1::gentoo\n',
+        }
+        log = []
+        containers = []
+
+        def create_container(index, program_name, output):
+            containers.append(_FakeContainer(f'test-{index}', outputs, log))
+            return containers[-1]
+
+        runner = ShardRunner('ebuild-cmder', 2, create_container,
+                             lambda status: True, 130)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(0, runner.run([], ['app-misc/x', 'app-misc/z']))
+        self.assertEqual(
+            [f'{_TREE_CMD} app-misc/x app-misc/z',
+             f'{_PRETEND_CMD} =app-misc/x-1::gentoo',
+             'emerge --oneshot =dev-libs/shared-1::gentoo',
+             'emerge --oneshot =app-misc/x-1::gentoo',
+             'emerge app-misc/x app-misc/z'],
+            containers[0].commands)
+        self.assertEqual(
+            [f'{_PRETEND_CMD} =app-misc/z-1::gentoo',
+             'emerge --oneshot =app-misc/z-1::gentoo'],
+            containers[1].commands)
+        # The shared package is built before any shard starts merging
+        self.assertLess(
+            log.index('emerge --oneshot =dev-libs/shared-1::gentoo'),
+            log.index('emerge --oneshot =app-misc/z-1::gentoo'))
+
+    def test_find_shared_packages(self):
+        first = parse_tree('[ebuild  N     ] dev-libs/a-1::gentoo\n'
+                           '[nomerge       ] dev-libs/b-2::gentoo\n'
+                           '[ebuild  N     ]  dev-libs/c-3::gentoo\n')
+        second = parse_tree('[ebuild  N     ] dev-libs/c-3::gentoo\n'
+                            '[nomerge       ] dev-libs/b-2::gentoo\n'
+                            '[binary   R    ] dev-libs/a-1::gentoo\n')
+        # Packages that will not be merged are not shared
+        self.assertEqual(['=dev-libs/a-1::gentoo', '=dev-libs/c-3::gentoo'],
+                         find_shared_packages([first, second]))
+        self.assertEqual([], find_shared_packages([first]))
+
+    def test_read_package_list(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'packages')
+            with open(path, 'w') as f:
+                f.write('# Packages to test\n'
+                        'app-misc/a dev-libs/b  # and b\n'
+                        '\n'
+                        '>=dev-libs/c-3\n')
+            self.assertEqual(['app-misc/a', 'dev-libs/b', '>=dev-libs/c-3'],
+                             read_package_list(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+#  Unit tests for snapshot.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import unittest
+import unittest.mock
+from ebuild_commander.snapshot import *
+
+# Stands in for Docker by keeping the 'docker image inspect' output for each
+# image in a file in the directory given by $IMAGES, and logging every
+# command to $DOCKER_LOG; the only container is named 'test'
+_FAKE_DOCKER = f'''#!{sys.executable}
+import json, os, pathlib, sys
+images = pathlib.Path(os.environ['IMAGES'])
+with open(os.environ['DOCKER_LOG'], 'a') as log:
+    print(' '.join(sys.argv[1:]), file=log)
+def path(name):
+    return images / name.replace('/', '%').replace(':', '@')
+args = sys.argv[1:]
+if args[:2] == ['image', 'ls']:
+    for file in sorted(images.iterdir()):
+        name = file.name.replace('%', '/').replace('@', ':')
+        if name.split(':')[0] == args[-1]:
+            print(name)
+elif args[:3] == ['image', 'inspect', '--format']:
+    if not path(args[-1]).exists():
+        sys.exit(1)
+    print(json.loads(path(args[-1]).read_text())['Id'])
+elif args[:2] == ['image', 'inspect']:
+    if not all(path(name).exists() for name in args[2:]):
+        sys.exit(1)
+    print(json.dumps([json.loads(path(name).read_text())
+                      for name in args[2:]]))
+elif args[:2] == ['image', 'rm']:
+    if args[2] in os.environ.get('UNREMOVABLE', '').split():
+        sys.exit(1)
+    path(args[2]).unlink()
+elif args[0] == 'commit':
+    if args[-2] != 'test':
+        sys.exit(1)
+    labels = dict(change.split(' ', 1)[1].split('=', 1)
+                  for change in args[2:-2:2])
+    path(args[-1]).write_text(json.dumps({{
+        'Id': 'sha256:' + args[-1], 'Created': str(len(os.listdir(images))),
+        'Config': {{'Labels': labels}}}}))
+'''
+
+_IMAGE = 'gentoo/stage3:latest'
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self._docker_cmd = os.path.join(self._tmp.name, 'docker')
+        with open(self._docker_cmd, 'w') as f:
+            f.write(_FAKE_DOCKER)
+        os.chmod(self._docker_cmd, 0o755)
+        self._images = pathlib.Path(self._tmp.name, 'images')
+        self._images.mkdir()
+        self._log = pathlib.Path(self._tmp.name, 'log')
+        environ = unittest.mock.patch.dict(
+            os.environ, {'IMAGES': str(self._images),
+                         'DOCKER_LOG': str(self._log)})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self._pull(_IMAGE, 'sha256:1')
+
+    def _pull(self, image: str, image_id: str) -> None:
+        path = self._images / image.replace('/', '%').replace(':', '@')
+        path.write_text(json.dumps({'Id': image_id, 'Created': '0'}))
+
+    def _get_log(self) -> list[str]:
+        commands = self._log.read_text().splitlines()
+        self._log.unlink()
+        return commands
+
+    def _create(self, key: str) -> None:
+        self.assertTrue(create_snapshot(
+            self._docker_cmd, 'test', key, _IMAGE,
+            get_image_id(self._docker_cmd, _IMAGE)))
+
+    def test_name(self):
+        self.assertEqual('ebuild-commander-snapshot:abc',
+                         get_snapshot_name('abc'))
+
+    def test_create(self):
+        self.assertEqual([], list_snapshots(self._docker_cmd))
+        self._create('a')
+        self.assertFalse(create_snapshot(self._docker_cmd, 'missing', 'b',
+                                         _IMAGE, 'sha256:1'))
+        # Images that are not snapshots are not listed
+        self.assertEqual(
+            [Snapshot('ebuild-commander-snapshot:a', '1', _IMAGE,
+                      'sha256:1')],
+            list_snapshots(self._docker_cmd))
+        self.assertEqual('sha256:ebuild-commander-snapshot:a', get_image_id(
+            self._docker_cmd, get_snapshot_name('a')))
+        self.assertIsNone(get_image_id(self._docker_cmd,
+                                       get_snapshot_name('b')))
+
+    def test_stale(self):
+        self._create('a')
+        self._create('b')
+        snapshots = list_snapshots(self._docker_cmd)
+        self._get_log()
+        image_ids = {}
+        self.assertEqual([False, False],
+                         [is_stale(self._docker_cmd, snapshot, image_ids)
+                          for snapshot in snapshots])
+        # The source image's ID is looked up only once
+        self.assertEqual(1, len(self._get_log()))
+        self._pull(_IMAGE, 'sha256:2')
+        self.assertFalse(is_stale(self._docker_cmd, snapshots[0], image_ids))
+        self.assertTrue(is_stale(self._docker_cmd, snapshots[0], {}))
+        os.remove(self._images / 'gentoo%stage3@latest')
+        self.assertTrue(is_stale(self._docker_cmd, snapshots[0], {}))
+
+    def test_print(self):
+        self._create('a')
+        self._pull(_IMAGE, 'sha256:2')
+        self._create('b')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(0, print_snapshots('test', self._docker_cmd))
+        self.assertEqual(
+            f'ebuild-commander-snapshot:a\t1\t{_IMAGE}\tstale\n'
+            f'ebuild-commander-snapshot:b\t2\t{_IMAGE}\tcurrent\n',
+            output.getvalue())
+
+    def test_prune(self):
+        self._create('a')
+        self._create('b')
+        self._pull(_IMAGE, 'sha256:2')
+        self._create('c')
+        self._get_log()
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(0, prune_snapshots('test', self._docker_cmd))
+        # Stale snapshots are removed in the order they are listed, and the
+        # source image's ID is looked up before the first removal
+        self.assertEqual(
+            [f'image inspect --format {{{{.Id}}}} {_IMAGE}',
+             f'image rm {get_snapshot_name("a")}',
+             f'image rm {get_snapshot_name("b")}'],
+            self._get_log()[2:])
+        self.assertEqual([get_snapshot_name('c')],
+                         [s.name for s in list_snapshots(self._docker_cmd)])
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(0, prune_snapshots('test', self._docker_cmd))
+
+    def test_prune_failure(self):
+        self._create('a')
+        self._create('b')
+        self._pull(_IMAGE, 'sha256:2')
+        os.environ['UNREMOVABLE'] = get_snapshot_name('a')
+        with contextlib.redirect_stderr(io.StringIO()) as messages:
+            self.assertEqual(1, prune_snapshots('test', self._docker_cmd))
+        # A failure does not stop the other stale snapshots from being removed
+        self.assertIn('Cannot remove stale snapshot '
+                      'ebuild-commander-snapshot:a', messages.getvalue())
+        self.assertEqual([get_snapshot_name('a')],
+                         [s.name for s in list_snapshots(self._docker_cmd)])
+
+
+if __name__ == '__main__':
+    unittest.main()
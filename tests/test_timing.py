@@ -0,0 +1,89 @@
+#  Unit tests for timing.py
+#
+#  Copyright (C) 2021-2022 Yuan Liao
+#
+#  This file is part of ebuild-commander.
+#
+#  ebuild-commander is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  ebuild-commander is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with ebuild-commander.  If not, see
+#  <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import tempfile
+import unittest
+from ebuild_commander.timing import *
+
+
+class TestTimingRecorder(unittest.TestCase):
+    def test_report(self):
+        recorder = TimingRecorder()
+        with recorder.phase('c1', 'run_container'):
+            pass
+        recorder.record_command('c1', 'emerge foo\n', 10.0, 2.5, 1,
+                                Origin('emerge.sh', 3))
+        recorder.record_command('c1', 'true\n', 12.5, 0.5, 0)
+        report = recorder.get_report()
+        self.assertEqual(REPORT_VERSION, report['version'])
+        phase, command, command_no_origin = report['spans']
+        self.assertEqual('phase', phase['kind'])
+        self.assertEqual('run_container', phase['name'])
+        self.assertEqual({
+            'kind': 'command',
+            'container': 'c1',
+            'command': 'emerge foo',
+            'start': 10.0,
+            'duration': 2.5,
+            'status': 1,
+            'script': 'emerge.sh',
+            'line': 3,
+        }, command)
+        self.assertNotIn('script', command_no_origin)
+
+    def test_phase_recorded_on_exception(self):
+        recorder = TimingRecorder()
+        with self.assertRaises(RuntimeError):
+            with recorder.phase('c1', 'config_portage'):
+                raise RuntimeError()
+        self.assertEqual(1, len(recorder.get_report()['spans']))
+
+    def test_summary(self):
+        recorder = TimingRecorder()
+        with recorder.phase('c1', 'run_container'):
+            pass
+        with recorder.phase('c2', 'run_container'):
+            pass
+        recorder.record_command('c1', 'fast', 0.0, 1.0, 0)
+        recorder.record_command('c1', 'slow', 0.0, 3.0, 0,
+                                Origin('-', 1))
+        recorder.record_command('c1', 'medium', 0.0, 2.0, 1)
+        lines = recorder.format_summary(2)
+        self.assertEqual(1, sum('run_container' in line for line in lines))
+        commands = lines[lines.index('Slowest commands:') + 1:]
+        self.assertEqual(2, len(commands))
+        self.assertTrue(commands[0].endswith('[0] -:1: slow'))
+        self.assertTrue(commands[1].endswith('[1] medium'))
+
+    def test_write_report(self):
+        recorder = TimingRecorder()
+        recorder.record_command('c1', 'true', 0.0, 1.0, 0)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'timing.json')
+            recorder.write_report(path)
+            with open(path) as f:
+                self.assertEqual(recorder.get_report()['spans'],
+                                 json.load(f)['spans'])
+
+
+if __name__ == '__main__':
+    unittest.main()